@@ -3,6 +3,14 @@ import psycopg2
 import argparse
 import re
 import csv
+import os
+import sys
+import itertools
+import resource
+from psycopg2.extras import execute_values
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Project"))
+import db_pool  # connection pool shared with the breadcrumb receiver
 
 DBname = "postgres"
 DBuser = "postgres"
@@ -10,6 +18,28 @@ DBpwd = "Storage"
 TableName = 'CensusData'
 Datafile = "2017.csv"  # name of the data file to be loaded
 CreateDB = False  # indicates whether the DB table should be (re)-created
+MaxRetries = 5  # consecutive lost connections tolerated while loading, by every method
+Methods = ("insert", "executemany", "execute_values", "copy")
+Method = "insert"  # how rows are sent, see loadFile
+BatchSize = 1000  # rows per executemany / execute_values batch
+
+# CSV header -> CensusData column, in table order
+Columns = {
+    "TractId": "CensusTract", "State": "State", "County": "County",
+    "TotalPop": "TotalPop", "Men": "Men", "Women": "Women", "Hispanic": "Hispanic",
+    "White": "White", "Black": "Black", "Native": "Native", "Asian": "Asian",
+    "Pacific": "Pacific", "VotingAgeCitizen": "Citizen", "Income": "Income",
+    "IncomeErr": "IncomeErr", "IncomePerCap": "IncomePerCap",
+    "IncomePerCapErr": "IncomePerCapErr", "Poverty": "Poverty",
+    "ChildPoverty": "ChildPoverty", "Professional": "Professional",
+    "Service": "Service", "Office": "Office", "Construction": "Construction",
+    "Production": "Production", "Drive": "Drive", "Carpool": "Carpool",
+    "Transit": "Transit", "Walk": "Walk", "OtherTransp": "OtherTransp",
+    "WorkAtHome": "WorkAtHome", "MeanCommute": "MeanCommute",
+    "Employed": "Employed", "PrivateWork": "PrivateWork",
+    "PublicWork": "PublicWork", "SelfEmployed": "SelfEmployed",
+    "FamilyWork": "FamilyWork", "Unemployment": "Unemployment",
+}
 
 def row2vals(row):
     for key in row:
@@ -64,12 +94,20 @@ def initialize():
   parser = argparse.ArgumentParser()
   parser.add_argument("-d", "--datafile", required=True)
   parser.add_argument("-c", "--createtable", action="store_true")
+  parser.add_argument("-m", "--method", choices=Methods, default="insert",
+                      help="insert: one literal INSERT per row; executemany / execute_values: "
+                           "parameterized batches; copy: stream the CSV through COPY FROM STDIN")
+  parser.add_argument("-b", "--batchsize", type=int, default=1000)
   args = parser.parse_args()
 
   global Datafile
   Datafile = args.datafile
   global CreateDB
   CreateDB = args.createtable
+  global Method
+  Method = args.method
+  global BatchSize
+  BatchSize = max(1, args.batchsize)
 
 # read the input data file into a list of row strings
 def readdata(fname):
@@ -83,6 +121,12 @@ def readdata(fname):
 
     return rowlist
 
+# stream the data file as parameter tuples in table order, empty fields as NULL
+def readtuples(fname):
+    with open(fname, mode="r", newline="") as fil:
+        for row in csv.DictReader(fil):
+            yield tuple(row[key] if row[key] != "" else None for key in Columns)
+
 # convert list of data rows into list of SQL 'INSERT INTO ...' commands
 def getSQLcmnds(rowlist):
     cmdlist = []
@@ -103,6 +147,10 @@ def dbconnect():
     connection.autocommit = True
     return connection
 
+# one pooled connection: pinged before reuse and replaced if the server restarts
+def dbpool():
+    return db_pool.ConnectionPool(dbconnect, size=1, retries=MaxRetries)
+
 # create the target table 
 # assumes that conn is a valid, open connection to a Postgres database
 def createTable(conn):
@@ -152,17 +200,106 @@ def createTable(conn):
         """)
         print(f"Created {TableName} (no constraints/indexes)")
 
-def load(conn, icmdlist):
+def load(pool, icmdlist):
 
-    with conn.cursor() as cursor:
-        print(f"Loading {len(icmdlist)} rows")
-        start = time.perf_counter()
+    print(f"Loading {len(icmdlist)} rows")
+    start = time.perf_counter()
+
+    # autocommit: every row already inserted stays, so after a lost
+    # connection the load resumes from the row that failed
+    i = 0
+    failures = 0
+    while i < len(icmdlist):
+        try:
+            with pool.connection() as conn, conn.cursor() as cursor:
+                while i < len(icmdlist):
+                    with pool.timed("insert"):
+                        cursor.execute(icmdlist[i])
+                    i += 1
+                    failures = 0
+        except db_pool.DISCONNECTS as e:
+            failures += 1
+            if failures > MaxRetries:
+                raise
+            print(f"load: lost connection at row {i} ({e}), reconnecting")
+            time.sleep(db_pool.RETRY_DELAY * 2 ** (failures - 1))   # as pool.run backs off
+
+    elapsed = time.perf_counter() - start
+    print(f'Finished Loading. Elapsed Time: {elapsed:0.4} seconds')
+    return len(icmdlist)
+
+# parameterized batches of BatchSize rows, read from the file as they're sent;
+# each batch is one transaction, so a batch retried on a new connection after
+# a lost one was either committed whole or not at all
+def loadBatches(pool, fname, method):
+    columns = ", ".join(Columns.values())
+    sql = f"INSERT INTO {TableName} ({columns}) VALUES "
+    placeholders = "(" + ", ".join(["%s"] * len(Columns)) + ")"
+
+    def send(conn, batch):
+        conn.autocommit = False     # dbconnect() turns it on
+        try:
+            with conn, conn.cursor() as cursor, pool.timed(method):
+                if method == "executemany":
+                    cursor.executemany(sql + placeholders, batch)
+                else:
+                    execute_values(cursor, sql + "%s", batch, page_size=len(batch))
+        finally:
+            if not conn.closed:
+                conn.autocommit = True
+
+    rows = 0
+    tuples = readtuples(fname)
+    while True:
+        batch = list(itertools.islice(tuples, BatchSize))
+        if not batch:
+            break
+        pool.run(lambda conn: send(conn, batch))
+        rows += len(batch)
+    return rows
+
+# stream the CSV file itself through COPY: nothing is parsed or held in
+# python, and empty fields arrive as typed NULLs. one statement, so a
+# retry after a lost connection starts over without duplicating rows
+def loadCopy(pool, fname):
+    with open(fname, mode="r", newline="") as fil:
+        header = next(csv.reader(fil))
+    unknown = [h for h in header if h not in Columns]
+    if unknown:
+        raise ValueError(f"{fname}: unexpected columns {unknown}")
+    columns = ", ".join(Columns[h] for h in header)
+
+    def copy(conn):
+        with open(fname, mode="r", newline="") as fil, conn.cursor() as cursor, pool.timed("copy"):
+            cursor.copy_expert(
+                f"COPY {TableName} ({columns}) FROM STDIN WITH (FORMAT csv, HEADER true)",
+                fil, size=1 << 20)
+            return cursor.rowcount
+
+    rows = pool.run(copy)
+    if rows < 0:    # older psycopg2 doesn't report COPY's row count
+        with open(fname, mode="r", newline="") as fil:
+            rows = sum(1 for _ in csv.reader(fil)) - 1
+    return rows
 
-        for cmd in icmdlist:
-            cursor.execute(cmd)
+def loadFile(pool, fname, method):
+    print(f"loadFile: loading {fname} with method {method}")
+    start = time.perf_counter()
+    if method == "insert":
+        rlis = readdata(fname)
+        rows = load(pool, getSQLcmnds(rlis))
+    elif method == "copy":
+        rows = loadCopy(pool, fname)
+    else:
+        rows = loadBatches(pool, fname, method)
+    elapsed = time.perf_counter() - start
 
-        elapsed = time.perf_counter() - start
-        print(f'Finished Loading. Elapsed Time: {elapsed:0.4} seconds')
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = peak / (1 << 20) if sys.platform == "darwin" else peak / 1024
+    print(f"{method}: {rows} rows in {elapsed:0.4} seconds, "
+          f"{rows / elapsed if elapsed else 0:,.0f} rows/sec, peak memory {peak_mb:0.1f} MB")
+    print(f"Pool stats: {pool.stats()}")
 
 def createConstraints(conn):
     with conn.cursor() as cursor:
@@ -174,16 +311,15 @@ def createConstraints(conn):
         print(f"Constraints and index created on {TableName}")
 def main():
     initialize()
-    conn = dbconnect()
-    rlis = readdata(Datafile)
-    cmdlist = getSQLcmnds(rlis)
+    pool = dbpool()
 
     if CreateDB:
-        createTable(conn)
+        pool.run(createTable)
 
-    load(conn, cmdlist)
+    loadFile(pool, Datafile, Method)
     if CreateDB:
-        createConstraints(conn) 
+        pool.run(createConstraints)
+    pool.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,297 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+# shared breadcrumb wire format lives with the pipeline code in Project/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Project"))
+import codec
+import transport
+
+# publisher -> subscriber benchmark. every message carries its publish time
+# (perf_counter_ns) as an attribute, and the subscriber records publish-to-ack
+# latency when it acks. publisher and subscriber run in this one process,
+# against an in-process fake broker, the local log transport or the Pub/Sub
+# emulator
+project_id = "somalias-data-eng"
+SAMPLE = {
+    "EVENT_NO_TRIP": 259172515, "EVENT_NO_STOP": 259172517, "OPD_DATE": "15FEB2023:00:00:00",
+    "VEHICLE_ID": 4223, "METERS": 80, "ACT_TIME": 22667, "GPS_LONGITUDE": -122.64112,
+    "GPS_LATITUDE": 45.501697, "GPS_SATELLITES": 12, "GPS_HDOP": 0.7,
+}
+
+
+def initialize():
+    parser = argparse.ArgumentParser(description="transport throughput/latency benchmark")
+    parser.add_argument("--backend", choices=("fake", "local", "emulator"), default="fake",
+                        help="emulator needs PUBSUB_EMULATOR_HOST set")
+    parser.add_argument("--messages", type=int, default=20_000, help="messages per run")
+    parser.add_argument("--sizes", default="1,10,100,500",
+                        help="records per message (payload size sweep)")
+    parser.add_argument("--batch", default="1,100,1000",
+                        help="publisher BatchSettings.max_messages sweep")
+    parser.add_argument("--latency", type=float, default=0.01,
+                        help="publisher BatchSettings.max_latency (seconds)")
+    parser.add_argument("--concurrency", default="1,4,16", help="subscriber callback threads sweep")
+    parser.add_argument("--wire", choices=codec.FORMATS, default=codec.FORMAT_BINARY)
+    parser.add_argument("--timeout", type=float, default=120, help="max seconds per run")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    return parser.parse_args()
+
+
+class FakeMessage:
+
+    def __init__(self, broker, data, attributes):
+        self.data = data
+        self.attributes = attributes
+        self.message_id = str(next(broker.ids))
+        self.broker = broker
+
+    def ack(self):
+        self.broker.acked(self)
+
+    def nack(self):
+        self.broker.queue.put(self)
+
+
+class FakeBroker:
+    # minimal in-process stand-in for Pub/Sub: a batching publisher (flushes at
+    # max_messages or max_latency, like BatchSettings) in front of one queue,
+    # drained by a pool of subscriber callback threads
+
+    def __init__(self, max_messages, max_latency):
+        self.max_messages = max_messages
+        self.max_latency = max_latency
+        self.queue = queue.Queue()
+        self.ids = itertools.count(1)
+        self.batch = []
+        self.lock = threading.Lock()
+        self.timer = None
+        self.on_ack = None
+
+    def publish(self, topic, data, **attrs):
+        future = Future()
+        with self.lock:
+            self.batch.append((FakeMessage(self, data, attrs), future))
+            if len(self.batch) >= self.max_messages:
+                self._flush()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.max_latency, self.flush)
+                self.timer.start()
+        return future
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        for message, future in self.batch:
+            self.queue.put(message)
+            future.set_result(message.message_id)
+        self.batch = []
+
+    def subscribe(self, callback, concurrency):
+        stop = threading.Event()
+
+        def worker():
+            while not stop.is_set():
+                try:
+                    message = self.queue.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+                callback(message)
+
+        threads = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+        for t in threads:
+            t.start()
+        return stop
+
+    def acked(self, message):
+        if self.on_ack:
+            self.on_ack(message)
+
+
+def make_payload(records, fmt):
+    payloads = [codec.encode_record(dict(SAMPLE, ACT_TIME=SAMPLE["ACT_TIME"] + i), fmt)
+                for i in range(records)]
+    data = codec.pack_envelope(payloads, fmt)
+    return data, codec.message_attributes(fmt, records, SAMPLE["VEHICLE_ID"])
+
+
+class Stats:
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.latencies = []
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.first = None
+        self.last = None
+
+    def callback(self, message):
+        # what a receiver does at minimum: decode, then ack
+        codec.decode_message(message.data, message.attributes)
+        message.ack()
+        now = time.perf_counter_ns()
+        with self.lock:
+            self.latencies.append(now - int(message.attributes["t0"]))
+            self.last = now
+            if len(self.latencies) >= self.expected:
+                self.done.set()
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    idx = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[idx]
+
+
+def run_fake(args, data, attrs, batch, concurrency, stats):
+    broker = FakeBroker(batch, args.latency)
+    stop = broker.subscribe(stats.callback, concurrency)
+    try:
+        publish_all(args.messages, data, attrs, lambda d, **a: broker.publish("bench", d, **a))
+        broker.flush()
+        stats.done.wait(args.timeout)
+    finally:
+        stop.set()
+
+
+def run_local(args, data, attrs, batch, concurrency, stats):
+    # fresh log directory per run so runs don't replay each other's messages
+    directory = os.path.join(transport.LOCAL_DIR, f"bench-{os.getpid()}-{time.time_ns()}")
+    local = transport.open_transport("local", topic_path="bench", subscription_path="bench",
+                                     directory=directory, max_latency=args.latency)
+    # BatchSettings.max_messages has no local equivalent; batches are by bytes
+    local.max_batch_bytes = max(batch * len(data), 1)
+    sub = local.subscribe(stats.callback, max_workers=concurrency)
+    try:
+        publish_all(args.messages, data, attrs, local.publish)
+        local.flush()
+        stats.done.wait(args.timeout)
+    finally:
+        sub.cancel()
+        local.close()
+        for name in os.listdir(directory):
+            os.unlink(os.path.join(directory, name))
+        os.rmdir(directory)
+
+
+def run_emulator(args, data, attrs, batch, concurrency, stats):
+    from google.cloud import pubsub_v1
+
+    if not os.environ.get("PUBSUB_EMULATOR_HOST"):
+        sys.exit("set PUBSUB_EMULATOR_HOST (gcloud beta emulators pubsub start) for --backend emulator")
+    suffix = f"bench-{os.getpid()}-{time.time_ns()}"
+    publisher = pubsub_v1.PublisherClient(batch_settings=pubsub_v1.types.BatchSettings(
+        max_messages=batch, max_latency=args.latency))
+    subscriber = pubsub_v1.SubscriberClient()
+    topic_path = publisher.topic_path(project_id, suffix)
+    sub_path = subscriber.subscription_path(project_id, suffix)
+    publisher.create_topic(request={"name": topic_path})
+    subscriber.create_subscription(request={"name": sub_path, "topic": topic_path})
+    scheduler = pubsub_v1.subscriber.scheduler.ThreadScheduler(
+        ThreadPoolExecutor(max_workers=concurrency))
+    future = subscriber.subscribe(sub_path, callback=stats.callback, scheduler=scheduler)
+    try:
+        publish_all(args.messages, data, attrs,
+                    lambda d, **a: publisher.publish(topic_path, d, **a))
+        stats.done.wait(args.timeout)
+    finally:
+        future.cancel()
+        subscriber.delete_subscription(request={"subscription": sub_path})
+        publisher.delete_topic(request={"topic": topic_path})
+
+
+def publish_all(n, data, attrs, publish):
+    for _ in range(n):
+        publish(data, t0=str(time.perf_counter_ns()), **attrs)
+
+
+def run_one(args, records, batch, concurrency):
+    data, attrs = make_payload(records, args.wire)
+    stats = Stats(args.messages)
+    start = time.perf_counter_ns()
+    runner = {"fake": run_fake, "local": run_local, "emulator": run_emulator}[args.backend]
+    runner(args, data, attrs, batch, concurrency, stats)
+    lat = sorted(stats.latencies)
+    received = len(lat)
+    elapsed = ((stats.last or time.perf_counter_ns()) - start) / 1e9
+    ms = lambda ns: round(ns / 1e6, 3) if ns is not None else None
+    return {
+        "records_per_message": records,
+        "payload_bytes": len(data),
+        "batch_max_messages": batch,
+        "batch_max_latency": args.latency,
+        "concurrency": concurrency,
+        "messages": args.messages,
+        "received": received,
+        "elapsed_s": round(elapsed, 4),
+        "msgs_per_sec": round(received / elapsed, 1) if elapsed else None,
+        "bytes_per_sec": round(received * len(data) / elapsed, 1) if elapsed else None,
+        "records_per_sec": round(received * records / elapsed, 1) if elapsed else None,
+        "latency_ms": {"p50": ms(percentile(lat, 50)), "p95": ms(percentile(lat, 95)),
+                       "p99": ms(percentile(lat, 99)), "max": ms(lat[-1] if lat else None)},
+    }
+
+
+def result_key(r):
+    return (r["records_per_message"], r["batch_max_messages"], r["concurrency"])
+
+
+def compare(results, baseline_file):
+    with open(baseline_file, "r", encoding="utf-8") as f:
+        base = {result_key(r): r for r in json.load(f)["results"]}
+    print("\nvs baseline (msgs/sec ratio, p99 ratio):")
+    for r in results:
+        b = base.get(result_key(r))
+        if not b or not b["msgs_per_sec"] or not b["latency_ms"]["p99"]:
+            continue
+        thr = r["msgs_per_sec"] / b["msgs_per_sec"]
+        p99 = (r["latency_ms"]["p99"] or 0) / b["latency_ms"]["p99"]
+        flag = "  REGRESSION" if thr < 0.9 or p99 > 1.1 else ""
+        print(f"  size={r['records_per_message']:>4} batch={r['batch_max_messages']:>5} "
+              f"conc={r['concurrency']:>3}  thr x{thr:.2f}  p99 x{p99:.2f}{flag}")
+
+
+def main():
+    args = initialize()
+    ints = lambda s: [int(x) for x in s.split(",") if x]
+    results = []
+    for records, batch, concurrency in itertools.product(
+            ints(args.sizes), ints(args.batch), ints(args.concurrency)):
+        r = run_one(args, records, batch, concurrency)
+        results.append(r)
+        print(f"size={records:>4} ({r['payload_bytes']:>6} B) batch={batch:>5} conc={concurrency:>3}  "
+              f"{r['msgs_per_sec']:>10} msg/s {r['records_per_sec']:>11} rec/s  "
+              f"p50={r['latency_ms']['p50']}ms p95={r['latency_ms']['p95']}ms "
+              f"p99={r['latency_ms']['p99']}ms  ({r['received']}/{r['messages']})")
+
+    out = {
+        "backend": args.backend,
+        "wire": args.wire,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(out, f, indent=1)
+    print(f"\nwrote {len(results)} results to {args.output}")
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,50 +1,146 @@
+import argparse
 import json
-from google.cloud import pubsub_v1
+import mmap
+import multiprocessing
+import os
+import re
+import sys
 import time
-start_time = time.time()
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait
+
+# shared breadcrumb wire format lives with the pipeline code in Project/
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Project"))
+import batch_publisher
+import codec
+import transport
 
 project_id = "somalias-data-eng"
 topic_id = "my-topic"
 filename = "bcsample.json"
 
-publisher = pubsub_v1.PublisherClient()
-topic_path = publisher.topic_path(project_id, topic_id)
-
-count = 0
-with open(filename, "r") as f:
-    while True:
-        line = f.readline()
-        if not line:
-            break 
-
-        line = line.strip()
-        if line.startswith("--- Vehicle ID:"):
-            vehicle_id = line.split(":")[1].strip().strip(" -")
-            
-            json_lines = []
-            # Start reading the array
-            while True:
-                json_line = f.readline()
-                if not json_line or json_line.strip().startswith("--- Vehicle ID:"):
-                    break
-                json_lines.append(json_line)
-
-            if json_line.strip().startswith("--- Vehicle ID:"):
-                f.seek(f.tell() - len(json_line))
-            # Parse the JSON array
+BANNER = re.compile(rb"^--- Vehicle ID: *(\d+) *---[^\n]*\n?", re.M)
+
+
+def initialize():
+    parser = argparse.ArgumentParser(description="replay an archived breadcrumb dump")
+    parser.add_argument("filename", nargs="?", default=filename)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2,
+                        help="processes parsing vehicle sections")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="target records/sec for load testing (0 = as fast as possible)")
+    parser.add_argument("--transport", choices=transport.BACKENDS, default=transport.BACKEND)
+    parser.add_argument("--wire", choices=codec.FORMATS, default=codec.FORMAT_BINARY)
+    parser.add_argument("--batch-records", type=int, default=batch_publisher.MAX_RECORDS)
+    parser.add_argument("--batch-bytes", type=int, default=batch_publisher.MAX_BYTES)
+    return parser.parse_args()
+
+
+class RateLimiter:
+    # token bucket in records/sec; only sleeps once we're ahead of the target
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+
+    def acquire(self, n=1):
+        if self.rate <= 0:
+            return
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= n
+        if self.tokens < 0:
+            time.sleep(-self.tokens / self.rate)
+
+
+def split_sections(path):
+    # one scan over the mapped file: (vehicle_id, start, end) per banner section
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        banners = [(int(m.group(1)), m.start(), m.end()) for m in BANNER.finditer(mm)]
+    for i, (vehicle_id, _, body_start) in enumerate(banners):
+        end = banners[i + 1][1] if i + 1 < len(banners) else None
+        yield vehicle_id, body_start, end
+
+
+def parse_section(task):
+    # runs in a worker: decode one vehicle's section and encode it for the
+    # wire, returning [(trip, payload, is_json)]. a section is either a raw
+    # JSON array (old.py dumps) or one JSON record per line (sent_ archives)
+    path, vehicle_id, start, end, fmt = task
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        body = mm[start:end if end is not None else len(mm)]
+    try:
+        records = json.loads(body)
+        if not isinstance(records, list):
+            records = [records]
+    except ValueError:
+        records = []
+        for line in body.splitlines():
             try:
-                records = json.loads("".join(json_lines))
-            except json.JSONDecodeError as e:
-                continue
-
-            for record in records:
-                data = json.dumps(record).encode("utf-8")
-                future = publisher.publish(
-                    topic_path,
-                    data,
-                    vehicle_id=vehicle_id  # metadata as Pub/Sub attribute
-                )
-                count += 1
-
-print(f"\nTotal records published: \033[33m{count}\033[0m")
-print(f"\nProducer took {time.time() - start_time:.2f} seconds")
\ No newline at end of file
+                records.append(json.loads(line))
+            except ValueError:
+                continue    # blank line or "Error fetching data: ..."
+    out = []
+    for rec in records:
+        try:
+            out.append((rec.get("EVENT_NO_TRIP"), codec.encode_record(rec, fmt), False))
+        except codec.EncodeError:
+            out.append((rec.get("EVENT_NO_TRIP"), codec.encode_record(rec), True))
+    return vehicle_id, out
+
+
+def main():
+    args = initialize()
+    start_time = time.time()
+
+    topic_path = f"projects/{project_id}/topics/{topic_id}"
+    publisher = transport.open_transport(args.transport, topic_path=topic_path)
+    futures = []
+    envelopes = batch_publisher.EnvelopePublisher(
+        publisher,
+        max_records=args.batch_records,
+        max_bytes=args.batch_bytes,
+        on_publish=lambda vid, fu: futures.append(fu),
+        fmt=args.wire,
+    )
+    limiter = RateLimiter(args.rate)
+
+    count = 0
+    tasks = ((args.filename, vid, s, e, args.wire) for vid, s, e in split_sections(args.filename))
+    # spawn, not fork: the pool adds workers as sections are submitted, by
+    # which time the transport's gRPC threads are running, and gRPC is not
+    # fork-safe
+    spawn = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=args.workers, mp_context=spawn) as pool:
+        # keep a bounded window of sections in flight, consumed in file order
+        pending = deque()
+        for task in tasks:
+            pending.append(pool.submit(parse_section, task))
+            if len(pending) >= args.workers * 4:
+                count += publish_section(envelopes, limiter, *pending.popleft().result())
+        while pending:
+            count += publish_section(envelopes, limiter, *pending.popleft().result())
+    envelopes.flush_all()
+    publisher.flush()
+    wait(futures)
+    publisher.close()
+
+    print(f"\nTotal records published: \033[33m{count}\033[0m in {envelopes.messages} envelopes")
+    print(f"\nProducer took {time.time() - start_time:.2f} seconds")
+
+
+def publish_section(envelopes, limiter, vehicle_id, encoded):
+    for trip, payload, is_json in encoded:
+        limiter.acquire()
+        if is_json:
+            envelopes.publish_single(vehicle_id, payload,
+                                     codec.message_attributes(vehicle_id=vehicle_id))
+        else:
+            envelopes.add(vehicle_id, trip, payload)
+    return len(encoded)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import date, datetime
+from functools import lru_cache
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+import codec
+
+# columnar breadcrumb archive: zstd parquet files laid out as
+#   <root>/service_date=YYYY-MM-DD/vehicle=NNNN/part-<run>-<seq>.parquet
+# so readers can prune by day/vehicle and only load the columns they need
+ARCHIVE_ROOT = "archive"
+ROWS_PER_FILE = 50_000      # flush a partition once it buffers this many rows
+ROW_GROUP_SIZE = 10_000
+MAX_AGE = 300               # seconds before a partition's buffer is flushed anyway
+                            # (checked by a background thread; 0 = only on close)
+COMPRESSION = "zstd"
+
+ARROW_TYPES = {"q": pa.int64(), "i": pa.int32(), "h": pa.int16(), "d": pa.float64()}
+SCHEMA = pa.schema([
+    (name, pa.date32() if kind == "date" else ARROW_TYPES[code])
+    for name, code, kind in codec.FIELDS
+])
+CASTS = {"int": int, "float": float}
+
+
+@lru_cache(maxsize=4096)
+def parse_opd(opd: str) -> date:
+    # "31DEC2022:00:00:00" -> date(2022, 12, 31)
+    return datetime.strptime(opd.split(":", 1)[0].title(), "%d%b%Y").date()
+
+
+class ParquetArchive:
+
+    def __init__(self, root=ARCHIVE_ROOT, rows_per_file=ROWS_PER_FILE,
+                 row_group_size=ROW_GROUP_SIZE, max_age=MAX_AGE):
+        self.root = root
+        self.rows_per_file = rows_per_file
+        self.row_group_size = row_group_size
+        self.max_age = max_age
+        self.run_id = datetime.now().strftime("%Y%m%dT%H%M%S") + "-" + uuid.uuid4().hex[:6]
+        self.seq = 0
+        self.buffers = {}   # (service_date, vehicle) -> (first add time, {column: [values]})
+        self.lock = threading.Lock()   # receivers add from several callback threads
+        self.rows = 0
+        self.errors = 0
+        self.stopped = threading.Event()
+        self.ticker = None
+        if max_age:
+            self.ticker = threading.Thread(target=self._age_loop, daemon=True)
+            self.ticker.start()
+
+    def add(self, vehicle_id, rec: dict):
+        try:
+            row = self._convert(rec)
+        except (KeyError, TypeError, ValueError) as e:
+            self.write_error(vehicle_id, f"Unarchivable record ({e}): {json.dumps(rec)}")
+            return
+        service_date = row["OPD_DATE"].isoformat() if row["OPD_DATE"] else "unknown"
+        key = (service_date, row["VEHICLE_ID"] if row["VEHICLE_ID"] is not None else vehicle_id)
+        with self.lock:
+            started, columns = self.buffers.setdefault(
+                key, (time.monotonic(), {name: [] for name in SCHEMA.names}))
+            for name in SCHEMA.names:
+                columns[name].append(row[name])
+            self.rows += 1
+            if len(columns["OPD_DATE"]) >= self.rows_per_file:
+                self._flush(key)
+
+    def write_records(self, vehicle_id, records):
+        for rec in records:
+            self.add(vehicle_id, rec)
+
+    def write_error(self, vehicle_id, message):
+        # fetch errors and records that don't fit the schema, one JSON line each
+        os.makedirs(self.root, exist_ok=True)
+        with self.lock, open(os.path.join(self.root, "_errors.jsonl"), "a", encoding="utf-8") as f:
+            f.write(json.dumps({"time": datetime.now().isoformat(timespec="seconds"),
+                                "vehicle_id": vehicle_id, "error": str(message)}) + "\n")
+            self.errors += 1
+
+    def flush(self):
+        with self.lock:
+            for key in list(self.buffers):
+                self._flush(key)
+
+    def close(self):
+        self.stopped.set()
+        if self.ticker is not None:
+            self.ticker.join()
+        self.flush()
+
+    def _age_loop(self):
+        # a partition that stops getting rows (a vehicle done for the day)
+        # is written once it's MAX_AGE old, not held in memory until close()
+        while not self.stopped.wait(max(self.max_age / 4, 0.05)):
+            try:
+                with self.lock:
+                    self._flush_aged()
+            except Exception as e:
+                self.write_error(None, f"Archive flush failed: {e}")
+
+    def _convert(self, rec):
+        row = {}
+        for name, _, kind in codec.FIELDS:
+            v = rec.get(name)
+            if v is None:
+                row[name] = None
+            elif kind == "date":
+                row[name] = parse_opd(v)
+            else:
+                row[name] = CASTS[kind](v)
+        return row
+
+    def _flush_aged(self):
+        now = time.monotonic()
+        for key, (started, _) in list(self.buffers.items()):
+            if now - started > self.max_age:
+                self._flush(key)
+
+    def _flush(self, key):
+        _, columns = self.buffers.pop(key)
+        service_date, vehicle = key
+        path = os.path.join(self.root, f"service_date={service_date}", f"vehicle={vehicle}")
+        os.makedirs(path, exist_ok=True)
+        self.seq += 1
+        table = pa.Table.from_pydict(columns, schema=SCHEMA)
+        name = f"part-{self.run_id}-{self.seq:05d}.parquet"
+        # write under a hidden temp name so readers never see a half-written file
+        tmp = os.path.join(path, "." + name)
+        pq.write_table(table, tmp, compression=COMPRESSION, row_group_size=self.row_group_size)
+        os.replace(tmp, os.path.join(path, name))
+
+
+def read_archive(root=ARCHIVE_ROOT, columns=None, dates=None, vehicles=None):
+    # load part of the archive as a DataFrame, e.g.
+    #   read_archive(columns=["EVENT_NO_TRIP", "ACT_TIME", "METERS"], dates=["2023-02-15"])
+    # only the matching partition directories and column chunks are read
+    partitioning = ds.partitioning(
+        pa.schema([("service_date", pa.string()), ("vehicle", pa.string())]), flavor="hive")
+    dataset = ds.dataset(root, format="parquet", partitioning=partitioning)
+    filt = None
+    if dates is not None:
+        filt = ds.field("service_date").isin([str(d) for d in dates])
+    if vehicles is not None:
+        vf = ds.field("vehicle").isin([str(v) for v in vehicles])
+        filt = vf if filt is None else filt & vf
+    return dataset.to_table(columns=columns, filter=filt).to_pandas()
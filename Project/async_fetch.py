@@ -0,0 +1,173 @@
+import asyncio
+import json
+import time
+from urllib.parse import urlsplit
+
+import httpx
+
+BASE_URL = "https://busdata.cs.pdx.edu/api/getBreadCrumbs?vehicle_id="
+
+# defaults, overridable per run
+MAX_IN_FLIGHT = 32      # concurrent requests (and keep-alive connections)
+RATE_PER_HOST = 20.0    # requests/sec allowed against any one host
+TIMEOUT = 10            # seconds, same as the old requests.get timeout
+
+
+class HostRateLimiter:
+    # token bucket per host so we don't hammer busdata with 200 requests at once
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.buckets = {}   # host -> [tokens, last refill time]
+        self.lock = asyncio.Lock()
+
+    async def acquire(self, host):
+        if not self.rate or self.rate <= 0:
+            return
+        while True:
+            async with self.lock:
+                now = time.monotonic()
+                tokens, last = self.buckets.get(host, (self.burst, now))
+                tokens = min(self.burst, tokens + (now - last) * self.rate)
+                if tokens >= 1.0:
+                    self.buckets[host] = (tokens - 1.0, now)
+                    return
+                self.buckets[host] = (tokens, now)
+                wait = (1.0 - tokens) / self.rate
+            await asyncio.sleep(wait)
+
+
+class JsonArrayStream:
+    # incremental decoder for a top-level JSON array: feed() text chunks as they
+    # arrive and get back the elements completed so far, so the full list (and
+    # the full response text) never has to sit in memory
+
+    def __init__(self):
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.state = "start"   # start -> array -> done, or single (not an array)
+
+    def feed(self, text):
+        self.buf += text
+        return self._drain(final=False)
+
+    def close(self):
+        if self.state == "single":
+            return [json.loads(self.buf)]
+        out = self._drain(final=True)
+        if self.state != "done" or self.buf.strip():
+            raise ValueError("truncated or malformed JSON array")
+        return out
+
+    def _drain(self, final):
+        if self.state == "single":
+            return []
+        out = []
+        pos = 0
+        n = len(self.buf)
+        while True:
+            while pos < n and self.buf[pos] in " \t\r\n":
+                pos += 1
+            if pos >= n or self.state == "done":
+                break
+            c = self.buf[pos]
+            if self.state == "start":
+                if c != "[":
+                    # a bare object, decode it whole in close()
+                    self.state = "single"
+                    return out
+                self.state = "array"
+                pos += 1
+            elif c == "]":
+                self.state = "done"
+                pos += 1
+            elif c == ",":
+                pos += 1
+            else:
+                try:
+                    obj, end = self.decoder.raw_decode(self.buf, pos)
+                except json.JSONDecodeError:
+                    break   # element split across chunks, wait for more
+                if (not final and not isinstance(obj, (dict, list, str))
+                        and (end == n or self.buf[end] not in ",] \t\r\n")):
+                    break   # a number at the chunk edge ("4." of "4.5") may continue
+                out.append(obj)
+                pos = end
+        self.buf = self.buf[pos:]
+        return out
+
+
+async def stream_vehicle(client, sem, limiter, vehicle_id, on_records, on_error,
+                         base_url=BASE_URL):
+    # like fetch_vehicle, but hands records over chunk by chunk. a stream cut
+    # short still reports on_error after the records that did arrive; errors
+    # raised by on_records itself propagate, as in fetch_vehicle
+    url = f"{base_url}{vehicle_id}"
+    async with sem:
+        await limiter.acquire(urlsplit(url).netloc)
+        decoder = JsonArrayStream()
+        try:
+            async with client.stream("GET", url) as response:
+                response.raise_for_status()
+                async for chunk in response.aiter_text():
+                    try:
+                        records = decoder.feed(chunk)
+                    except ValueError as e:
+                        on_error(vehicle_id, e)
+                        return
+                    if records:
+                        on_records(vehicle_id, records)
+        except httpx.HTTPError as e:
+            on_error(vehicle_id, e)
+            return
+    try:
+        records = decoder.close()
+    except ValueError as e:     # truncated or malformed
+        on_error(vehicle_id, e)
+        return
+    if records:
+        on_records(vehicle_id, records)
+
+
+async def fetch_vehicle(client, sem, limiter, vehicle_id, on_records, on_error,
+                        base_url=BASE_URL):
+    url = f"{base_url}{vehicle_id}"
+    async with sem:
+        await limiter.acquire(urlsplit(url).netloc)
+        try:
+            response = await client.get(url)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            on_error(vehicle_id, e)
+            return
+    # parse outside the semaphore so a big payload doesn't hold a request slot
+    try:
+        breadcrumbs = response.json()
+    except ValueError as e:
+        on_error(vehicle_id, e)
+        return
+    on_records(vehicle_id, breadcrumbs)
+
+
+async def fetch_all(vehicle_ids, on_records, on_error,
+                    max_in_flight=MAX_IN_FLIGHT, rate_per_host=RATE_PER_HOST,
+                    timeout=TIMEOUT, base_url=BASE_URL, stream=False):
+    # on_records(vehicle_id, data) is called on the event loop as soon as each
+    # vehicle's response is parsed; on_error(vehicle_id, exc) for fetch/parse errors.
+    # with stream=True it is called repeatedly with lists of decoded elements
+    limits = httpx.Limits(max_connections=max_in_flight,
+                          max_keepalive_connections=max_in_flight)
+    sem = asyncio.Semaphore(max_in_flight)
+    limiter = HostRateLimiter(rate_per_host)
+    fetch_one = stream_vehicle if stream else fetch_vehicle
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        tasks = [
+            fetch_one(client, sem, limiter, vid, on_records, on_error, base_url)
+            for vid in vehicle_ids
+        ]
+        await asyncio.gather(*tasks)
+
+
+def run(vehicle_ids, on_records, on_error, **kwargs):
+    return asyncio.run(fetch_all(vehicle_ids, on_records, on_error, **kwargs))
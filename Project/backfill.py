@@ -0,0 +1,301 @@
+import argparse
+import glob
+import itertools
+import json
+import logging
+import os
+import re
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import date, timedelta
+
+import psycopg2
+import pyarrow.parquet as pq
+
+import archive
+import codec
+import db_pool
+import db_sink
+import dedup
+import part2_receiver as receiver
+import reorder
+import rejects as rejections
+import schema
+import trip_state
+import wal
+
+# loads archived breadcrumbs straight into Trip/BreadCrumb, without going
+# through Pub/Sub. sources are parquet archives (the receiver's received/, or
+# fetch's sent/: one unit per service_date=/vehicle= partition, so a unit
+# holds whole trips) and daily JSON files (legacy YYYY-MM-DD.json /
+# sent_YYYY-MM-DD.json: one unit per file). units are split across the worker
+# processes by size; each worker streams its units CHUNK records at a time
+# through the receiver's own pipeline (dedup, per-trip reorder, batch
+# validation and speed, BreadCrumbSink merging with ON CONFLICT DO NOTHING),
+# so re-running a range never adds rows twice and a worker holds at most
+# about FLUSH_ROWS records.
+# the receiver writes every record to both received/ and its write-ahead log
+# received/_wal, so only the parquet archive is loaded; once it's done, one
+# worker loads the WAL records whose service day and vehicle have no parquet
+# partition (buffers lost in a crash). a partition cut short by a crash isn't
+# detected: load that day's WAL file explicitly. any failed batch makes the
+# run exit non-zero; re-running it is safe
+Sources    = ["received"]
+GAPS       = os.path.join("received", "_wal")
+Gaps       = GAPS
+FromDate   = None
+ToDate     = None
+Workers    = os.cpu_count() or 2
+FLUSH_ROWS = 50_000     # rows per COPY/merge transaction, and records held for reordering
+FlushRows  = FLUSH_ROWS
+CHUNK      = 5_000      # records read and handed to the pipeline at a time
+DEAD_LETTER_FILE = "backfill_rejected.jsonl"
+
+FILE_RE = re.compile(r"^(?:sent_)?(\d{4}-\d{2}-\d{2})\.json$")
+PARTITION_RE = re.compile(r"service_date=(\d{4}-\d{2}-\d{2})$")
+
+logger = logging.getLogger("backfill")
+
+
+def initialize():
+    parser = argparse.ArgumentParser(description="load archived breadcrumbs into Postgres")
+    parser.add_argument("sources", nargs="*",
+                        help="parquet archive roots, directories of daily .json files, or "
+                             "single files (default: received)")
+    parser.add_argument("--gaps",
+                        help="directory of daily .json files (the receiver's write-ahead log) "
+                             "to fill in partitions missing from the parquet archive; '' for "
+                             f"none (default: {GAPS}, or none when sources are given)")
+    parser.add_argument("--from", dest="from_date", help="first day to load, YYYY-MM-DD")
+    parser.add_argument("--to", dest="to_date", help="last day to load, YYYY-MM-DD")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--flush-rows", type=int, default=FLUSH_ROWS)
+    args = parser.parse_args()
+
+    global Sources, Gaps, FromDate, ToDate, Workers, FlushRows
+    Sources = args.sources or Sources
+    Gaps = args.gaps if args.gaps is not None else ("" if args.sources else GAPS)
+    FromDate = args.from_date
+    ToDate = args.to_date
+    Workers = max(1, args.workers)
+    FlushRows = args.flush_rows
+
+
+def in_range(day):
+    return not ((FromDate and day < FromDate) or (ToDate and day > ToDate))
+
+
+def find_units(sources):
+    # -> [(kind, paths, bytes, day)]: "parquet" with every part file of one
+    # partition and its service day, or "json" with one daily file and the
+    # day in its name (None for files named otherwise)
+    units = []
+    for source in sources:
+        if os.path.isfile(source):
+            m = FILE_RE.match(os.path.basename(source))
+            units.append(("parquet" if source.endswith(".parquet") else "json", [source],
+                          os.path.getsize(source), m and m.group(1)))
+            continue
+        for day_dir in sorted(glob.glob(os.path.join(source, "service_date=*"))):
+            m = PARTITION_RE.search(day_dir)
+            if not m or not in_range(m.group(1)):
+                continue
+            for part_dir in sorted(glob.glob(os.path.join(day_dir, "vehicle=*"))):
+                paths = sorted(glob.glob(os.path.join(part_dir, "part-*.parquet")))
+                if paths:
+                    units.append(("parquet", paths, sum(os.path.getsize(p) for p in paths),
+                                  m.group(1)))
+        for path in sorted(glob.glob(os.path.join(source, "*.json"))):
+            m = FILE_RE.match(os.path.basename(path))
+            if m and in_range(m.group(1)):
+                units.append(("json", [path], os.path.getsize(path), m.group(1)))
+    return units
+
+
+def covered(units):
+    # {(service day, vehicle)} the parquet units hold, as the archive names them
+    return {(day, os.path.basename(os.path.dirname(paths[0]))[len("vehicle="):])
+            for kind, paths, _, day in units if kind == "parquet" and day is not None}
+
+
+def partition_days(units):
+    # a daily JSON file is named for the day it was received, which holds
+    # the previous service day's records
+    days = set()
+    for kind, _, _, day in units:
+        if day is not None:
+            day = date.fromisoformat(day)
+            days.add(day)
+            if kind == "json":
+                days.add(day - timedelta(days=1))
+    return days
+
+
+def assign(units, workers):
+    # biggest unit first, each to the least loaded worker
+    shares = [[] for _ in range(workers)]
+    loads = [0] * workers
+    for unit in sorted(units, key=lambda u: -u[2]):
+        i = loads.index(min(loads))
+        shares[i].append(unit)
+        loads[i] += unit[2]
+    return shares
+
+
+def read_parquet(paths, stats):
+    # records as the receiver decodes them: OPD_DATE back to "31DEC2022:00:00:00"
+    for path in paths:
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=CHUNK):
+            for rec in batch.to_pylist():
+                opd = rec.get("OPD_DATE")
+                if isinstance(opd, date):
+                    rec["OPD_DATE"] = codec.days_to_opd((opd - codec.EPOCH).days)
+                stats["records"] += 1
+                yield rec
+
+
+def read_json(paths, stats):
+    # banner and "Error ..." lines in sent_ files are skipped; the message id
+    # the write-ahead log tags each line with is dropped
+    for path in paths:
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.startswith(b"{"):
+                    continue
+                stats["records"] += 1
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    stats["unparseable"] += 1
+                    continue
+                rec.pop(wal.MESSAGE_FIELD, None)
+                yield rec
+
+
+READERS = {"parquet": read_parquet, "json": read_json}
+
+
+def uncovered(records, skip, stats):
+    # drops records whose (service day, vehicle) partition was loaded from parquet
+    for rec in records:
+        try:
+            key = (archive.parse_opd(rec["OPD_DATE"]).isoformat(), str(int(rec["VEHICLE_ID"])))
+        except (AttributeError, KeyError, TypeError, ValueError):
+            key = None      # the archive couldn't place it either; validation decides
+        if key in skip:
+            stats["in_archive"] += 1
+            continue
+        yield rec
+
+
+class Tally:
+    # stands in for the Pub/Sub message behind each chunk: the receiver acks
+    # it once every record is committed or rejected, nacks it if a batch failed
+
+    def __init__(self):
+        self.failed = 0
+
+    def ack(self):
+        pass
+
+    def nack(self):
+        self.failed += 1
+
+
+def backfill_shard(units, shard, flush_rows, skip=None):
+    # reuse the receiver's pipeline globals, pointed at this shard's state
+    receiver.logger = logging.getLogger(f"backfill.shard{shard}")
+    receiver.previous_records = trip_state.TripStateStore(None)
+    receiver.rejects = rejections.Rejects(receiver.shard_file(DEAD_LETTER_FILE, shard),
+                                          receiver.logger)
+    connect = lambda: psycopg2.connect(**receiver.DB_CONFIG)
+    pool = db_pool.ConnectionPool(connect, 2)    # writer + duplicate lookups
+    receiver.sink = db_sink.BreadCrumbSink(pool, flush_rows=flush_rows, linger=3600,
+                                           partitions=schema.Partitions(connect).load(),
+                                           summaries=receiver.SUMMARIES,
+                                           on_commit=receiver.committed, on_fail=receiver.failed)
+    receiver.sink.warm()
+    receiver.retrying = db_sink.KnownTrips(receiver.RETRY_KEYS, receiver.RETRY_TTL)
+    receiver.deduper = dedup.Deduplicator(receiver.stored_duplicates)
+    # held by event time only: a trip is released when its unit ends, or
+    # when over flush_rows records are held (longest-waiting trip first)
+    receiver.reorderer = reorder.ReorderBuffer(receiver.process_items, receiver.reject_late,
+                                               lateness=86400, max_hold=86400,
+                                               max_records=flush_rows)
+    stats = {"records": 0, "unparseable": 0, "in_archive": 0}
+    tally = Tally()
+    for kind, paths, _, _ in units:
+        records = READERS[kind](paths, stats)
+        if skip is not None:
+            records = uncovered(records, skip, stats)
+        while True:
+            chunk = list(itertools.islice(records, CHUNK))
+            if not chunk:
+                break
+            receiver.process_records(chunk, tally)
+        receiver.reorderer.flush()
+    receiver.reorderer.close()
+    receiver.sink.close()
+    receiver.rejects.close()
+    return {
+        "shard": shard,
+        "units": len(units),
+        **stats,
+        "duplicates": receiver.deduper.duplicates,
+        "inserted": receiver.sink.rows_written,
+        "already_loaded": receiver.sink.rows_skipped + receiver.redelivered,
+        "rejected": sum(receiver.rejects.counts.values()),
+        "failed_chunks": tally.failed,
+        "reconnects": pool.reconnects,
+    }
+
+
+def load(pool, shares, skip, totals):
+    futures = [pool.submit(backfill_shard, share, shard, FlushRows, skip)
+               for shard, share in shares if share]
+    for fu in futures:
+        stats = fu.result()
+        logger.info("Shard %s", stats)
+        for k, v in stats.items():
+            if k != "shard":
+                totals[k] = totals.get(k, 0) + v
+
+
+def main():
+    initialize()
+    units = find_units(Sources)
+    gaps = find_units([Gaps]) if Gaps and os.path.isdir(Gaps) else []
+    gaps = [u for u in gaps if u[0] == "json"]
+    if not units and not gaps:
+        logger.error("Nothing to load from %s", Sources)
+        return
+    logger.info("Backfilling %d partitions/files with %d workers, then %d files of %s",
+                len(units), Workers, len(gaps), Gaps)
+    start = time.time()
+
+    # make sure redelivered/reloaded rows are recognised before loading, and
+    # create the historical days' partitions here rather than in racing workers
+    receiver.prepare_schema()
+    connect = lambda: psycopg2.connect(**receiver.DB_CONFIG)
+    conn = connect()
+    try:
+        schema.Partitions(connect).load().ensure(conn, partition_days(units + gaps))
+    finally:
+        conn.close()
+
+    totals = {}
+    with ProcessPoolExecutor(max_workers=Workers) as pool:
+        load(pool, enumerate(assign(units, Workers)), None, totals)
+        # one worker, so no trip is split between two of them
+        if gaps:
+            load(pool, [(Workers, gaps)], covered(units), totals)
+    logger.info("Backfill done in %.1fs: %s", time.time() - start, totals)
+    if totals.get("failed_chunks"):
+        logger.error("%d chunks had a batch that failed to load; run the backfill again",
+                     totals["failed_chunks"])
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
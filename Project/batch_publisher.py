@@ -0,0 +1,62 @@
+import codec
+
+# envelope limits: flush a vehicle's buffer at whichever comes first
+MAX_RECORDS = 500
+MAX_BYTES = 512_000     # well under Pub/Sub's 10MB message cap
+
+
+class EnvelopePublisher:
+    # packs encoded breadcrumbs of the same vehicle/trip into one message.
+    # each vehicle has one open buffer; a new trip flushes the old one first so
+    # envelopes on a vehicle's ordering key stay in trip order
+
+    def __init__(self, transport, max_records=MAX_RECORDS,
+                 max_bytes=MAX_BYTES, on_publish=None, fmt=codec.FORMAT_JSON):
+        self.transport = transport
+        self.fmt = fmt                  # codec format the payloads were encoded with
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.on_publish = on_publish    # on_publish(vehicle_id, future)
+        self.buffers = {}               # vehicle_id -> [trip, payloads, nbytes]
+        self.messages = 0
+        self.records = 0
+
+    def add(self, vehicle_id, trip, payload: bytes):
+        buf = self.buffers.get(vehicle_id)
+        if buf is not None and (buf[0] != trip or len(buf[1]) >= self.max_records
+                                or buf[2] + len(payload) > self.max_bytes):
+            self.flush(vehicle_id)
+            buf = None
+        if buf is None:
+            buf = self.buffers[vehicle_id] = [trip, [], 2]
+        buf[1].append(payload)
+        buf[2] += len(payload) + 1
+
+    def publish_single(self, vehicle_id, data: bytes, attrs: dict):
+        # a record that can't go in an envelope (e.g. JSON fallback); flush
+        # what's buffered first so it stays in order on the ordering key
+        self.flush(vehicle_id)
+        future = self.transport.publish(data, ordering_key=str(vehicle_id), **attrs)
+        if self.on_publish:
+            self.on_publish(vehicle_id, future)
+        return future
+
+    def flush(self, vehicle_id):
+        buf = self.buffers.pop(vehicle_id, None)
+        if not buf or not buf[1]:
+            return None
+        key = str(vehicle_id)
+        future = self.transport.publish(
+            codec.pack_envelope(buf[1], self.fmt),
+            ordering_key=key,
+            **codec.message_attributes(self.fmt, len(buf[1]), vehicle_id),
+        )
+        self.messages += 1
+        self.records += len(buf[1])
+        if self.on_publish:
+            self.on_publish(vehicle_id, future)
+        return future
+
+    def flush_all(self):
+        for vehicle_id in list(self.buffers):
+            self.flush(vehicle_id)
@@ -0,0 +1,51 @@
+import json
+import os
+from datetime import datetime
+
+# per-vehicle high-water marks: the (OPD_DATE, EVENT_NO_TRIP, ACT_TIME) of the
+# newest breadcrumb we've already published for that vehicle
+CHECKPOINT_FILE = "checkpoints.json"
+
+
+def record_mark(rec: dict) -> tuple:
+    # "31DEC2022:00:00:00" -> "2022-12-31" so marks compare in date order
+    date_part = rec["OPD_DATE"].split(":", 1)[0].title()
+    opd = datetime.strptime(date_part, "%d%b%Y").strftime("%Y-%m-%d")
+    return (opd, rec["EVENT_NO_TRIP"], rec["ACT_TIME"])
+
+
+class CheckpointStore:
+
+    def __init__(self, path=CHECKPOINT_FILE):
+        self.path = path
+        self.marks = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.marks = {k: tuple(v) for k, v in json.load(f).items()}
+
+    def get(self, vehicle_id):
+        return self.marks.get(str(vehicle_id))
+
+    def is_new(self, vehicle_id, rec: dict) -> bool:
+        mark = self.get(vehicle_id)
+        if mark is None:
+            return True
+        try:
+            return record_mark(rec) > mark
+        except (KeyError, TypeError, ValueError):
+            # can't place it, let the receiver's validation decide
+            return True
+
+    def update(self, vehicle_id, mark):
+        current = self.get(vehicle_id)
+        if current is None or mark > current:
+            self.marks[str(vehicle_id)] = tuple(mark)
+
+    def save(self):
+        # write to a temp file and rename so a crash never leaves half a file
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.marks, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
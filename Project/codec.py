@@ -0,0 +1,151 @@
+import json
+import struct
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+
+# wire format shared by the fetchers, publishers and receivers.
+# a message is either one breadcrumb (the original format) or an envelope
+# holding several breadcrumbs of the same vehicle/trip, flagged by attribute.
+# the payload is JSON text or the fixed-layout binary format below, selected
+# by the "encoding" attribute (missing = json, for older publishers)
+ENVELOPE_ATTR = "envelope"
+ENCODING_ATTR = "encoding"
+FORMAT_JSON = "json"
+FORMAT_BINARY = "binary"
+FORMATS = (FORMAT_JSON, FORMAT_BINARY)
+
+# binary layout, version 1: a header, then `count` fixed-size records.
+# each record starts with a null bitmap (bit i set = FIELDS[i] was None)
+MAGIC = b"BC"
+VERSION = 1
+HEADER = struct.Struct("<2sBI")     # magic, version, count
+FIELDS = (
+    # name            struct code  kind
+    ("EVENT_NO_TRIP",  "q", "int"),
+    ("EVENT_NO_STOP",  "q", "int"),
+    ("OPD_DATE",       "i", "date"),   # days since 1970-01-01
+    ("VEHICLE_ID",     "i", "int"),
+    ("METERS",         "i", "int"),
+    ("ACT_TIME",       "i", "int"),
+    ("GPS_LONGITUDE",  "d", "float"),
+    ("GPS_LATITUDE",   "d", "float"),
+    ("GPS_SATELLITES", "h", "int"),
+    ("GPS_HDOP",       "d", "float"),
+)
+FIELD_NAMES = tuple(name for name, _, _ in FIELDS)
+RECORD = struct.Struct("<H" + "".join(code for _, code, _ in FIELDS))
+EPOCH = date(1970, 1, 1)
+
+
+class EncodeError(ValueError):
+    # the record doesn't fit the binary layout; send it as JSON instead
+    pass
+
+
+@lru_cache(maxsize=4096)
+def opd_to_days(opd: str) -> int:
+    # "31DEC2022:00:00:00" -> days since epoch; only midnight dates fit
+    if not isinstance(opd, str):
+        raise EncodeError(f"OPD_DATE is not a string: {opd!r}")
+    dt = datetime.strptime(opd.title(), "%d%b%Y:%H:%M:%S")
+    if dt.hour or dt.minute or dt.second:
+        raise EncodeError(f"OPD_DATE has a time part: {opd}")
+    return (dt.date() - EPOCH).days
+
+
+@lru_cache(maxsize=4096)
+def days_to_opd(days: int) -> str:
+    return (EPOCH + timedelta(days=days)).strftime("%d%b%Y:00:00:00").upper()
+
+
+def encode_record(rec: dict, fmt=FORMAT_JSON) -> bytes:
+    if fmt == FORMAT_JSON:
+        return json.dumps(rec).encode("utf-8")
+    if len(rec.keys() - FIELD_NAMES):
+        raise EncodeError(f"unknown fields: {sorted(rec.keys() - FIELD_NAMES)}")
+    nulls = 0
+    values = []
+    for i, (name, _, kind) in enumerate(FIELDS):
+        v = rec.get(name)
+        if v is None:
+            nulls |= 1 << i
+            values.append(0)
+        elif kind == "float":
+            if not isinstance(v, (int, float)) or isinstance(v, bool):
+                raise EncodeError(f"{name} is not numeric: {v!r}")
+            values.append(float(v))
+        elif kind == "int":
+            if isinstance(v, float) and v.is_integer():
+                v = int(v)
+            if not isinstance(v, int) or isinstance(v, bool):
+                raise EncodeError(f"{name} is not an integer: {v!r}")
+            values.append(v)
+        else:
+            try:
+                values.append(opd_to_days(v))
+            except (TypeError, ValueError) as e:
+                raise EncodeError(f"bad OPD_DATE {v!r}: {e}")
+    try:
+        return RECORD.pack(nulls, *values)
+    except struct.error as e:
+        raise EncodeError(str(e))
+
+
+def pack_envelope(payloads, fmt=FORMAT_JSON) -> bytes:
+    # payloads are already-encoded records, so packing is just a join
+    if fmt == FORMAT_BINARY:
+        return HEADER.pack(MAGIC, VERSION, len(payloads)) + b"".join(payloads)
+    return b"[" + b",".join(payloads) + b"]"
+
+
+def message_attributes(fmt=FORMAT_JSON, count=None, vehicle_id=None) -> dict:
+    attrs = {ENCODING_ATTR: fmt}
+    if count is not None:
+        attrs[ENVELOPE_ATTR] = "1"
+        attrs["count"] = str(count)
+    if vehicle_id is not None:
+        attrs["vehicle_id"] = str(vehicle_id)
+    return attrs
+
+
+def encode_message(rec: dict, fmt=FORMAT_JSON, vehicle_id=None):
+    # one record as a standalone message -> (data, attributes); falls back to
+    # JSON for records the binary layout can't hold
+    if fmt == FORMAT_BINARY:
+        try:
+            data = pack_envelope([encode_record(rec, fmt)], fmt)
+            return data, message_attributes(fmt, 1, vehicle_id)
+        except EncodeError:
+            fmt = FORMAT_JSON
+    return encode_record(rec), message_attributes(fmt, vehicle_id=vehicle_id)
+
+
+def decode_binary(data: bytes) -> list:
+    magic, version, count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError(f"unsupported binary breadcrumb format {magic!r} v{version}")
+    body = memoryview(data)[HEADER.size:]
+    if len(body) != count * RECORD.size:
+        raise ValueError(f"expected {count} records, got {len(body)} bytes")
+    records = []
+    for values in RECORD.iter_unpack(body):
+        nulls = values[0]
+        rec = dict(zip(FIELD_NAMES, values[1:]))
+        if nulls:
+            for i, name in enumerate(FIELD_NAMES):
+                if nulls & (1 << i):
+                    rec[name] = None
+        if rec["OPD_DATE"] is not None:
+            rec["OPD_DATE"] = days_to_opd(rec["OPD_DATE"])
+        records.append(rec)
+    return records
+
+
+def decode_message(data: bytes, attributes=None) -> list:
+    # always returns a list of records, whatever the message shape
+    attributes = attributes or {}
+    if attributes.get(ENCODING_ATTR) == FORMAT_BINARY:
+        return decode_binary(data)
+    if attributes.get(ENVELOPE_ATTR) == "1":
+        return json.loads(data)
+    return [json.loads(data)]
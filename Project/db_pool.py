@@ -0,0 +1,229 @@
+import collections
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+
+logger = logging.getLogger("receiver.pool")
+
+# a small pool of psycopg2 connections: checked out one caller at a time,
+# pinged before reuse once they've sat idle, and replaced when postgres has
+# gone away, so a database restart costs one failed attempt instead of every
+# write until the process is restarted. statements registered with prepare()
+# are PREPAREd lazily on each connection and run with EXECUTE
+POOL_SIZE = 4           # connections open at most
+CHECK_IDLE = 30         # seconds idle before a connection is pinged on checkout
+RETRIES = 2             # extra attempts run() makes after a lost connection
+RETRY_DELAY = 1.0       # seconds, doubled per attempt
+
+DISCONNECTS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
+
+class Latency:
+    __slots__ = ("count", "total", "max")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def summary(self) -> dict:
+        return {"n": self.count,
+                "avg_ms": round(self.total / self.count * 1000, 2) if self.count else 0.0,
+                "max_ms": round(self.max * 1000, 2)}
+
+
+class Pooled:
+    __slots__ = ("conn", "prepared", "last_used")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.prepared = set()   # None after an error: DEALLOCATE ALL before the next PREPARE
+        self.last_used = time.monotonic()
+
+
+class ConnectionPool:
+
+    def __init__(self, connect, size=POOL_SIZE, check_idle=CHECK_IDLE, retries=RETRIES,
+                 observe=None):
+        self.connect = connect      # () -> new psycopg2 connection
+        self.observe = observe      # (name, seconds) for each wait and statement, or None
+        self.size = size
+        self.check_idle = check_idle
+        self.retries = retries
+        self.idle = collections.deque()
+        self.busy = {}              # conn -> Pooled
+        self.opening = 0            # slots held while a connection is checked or opened
+        self.cond = threading.Condition()
+        self.statements = {}        # name -> (argument types, sql)
+        self.wait = Latency()
+        self.latency = collections.defaultdict(Latency)
+        self.stats_lock = threading.Lock()
+        self.connects = 0
+        self.reconnects = 0         # connections replaced after a failure
+        self.failed_checks = 0
+        self.closed = False
+
+    def prepare(self, name, sql, types=()):
+        self.statements[name] = (types, sql)
+
+    def _checkout(self):
+        start = time.monotonic()
+        with self.cond:
+            while not self.idle and len(self.busy) + self.opening >= self.size:
+                self.cond.wait()
+            pooled = self.idle.pop() if self.idle else None
+            self.opening += 1
+        self._timed_wait(time.monotonic() - start)
+        ok = False
+        try:
+            if pooled is not None and not self._healthy(pooled):
+                self.failed_checks += 1
+                self.reconnects += 1
+                self._close(pooled.conn)
+                pooled = None
+            if pooled is None:
+                pooled = Pooled(self.connect())
+                self.connects += 1
+            ok = True
+        finally:
+            with self.cond:
+                self.opening -= 1
+                if ok:
+                    self.busy[pooled.conn] = pooled
+                else:
+                    self.cond.notify()
+        if not ok and pooled is not None:
+            self._close(pooled.conn)
+        return pooled
+
+    def _healthy(self, pooled):
+        if pooled.conn.closed:
+            return False
+        if time.monotonic() - pooled.last_used < self.check_idle:
+            return True
+        try:
+            with pooled.conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            pooled.conn.rollback()
+            return True
+        except DISCONNECTS:
+            return False
+
+    def _checkin(self, pooled, failed):
+        conn = pooled.conn
+        keep = not self.closed and not conn.closed
+        if keep and failed:
+            pooled.prepared = None
+            try:
+                conn.rollback()
+            except DISCONNECTS:
+                keep = False
+        if keep and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()     # caller left a transaction open
+        pooled.last_used = time.monotonic()
+        with self.cond:
+            del self.busy[conn]
+            if keep:
+                self.idle.append(pooled)
+            self.cond.notify()
+        if not keep:
+            self._close(conn)
+
+    @contextmanager
+    def connection(self):
+        pooled = self._checkout()
+        failed = False
+        try:
+            yield pooled.conn
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            self._checkin(pooled, failed)
+
+    def run(self, fn):
+        # fn(conn), retried on a fresh connection if the one it got was lost.
+        # fn must be safe to repeat: its transaction didn't commit
+        delay = RETRY_DELAY
+        for attempt in range(self.retries + 1):
+            try:
+                with self.connection() as conn:
+                    return fn(conn)
+            except DISCONNECTS as e:
+                if attempt == self.retries:
+                    raise
+                logger.warning("Lost database connection (%s), retrying in %.1fs", e, delay)
+                self.reconnects += 1
+                self._drop_idle()   # they went down with it
+                time.sleep(delay)
+                delay *= 2
+
+    def execute(self, cur, name, args=()):
+        # EXECUTE a registered statement, PREPAREing it on this connection first
+        pooled = self.busy[cur.connection]
+        if name not in (pooled.prepared or ()):
+            if pooled.prepared is None:
+                cur.execute("DEALLOCATE ALL")   # an aborted transaction may have kept some
+                pooled.prepared = set()
+            types, sql = self.statements[name]
+            signature = f"({', '.join(types)})" if types else ""
+            cur.execute(f"PREPARE {name}{signature} AS {sql}")
+            pooled.prepared.add(name)
+        placeholders = f" ({', '.join(['%s'] * len(args))})" if args else ""
+        with self.timed(name):
+            cur.execute(f"EXECUTE {name}{placeholders}", args or None)
+
+    @contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.stats_lock:
+                self.latency[name].add(elapsed)
+            if self.observe:
+                self.observe(name, elapsed)
+
+    def _timed_wait(self, seconds):
+        with self.stats_lock:
+            self.wait.add(seconds)
+        if self.observe:
+            self.observe("pool_wait", seconds)
+
+    def _drop_idle(self):
+        with self.cond:
+            stale, self.idle = list(self.idle), collections.deque()
+        for pooled in stale:
+            self._close(pooled.conn)
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def close(self):
+        self.closed = True
+        self._drop_idle()
+
+    def stats(self) -> dict:
+        with self.stats_lock:
+            return {
+                "open": len(self.idle) + len(self.busy),
+                "connects": self.connects,
+                "reconnects": self.reconnects,
+                "failed_checks": self.failed_checks,
+                "wait": self.wait.summary(),
+                "statements": {name: lat.summary() for name, lat in sorted(self.latency.items())},
+            }
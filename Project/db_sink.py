@@ -0,0 +1,373 @@
+import io
+import logging
+import queue
+import threading
+import time
+from collections import Counter, OrderedDict
+
+import schema
+
+logger = logging.getLogger("receiver.sink")
+
+# defaults for the receiver's buffered BreadCrumb writer
+FLUSH_ROWS = 5000       # flush once this many breadcrumbs are buffered
+LINGER = 1.0            # ... or once the oldest has waited this long (seconds)
+MAX_INFLIGHT = 2        # batches queued for / being written to postgres
+TRIP_CACHE_SIZE = 50_000    # trip_ids known to exist in Trip
+TRIP_CACHE_TTL = 6 * 3600   # forget a trip this long after its last breadcrumb
+
+BREADCRUMB_COLUMNS = ("tstamp", "latitude", "longitude", "speed", "trip_id", "meters")
+# one breadcrumb per trip and instant; redelivered rows are skipped on insert
+UNIQUE_INDEX = "breadcrumb_trip_tstamp"
+
+# insert the staged batch and fold the rows that were actually inserted into
+# TripSummary / VehicleDaySummary, all in one statement. redelivered rows
+# aren't RETURNed, so they're never counted twice
+INSERT_WITH_SUMMARIES = """
+    WITH ins AS (
+        INSERT INTO BreadCrumb ({columns})
+        SELECT {columns} FROM breadcrumb_stage
+        ON CONFLICT DO NOTHING
+        RETURNING tstamp, speed, trip_id, meters
+    ), added AS (
+        SELECT ins.trip_id, t.vehicle_id, ins.tstamp, ins.speed, ins.meters
+        FROM ins JOIN Trip t ON t.trip_id = ins.trip_id
+    ), trips AS (
+        INSERT INTO TripSummary AS x
+        SELECT trip_id, min(vehicle_id), count(*), sum(speed), min(speed), max(speed),
+               min(tstamp), max(tstamp), min(meters), max(meters)
+        FROM added GROUP BY trip_id
+        ON CONFLICT (trip_id) DO UPDATE SET {merge}
+        RETURNING 1
+    ), days AS (
+        INSERT INTO VehicleDaySummary AS x
+        SELECT vehicle_id, tstamp::date, count(*), sum(speed), min(speed), max(speed),
+               min(tstamp), max(tstamp), min(meters), max(meters)
+        FROM added WHERE vehicle_id IS NOT NULL GROUP BY vehicle_id, tstamp::date
+        ORDER BY 1, 2       -- shards share vehicle-days; lock them in one order
+        ON CONFLICT (vehicle_id, service_date) DO UPDATE SET {merge}
+        RETURNING 1
+    )
+    SELECT count(*) FROM ins
+"""
+SUMMARY_MERGE = """
+    breadcrumbs  = x.breadcrumbs + EXCLUDED.breadcrumbs,
+    speed_sum    = coalesce(x.speed_sum, 0) + coalesce(EXCLUDED.speed_sum, 0),
+    speed_min    = LEAST(x.speed_min, EXCLUDED.speed_min),
+    speed_max    = GREATEST(x.speed_max, EXCLUDED.speed_max),
+    first_tstamp = LEAST(x.first_tstamp, EXCLUDED.first_tstamp),
+    last_tstamp  = GREATEST(x.last_tstamp, EXCLUDED.last_tstamp),
+    meters_min   = LEAST(x.meters_min, EXCLUDED.meters_min),
+    meters_max   = GREATEST(x.meters_max, EXCLUDED.meters_max)
+"""
+
+
+class AckToken:
+    # acks a message once every record it carried is accounted for: committed
+    # by the sink or rejected by validation. if a batch fails the message is
+    # nacked so the broker redelivers it. a token has ack()/nack() itself, so
+    # it can stand in for the message of another token (to also wait on
+    # something else, e.g. the raw archive being on disk)
+
+    __slots__ = ("message", "pending", "failed", "lock")
+
+    def __init__(self, message, count):
+        self.message = message
+        self.pending = count + 1    # +1 guard, released by close()
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def done(self, ok=True):
+        with self.lock:
+            if not ok:
+                self.failed = True
+            self.pending -= 1
+            if self.pending:
+                return
+        if self.failed:
+            self.message.nack()
+        else:
+            self.message.ack()
+
+    close = done
+
+    def ack(self):
+        self.done()
+
+    def nack(self):
+        self.done(False)
+
+
+class KnownTrips:
+    # trip_ids already committed to Trip, so a trip is upserted once rather
+    # than once per breadcrumb. LRU by last use, bounded by size and TTL; a
+    # trip that falls out is just upserted again (ON CONFLICT DO NOTHING)
+
+    def __init__(self, max_size=TRIP_CACHE_SIZE, ttl=TRIP_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.trips = OrderedDict()  # trip_id -> last seen (monotonic)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.trips)
+
+    def __contains__(self, trip_id):
+        now = time.monotonic()
+        with self.lock:
+            seen = self.trips.get(trip_id)
+            if seen is None or now - seen > self.ttl:
+                self.misses += 1
+                return False
+            self.trips[trip_id] = now
+            self.trips.move_to_end(trip_id)
+            self.hits += 1
+            return True
+
+    def add_all(self, trip_ids):
+        now = time.monotonic()
+        with self.lock:
+            for trip_id in trip_ids:
+                self.trips[trip_id] = now
+                self.trips.move_to_end(trip_id)
+            while len(self.trips) > self.max_size:
+                self.trips.popitem(last=False)
+            # the oldest entries are at the front; drop the expired ones
+            while self.trips:
+                trip_id, seen = next(iter(self.trips.items()))
+                if now - seen <= self.ttl:
+                    break
+                del self.trips[trip_id]
+
+
+class Batch:
+
+    def __init__(self):
+        self.trips = {}         # trip_id -> vehicle_id
+        self.rows = []          # staged rows, in BREADCRUMB_COLUMNS order
+        self.tokens = []
+        self.marks = {}         # trip_id -> the caller's mark for its newest row
+        self.started = time.monotonic()
+
+
+class BreadCrumbSink:
+    # buffers validated breadcrumbs and writes them in one transaction per
+    # batch: a multi-row Trip upsert, then COPY ... FROM STDIN into BreadCrumb.
+    # tokens (and so messages) are only released after the commit
+
+    def __init__(self, pool, flush_rows=FLUSH_ROWS, linger=LINGER, max_inflight=MAX_INFLIGHT,
+                 known_trips=None, partitions=None, summaries=False, on_commit=None, on_fail=None):
+        self.pool = pool            # db_pool.ConnectionPool; closed with the sink
+        # (batch) once it has committed / failed, before its tokens are released
+        self.on_commit = on_commit
+        self.on_fail = on_fail
+        self.partitions = partitions    # schema.Partitions, when BreadCrumb is partitioned
+        self.summaries = summaries      # maintain TripSummary / VehicleDaySummary
+        self.known = known_trips if known_trips is not None else KnownTrips()
+        self.flush_rows = flush_rows
+        self.linger = linger
+        self.batch = Batch()
+        self.lock = threading.Lock()
+        self.pending = Counter()    # (trip_id, tstamp) buffered or being written
+        self.queue = queue.Queue(maxsize=max_inflight)
+        columns = ", ".join(BREADCRUMB_COLUMNS)
+        pool.prepare("trip_upsert", """
+            INSERT INTO Trip (trip_id, vehicle_id) SELECT * FROM unnest($1, $2)
+            ON CONFLICT (trip_id) DO NOTHING
+            """, ("integer[]", "integer[]"))
+        if summaries:
+            pool.prepare("breadcrumb_merge",
+                         INSERT_WITH_SUMMARIES.format(columns=columns, merge=SUMMARY_MERGE))
+        else:
+            pool.prepare("breadcrumb_merge", f"""
+                INSERT INTO BreadCrumb ({columns})
+                SELECT {columns} FROM breadcrumb_stage
+                ON CONFLICT DO NOTHING
+                """)
+        pool.prepare("breadcrumb_existing", """
+            SELECT b.trip_id, b.tstamp FROM BreadCrumb b
+            JOIN unnest($1, $2) AS k (trip_id, tstamp)
+              ON b.trip_id = k.trip_id AND b.tstamp = k.tstamp
+            """, ("integer[]", "timestamp[]"))
+        self.rows_written = 0
+        self.rows_skipped = 0       # already in BreadCrumb
+        self.batches_written = 0
+        self.batches_failed = 0
+        self.trips_upserted = 0
+        self.stopped = threading.Event()
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+        self.ticker = threading.Thread(target=self._linger_loop, daemon=True)
+        self.ticker.start()
+
+    def warm(self, limit=None):
+        # preload the newest trips (trip ids are issued in increasing order)
+        limit = limit or self.known.max_size
+
+        def load(conn):
+            with conn, conn.cursor() as cur:
+                cur.execute("SELECT trip_id FROM Trip ORDER BY trip_id DESC LIMIT %s", (limit,))
+                return [r[0] for r in cur.fetchall()]
+        ids = self.pool.run(load)
+        self.known.add_all(reversed(ids))    # newest ends up most recently used
+        return len(ids)
+
+    def _ddl(self, statements):
+        def run(conn):
+            with conn, conn.cursor() as cur:
+                for ddl in statements:
+                    cur.execute(ddl)
+        self.pool.run(run)
+
+    def ensure_unique_index(self) -> bool:
+        try:
+            self._ddl([f"CREATE UNIQUE INDEX IF NOT EXISTS {UNIQUE_INDEX} "
+                       "ON BreadCrumb (trip_id, tstamp)"])
+            return True
+        except Exception as e:
+            # e.g. the table already holds duplicates; inserts still work
+            logger.error("Could not create unique index %s: %s", UNIQUE_INDEX, e)
+            return False
+
+    def ensure_meters(self) -> bool:
+        try:
+            self._ddl([schema.ADD_METERS.format("BreadCrumb")])
+            return True
+        except Exception as e:
+            logger.error("Could not add BreadCrumb.meters: %s", e)
+            return False
+
+    def ensure_summaries(self) -> bool:
+        try:
+            self._ddl(schema.CREATE_SUMMARIES)
+            return True
+        except Exception as e:
+            logger.error("Could not create summary tables: %s", e)
+            return False
+
+    def existing(self, keys):
+        # which (trip_id, tstamp) pairs are already in BreadCrumb, one query
+        def lookup(conn):
+            with conn, conn.cursor() as cur:
+                self.pool.execute(cur, "breadcrumb_existing",
+                                  ([k[0] for k in keys], [k[1] for k in keys]))
+                return cur.fetchall()
+        try:
+            rows = self.pool.run(lookup)
+        except Exception as e:
+            # can't tell: treat as new, the insert skips real duplicates
+            logger.error("Duplicate lookup failed: %s", e)
+            return set()
+        return {tuple(r) for r in rows}
+
+    def add(self, trip_id, vehicle_id, row, token, mark=None):
+        known = trip_id in self.known
+        with self.lock:
+            if not known:
+                self.batch.trips.setdefault(trip_id, vehicle_id)
+            self.batch.rows.append(row)
+            self.batch.tokens.append(token)
+            self.pending[(row[4], row[0])] += 1
+            if mark is not None:
+                self.batch.marks[trip_id] = mark
+            full = len(self.batch.rows) >= self.flush_rows
+            batch = self._take() if full else None
+        if batch is not None:
+            self.queue.put(batch)   # blocks while MAX_INFLIGHT batches are pending
+
+    def in_flight(self, key) -> bool:
+        # (trip_id, tstamp) added but not yet committed (or failed)
+        with self.lock:
+            return key in self.pending
+
+    def flush(self):
+        with self.lock:
+            batch = self._take()
+        if batch is not None:
+            self.queue.put(batch)
+
+    def close(self):
+        self.flush()
+        self.stopped.set()
+        self.queue.put(None)
+        self.writer.join()
+        self.pool.close()
+
+    def _take(self):
+        if not self.batch.rows:
+            return None
+        batch, self.batch = self.batch, Batch()
+        return batch
+
+    def _linger_loop(self):
+        while not self.stopped.wait(self.linger / 4):
+            with self.lock:
+                due = self.batch.rows and time.monotonic() - self.batch.started >= self.linger
+                batch = self._take() if due else None
+            if batch is not None:
+                self.queue.put(batch)
+
+    def _write_loop(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            ok = self._write(batch)
+            with self.lock:
+                for row in batch.rows:
+                    key = (row[4], row[0])
+                    self.pending[key] -= 1
+                    if not self.pending[key]:
+                        del self.pending[key]
+            hook = self.on_commit if ok else self.on_fail
+            if hook is not None:
+                try:
+                    hook(batch)
+                except Exception as e:
+                    logger.error("Batch %s hook failed: %s", "commit" if ok else "failure", e)
+            for token in batch.tokens:
+                token.done(ok)
+
+    def _write(self, batch):
+        try:
+            inserted = self.pool.run(lambda conn: self._write_batch(conn, batch))
+        except Exception as e:
+            logger.error("BreadCrumb batch of %d failed, messages will be redelivered: %s",
+                         len(batch.rows), e)
+            self.batches_failed += 1
+            return False
+        self.known.add_all(batch.trips)
+        self.trips_upserted += len(batch.trips)
+        self.rows_written += inserted
+        self.rows_skipped += len(batch.rows) - inserted
+        self.batches_written += 1
+        return True
+
+    def _write_batch(self, conn, batch):
+        # -> rows inserted. nothing is committed if it raises, so pool.run
+        # can repeat it on a fresh connection
+        if self.partitions is not None:
+            self.partitions.ensure(conn, {row[0].date() for row in batch.rows})
+        with conn, conn.cursor() as cur:   # one transaction
+            # Referential Integrity: trips not already known to exist go
+            # first, all in one statement
+            if batch.trips:
+                self.pool.execute(cur, "trip_upsert",
+                                  (list(batch.trips), list(batch.trips.values())))
+            buf = io.StringIO()
+            for row in batch.rows:
+                buf.write("\t".join(str(v) for v in row))
+                buf.write("\n")
+            buf.seek(0)
+            # COPY into a per-connection staging table, then insert what
+            # isn't there yet: a redelivered row can't fail the batch
+            cur.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS breadcrumb_stage
+                (LIKE BreadCrumb INCLUDING DEFAULTS) ON COMMIT DELETE ROWS
+                """)
+            with self.pool.timed("breadcrumb_copy"):
+                cur.copy_expert(f"COPY breadcrumb_stage ({', '.join(BREADCRUMB_COLUMNS)}) FROM STDIN", buf)
+            self.pool.execute(cur, "breadcrumb_merge")
+            return cur.fetchone()[0] if self.summaries else cur.rowcount
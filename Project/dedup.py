@@ -0,0 +1,123 @@
+import hashlib
+import math
+import threading
+
+# drops breadcrumbs we've already seen (Pub/Sub redelivery, fetch.py re-sending
+# overlapping history) before they reach validation, speed state or the DB.
+# a rotating Bloom filter covers the hot window; since a Bloom filter can say
+# "seen" for a record it never saw, every hit is confirmed before the record
+# is dropped: against what the receiver still holds or is writing, then
+# BreadCrumb's unique (trip_id, tstamp) index. hits that can't be confirmed
+# are "unconfirmed": real false positives, plus copies of rejected records
+KEY_FIELDS = ("VEHICLE_ID", "EVENT_NO_TRIP", "OPD_DATE", "ACT_TIME")
+CAPACITY = 1_000_000    # keys per generation
+ERROR_RATE = 0.001      # false-positive rate of one full generation
+GENERATIONS = 3         # window is between (GENERATIONS-1) and GENERATIONS x CAPACITY keys
+
+
+def record_key(rec: dict):
+    key = tuple(rec.get(f) for f in KEY_FIELDS)
+    return None if None in key else key
+
+
+class BloomFilter:
+
+    def __init__(self, capacity, error_rate):
+        self.bits = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self.array = bytearray((self.bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        # double hashing over one 128-bit digest
+        digest = hashlib.blake2b(repr(key).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def __contains__(self, key):
+        return all(self.array[p >> 3] & (1 << (p & 7)) for p in self._positions(key))
+
+    def add(self, key):
+        for p in self._positions(key):
+            self.array[p >> 3] |= 1 << (p & 7)
+        self.count += 1
+
+
+class RotatingBloom:
+    # newest generation takes inserts; once it holds `capacity` keys the
+    # oldest generation is dropped, so memory stays fixed and old keys age out
+
+    def __init__(self, capacity=CAPACITY, error_rate=ERROR_RATE, generations=GENERATIONS):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.generations = [BloomFilter(capacity, error_rate)]
+        self.max_generations = generations
+        self.rotations = 0
+
+    def __contains__(self, key):
+        return any(key in g for g in reversed(self.generations))
+
+    def add(self, key):
+        current = self.generations[-1]
+        if current.count >= self.capacity:
+            current = BloomFilter(self.capacity, self.error_rate)
+            self.generations.append(current)
+            if len(self.generations) > self.max_generations:
+                self.generations.pop(0)
+            self.rotations += 1
+        current.add(key)
+
+    def memory(self) -> int:
+        return sum(len(g.array) for g in self.generations)
+
+
+class Deduplicator:
+
+    def __init__(self, confirm, capacity=CAPACITY, error_rate=ERROR_RATE, generations=GENERATIONS):
+        self.confirm = confirm  # [rec] -> set of indexes already stored or on their way
+        self.bloom = RotatingBloom(capacity, error_rate, generations)
+        self.lock = threading.Lock()
+        self.checked = 0
+        self.duplicates = 0
+        self.unconfirmed = 0
+
+    def filter(self, records):
+        # -> (new records, number dropped as duplicates), order preserved
+        fresh, suspects = [], []
+        batch_keys = set()
+        with self.lock:
+            for rec in records:
+                key = record_key(rec)
+                if key is None:
+                    fresh.append(rec)   # validation will reject it
+                    continue
+                self.checked += 1
+                if key in batch_keys:
+                    self.duplicates += 1    # repeated within this message
+                    continue
+                batch_keys.add(key)
+                if key in self.bloom:
+                    suspects.append((len(fresh), rec))
+                else:
+                    self.bloom.add(key)
+                fresh.append(rec)
+        if not suspects:
+            return fresh, len(records) - len(fresh)
+        stored = self.confirm([rec for _, rec in suspects])
+        drop = {pos for i, (pos, _) in enumerate(suspects) if i in stored}
+        with self.lock:
+            self.duplicates += len(drop)
+            self.unconfirmed += len(suspects) - len(drop)
+        fresh = [rec for pos, rec in enumerate(fresh) if pos not in drop]
+        return fresh, len(records) - len(fresh)
+
+    def stats(self) -> dict:
+        return {
+            "checked": self.checked,
+            "duplicates": self.duplicates,
+            "hit_rate": round(self.duplicates / self.checked, 4) if self.checked else 0.0,
+            "unconfirmed": self.unconfirmed,
+            "bloom_bytes": self.bloom.memory(),
+            "rotations": self.bloom.rotations,
+        }
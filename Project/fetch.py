@@ -1,70 +1,195 @@
-import requests
-import json
-from datetime import datetime
-from google.cloud import pubsub_v1
+import argparse
 import concurrent.futures
+import async_fetch
+from archive import ParquetArchive
+import batch_publisher
+import codec
+from checkpoints import CheckpointStore, record_mark
+import transport
+from vehicles import VehicleRegistry
 
-# Set up Pub/Sub publisher
+# Set up publisher (created in main once the backend and batch settings are known)
 topic_path = "projects/somalias-data-eng/topics/breadcrumbs"
-publisher = pubsub_v1.PublisherClient()
-
-def publish_message(message_str):
-    return publisher.publish(topic_path, data=message_str.encode("utf-8"))
-# Get current date for filename
-today = datetime.now().strftime("%Y-%m-%d")
-filename = f"sent_{today}.json"
-# List of vehicle IDs
-vehicle_ids = [
-    2901, 2902, 2904, 2905, 2907, 2908, 2910, 2922, 2924, 2926, 2929, 2935, 2937, 3001, 3002, 3004, 3006,
-    3008, 3009, 3010, 3017, 3020, 3029, 3036, 3042, 3046, 3052, 3054, 3059, 3105, 3108, 3110, 3115, 3117,
-    3118, 3121, 3122, 3125, 3127, 3128, 3132, 3138, 3141, 3146, 3149, 3150, 3153, 3158, 3160, 3163, 3203,
-    3204, 3206, 3208, 3213, 3214, 3219, 3220, 3223, 3226, 3227, 3231, 3233, 3234, 3235, 3237, 3240, 3241,
-    3242, 3243, 3247, 3249, 3250, 3251, 3252, 3254, 3255, 3261, 3264, 3265, 3315, 3318, 3320, 3324, 3330,
-    3404, 3406, 3412, 3417, 3418, 3422, 3503, 3508, 3512, 3521, 3523, 3528, 3534, 3536, 3548, 3549, 3554,
-    3557, 3562, 3563, 3565, 3569, 3577, 3603, 3620, 3631, 3633, 3635, 3637, 3639, 3645, 3647, 3649, 3650,
-    3702, 3704, 3705, 3712, 3718, 3720, 3723, 3725, 3730, 3731, 3732, 3733, 3737, 3738, 3748, 3749, 3750,
-    3754, 3755, 3756, 3902, 3907, 3911, 3912, 3914, 3920, 3922, 3923, 3926, 3928, 3932, 3934, 3935, 3938,
-    3939, 3943, 3948, 3951, 3952, 3960, 3963, 3964, 4002, 4006, 4009, 4017, 4019, 4022, 4026, 4031, 4033,
-    4038, 4043, 4049, 4053, 4058, 4060, 4062, 4070, 4202, 4206, 4208, 4209, 4213, 4217, 4218, 4223, 4225,
-    4226, 4228, 4231, 4236, 4237, 4238, 4302, 4510, 4513, 4521, 4526, 4528, 4530
-]
-
-base_url = "https://busdata.cs.pdx.edu/api/getBreadCrumbs?vehicle_id="
+publisher = None    # transport.Transport
+envelopes = None    # EnvelopePublisher when batching, else one message per record
 
+WireFormat = codec.FORMAT_BINARY
 
+def publish_message(vehicle_id, record, fmt):
+    data, attrs = codec.encode_message(record, fmt, vehicle_id)
+    return publisher.publish(data, **attrs)
+# Archive of what was sent, partitioned by service date and vehicle
+ArchiveDir = "sent"
+
+MaxInFlight = async_fetch.MAX_IN_FLIGHT  # concurrent requests / pooled connections
+RatePerHost = async_fetch.RATE_PER_HOST  # requests per second against busdata
+
+
+def initialize():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--max-in-flight", type=int, default=async_fetch.MAX_IN_FLIGHT)
+    parser.add_argument("--rate", type=float, default=async_fetch.RATE_PER_HOST,
+                        help="max requests/sec per host (0 = unlimited)")
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True,
+                        help="decode responses incrementally instead of all at once")
+    parser.add_argument("--envelope", action=argparse.BooleanOptionalAction, default=True,
+                        help="pack records of a vehicle/trip into one ordered message")
+    parser.add_argument("--wire", choices=codec.FORMATS, default=codec.FORMAT_BINARY,
+                        help="message payload encoding")
+    parser.add_argument("--batch-records", type=int, default=batch_publisher.MAX_RECORDS)
+    parser.add_argument("--batch-bytes", type=int, default=batch_publisher.MAX_BYTES)
+    parser.add_argument("--transport", choices=transport.BACKENDS, default=transport.BACKEND,
+                        help="message backend (default from BREADCRUMB_TRANSPORT)")
+    parser.add_argument("--batch-latency", type=float, default=transport.BATCH_MAX_LATENCY,
+                        help="client-side BatchSettings.max_latency in seconds")
+    parser.add_argument("--flow-messages", type=int, default=transport.FLOW_MAX_MESSAGES,
+                        help="max outstanding messages before publish blocks")
+    parser.add_argument("--archive-dir", default="sent",
+                        help="root of the parquet archive of published records")
+    parser.add_argument("--full", action="store_true",
+                        help="ignore checkpoints and republish everything")
+    args = parser.parse_args()
+
+    global MaxInFlight, RatePerHost, FullRun, Stream, WireFormat, ArchiveDir
+    global publisher, envelopes
+    MaxInFlight = args.max_in_flight
+    RatePerHost = args.rate
+    FullRun = args.full
+    Stream = args.stream
+    WireFormat = args.wire
+    ArchiveDir = args.archive_dir
+
+    publisher = transport.open_transport(
+        args.transport,
+        topic_path=topic_path,
+        batch_max_latency=args.batch_latency,
+        flow_max_messages=args.flow_messages,
+        ordering=args.envelope,
+    )
+    if args.envelope:
+        envelopes = batch_publisher.EnvelopePublisher(
+            publisher,
+            max_records=args.batch_records,
+            max_bytes=args.batch_bytes,
+            on_publish=track_future,
+            fmt=WireFormat,
+        )
+
+
+FullRun = False
+Stream = True
+checkpoints = CheckpointStore()
+registry = VehicleRegistry()
+vehicle_counts = {}   # vehicle_id -> new records this run, fed back to the registry
 publish_futures = []
-with open(filename, "w", encoding="utf-8") as f:
-    for vehicle_id in vehicle_ids:
-        url = f"{base_url}{vehicle_id}"
+vehicle_futures = {}  # vehicle_id -> publish futures carrying its records
+pending_marks = {}    # vehicle_id -> newest mark published this run
+failed_vehicles = set()   # fetch errors: not idle, and their marks stay put
+
+
+def track_future(vehicle_id, future):
+    publish_futures.append(future)
+    vehicle_futures.setdefault(vehicle_id, []).append(future)
+
+
+def publish_record(vehicle_id, record):
+    if envelopes is None:
+        track_future(vehicle_id, publish_message(vehicle_id, record, WireFormat))
+    else:
         try:
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            print("Response for vehicle", vehicle_id, "status:", response.status_code)
-            print("Response text snippet:", response.text[:200])
-            try:
-                breadcrumbs = response.json()
-            except ValueError as parse_err:
-                f.write(f"--- Vehicle ID: {vehicle_id} ---\n")
-                f.write(f"Error parsing JSON: {parse_err}\n\n")
-                continue
-            f.write(f"--- Vehicle ID: {vehicle_id} ---\n")
-            if isinstance(breadcrumbs, list):
-                for record in breadcrumbs:
-                    record_str = json.dumps(record)
-                    f.write(record_str + "\n")
-                    future = publish_message(record_str)
-                    publish_futures.append(future)
-            else:
-                record_str = json.dumps(breadcrumbs)
-                f.write(record_str + "\n")
-                future = publish_message(record_str)
-                publish_futures.append(future)
-            f.write("\n\n")
-        except requests.RequestException as e:
-            f.write(f"--- Vehicle ID: {vehicle_id} ---\n")
-            f.write(f"Error fetching data: {e}\n\n")
-try:
-    concurrent.futures.wait(publish_futures, timeout=60)
-    print("All messages published or timed out.")
-except Exception as e:
-    print("Error waiting on publishing futures:", e)
\ No newline at end of file
+            payload = codec.encode_record(record, WireFormat)
+        except codec.EncodeError:
+            # odd record, send it on its own as JSON (after what's buffered)
+            envelopes.publish_single(vehicle_id, *codec.encode_message(record, vehicle_id=vehicle_id))
+        else:
+            envelopes.add(vehicle_id, record.get("EVENT_NO_TRIP"), payload)
+    try:
+        mark = record_mark(record)
+    except (KeyError, TypeError, ValueError):
+        return
+    best = pending_marks.get(vehicle_id)
+    if best is None or mark > best:
+        pending_marks[vehicle_id] = mark
+
+
+def handle_records(sink, vehicle_id, breadcrumbs):
+    # called as soon as a vehicle's response arrives (or, when streaming, as
+    # each chunk is decoded), so publishing overlaps with requests in flight
+    if not isinstance(breadcrumbs, list):
+        breadcrumbs = [breadcrumbs]
+    if not FullRun:
+        # only what's past this vehicle's high-water mark
+        breadcrumbs = [r for r in breadcrumbs if checkpoints.is_new(vehicle_id, r)]
+    print("Response for vehicle", vehicle_id, "new records:", len(breadcrumbs))
+    vehicle_counts[vehicle_id] = vehicle_counts.get(vehicle_id, 0) + len(breadcrumbs)
+    for record in breadcrumbs:
+        publish_record(vehicle_id, record)
+        sink.add(vehicle_id, record)
+
+
+def commit_checkpoints():
+    # advance a vehicle's mark only if its whole response arrived and every
+    # message in it was published: the mark is the newest record published,
+    # and a stream cut short (or an unsorted response) can put records that
+    # never arrived below it
+    for vehicle_id, mark in pending_marks.items():
+        futures = vehicle_futures.get(vehicle_id, [])
+        if vehicle_id in failed_vehicles:
+            print("Not advancing checkpoint for vehicle", vehicle_id, "(incomplete response)")
+        elif all(fu.done() and fu.exception() is None for fu in futures):
+            checkpoints.update(vehicle_id, mark)
+        else:
+            print("Not advancing checkpoint for vehicle", vehicle_id)
+    checkpoints.save()
+
+
+
+def handle_error(sink, vehicle_id, err):
+    failed_vehicles.add(vehicle_id)
+    if isinstance(err, ValueError):
+        sink.write_error(vehicle_id, f"Error parsing JSON: {err}")
+    else:
+        sink.write_error(vehicle_id, f"Error fetching data: {err}")
+
+
+def main():
+    initialize()
+    vehicle_ids = registry.due()
+    print("Polling", len(vehicle_ids), "vehicles")
+    sink = ParquetArchive(ArchiveDir)
+    try:
+        async_fetch.run(
+            vehicle_ids,
+            on_records=lambda vid, data: handle_records(sink, vid, data),
+            on_error=lambda vid, err: handle_error(sink, vid, err),
+            max_in_flight=MaxInFlight,
+            rate_per_host=RatePerHost,
+            stream=Stream,
+        )
+    finally:
+        sink.close()
+    for vehicle_id in vehicle_ids:
+        if vehicle_id in vehicle_counts:
+            registry.record_result(vehicle_id, vehicle_counts[vehicle_id])
+        elif vehicle_id not in failed_vehicles:
+            registry.record_result(vehicle_id, 0)
+    registry.save()
+    print("Archived", sink.rows, "records to", ArchiveDir, "with", sink.errors, "errors")
+    if envelopes is not None:
+        envelopes.flush_all()
+    publisher.flush()
+    try:
+        concurrent.futures.wait(publish_futures, timeout=60)
+        print("All messages published or timed out.")
+    except Exception as e:
+        print("Error waiting on publishing futures:", e)
+    commit_checkpoints()
+    publisher.close()
+    if envelopes is not None:
+        print("Published", envelopes.records, "records in", envelopes.messages, "envelopes")
+    else:
+        print("Published", len(publish_futures), "messages")
+
+
+if __name__ == "__main__":
+    main()
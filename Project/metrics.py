@@ -0,0 +1,252 @@
+import bisect
+import collections
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# per-stage latency histograms for the ingest path. span(stage) times a block
+# into an in-process histogram; until enable() is called it hands back one
+# shared no-op, so instrumented code costs a function call. enabled, the
+# histograms are served as Prometheus text on /metrics, summarised to the log
+# every SUMMARY_EVERY seconds, and a sampling profile of every thread can be
+# taken on demand: GET /profile?seconds=N, or SIGUSR1 (PROFILE_SECONDS)
+METRICS_PORT = 9108         # 0: no HTTP endpoint
+METRICS_HOST = "127.0.0.1"
+SUMMARY_EVERY = 60          # seconds between log summaries; 0 disables them
+PROFILE_SECONDS = 30        # length of a SIGUSR1 profile
+PROFILE_MAX_SECONDS = 300
+PROFILE_INTERVAL = 0.005    # seconds between stack samples
+PROFILE_DIR = "."
+# upper bounds in seconds, 50us .. 10s
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+           0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+NAME = "receiver_stage_seconds"
+
+logger = logging.getLogger("receiver.metrics")
+
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count", "lock")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)     # last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(BUCKETS, seconds)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.counts), self.sum, self.count
+
+
+def quantile(counts, total, q):
+    # upper bound of the bucket holding the q-th observation
+    if not total:
+        return 0.0
+    rank = q * total
+    seen = 0
+    for bound, n in zip(BUCKETS, counts):
+        seen += n
+        if seen >= rank:
+            return bound
+    return float("inf")
+
+
+class Span:
+    __slots__ = ("hist", "start")
+
+    def __init__(self, hist):
+        self.hist = hist
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.start)
+        return False
+
+
+class NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_SPAN = NoSpan()
+
+enabled = False
+histograms = collections.defaultdict(Histogram)   # stage -> Histogram
+last_summary = {}                                  # stage -> snapshot at the last log line
+profiling = threading.Lock()                       # one profile at a time
+server = None
+
+
+def span(stage):
+    if not enabled:
+        return NO_SPAN
+    return Span(histograms[stage])
+
+
+def observe(stage, seconds):
+    if enabled:
+        histograms[stage].observe(seconds)
+
+
+def render() -> str:
+    # Prometheus text exposition format
+    lines = [f"# HELP {NAME} Time spent per ingest stage.", f"# TYPE {NAME} histogram"]
+    for stage in sorted(histograms):
+        counts, total, n = histograms[stage].snapshot()
+        cumulative = 0
+        for bound, c in zip(BUCKETS, counts):
+            cumulative += c
+            lines.append(f'{NAME}_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        lines.append(f'{NAME}_bucket{{stage="{stage}",le="+Inf"}} {n}')
+        lines.append(f'{NAME}_sum{{stage="{stage}"}} {total}')
+        lines.append(f'{NAME}_count{{stage="{stage}"}} {n}')
+    return "\n".join(lines) + "\n"
+
+
+def summary():
+    # per stage over the last interval: count, mean and bucket-bound p50/p99
+    parts = []
+    for stage in sorted(histograms):
+        counts, total, n = histograms[stage].snapshot()
+        prev_counts, prev_total, prev_n = last_summary.get(stage, ([0] * len(counts), 0.0, 0))
+        last_summary[stage] = (counts, total, n)
+        delta = [a - b for a, b in zip(counts, prev_counts)]
+        dn = n - prev_n
+        if not dn:
+            continue
+        parts.append(f"{stage} n={dn} mean={(total - prev_total) / dn * 1000:.3f}ms "
+                     f"p50<={quantile(delta, dn, 0.5) * 1000:g}ms "
+                     f"p99<={quantile(delta, dn, 0.99) * 1000:g}ms")
+    if parts:
+        logger.info("Stage latency: %s", "; ".join(parts))
+
+
+def _summary_loop(every):
+    while True:
+        time.sleep(every)
+        summary()
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def profile(seconds, interval=PROFILE_INTERVAL) -> collections.Counter:
+    # sample every other thread's stack; -> Counter of "root;...;leaf" stacks
+    # (collapsed format, feeds straight into flamegraph.pl / speedscope)
+    me = threading.get_ident()
+    names = {t.ident: t.name for t in threading.enumerate()}
+    stacks = collections.Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            stacks[";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def run_profile(seconds) -> str:
+    # -> collapsed stacks; also written to PROFILE_DIR and the hottest
+    # frames logged. None if a profile is already running
+    if not profiling.acquire(blocking=False):
+        return None
+    try:
+        seconds = max(0.1, min(seconds, PROFILE_MAX_SECONDS))
+        logger.info("Profiling for %.1fs", seconds)
+        stacks = profile(seconds)
+    finally:
+        profiling.release()
+    text = "".join(f"{stack} {n}\n" for stack, n in stacks.most_common())
+    path = os.path.join(PROFILE_DIR, f"profile-{os.getpid()}-{datetime.now():%Y%m%d-%H%M%S}.folded")
+    try:
+        with open(path, "w") as f:
+            f.write(text)
+    except OSError as e:
+        logger.error("Profile write failed: %s", e)
+        path = None
+    leaves = collections.Counter()
+    for stack, n in stacks.items():
+        leaves[stack.rsplit(";", 1)[-1]] += n
+    total = sum(stacks.values()) or 1
+    logger.info("Profile (%d samples) written to %s; hottest: %s", total, path,
+                ", ".join(f"{name} {n / total:.0%}" for name, n in leaves.most_common(5)))
+    return text
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/metrics":
+            body, status = render(), 200
+        elif url.path == "/profile":
+            try:
+                seconds = float(parse_qs(url.query).get("seconds", [PROFILE_SECONDS])[0])
+            except ValueError:
+                seconds = PROFILE_SECONDS
+            body = run_profile(seconds)
+            status = 200 if body is not None else 409
+            body = body if body is not None else "a profile is already running\n"
+        else:
+            body, status = "not found\n", 404
+        data = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+def _on_signal(signum, frame):
+    threading.Thread(target=run_profile, args=(PROFILE_SECONDS,), daemon=True).start()
+
+
+def enable(port=METRICS_PORT, summary_every=SUMMARY_EVERY):
+    global enabled, server
+    enabled = True
+    if port:
+        try:
+            server = ThreadingHTTPServer((METRICS_HOST, port), Handler)
+        except OSError as e:
+            logger.error("Metrics endpoint on port %d failed: %s", port, e)
+        else:
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            logger.info("Metrics on http://%s:%d/metrics", METRICS_HOST, port)
+    if summary_every:
+        threading.Thread(target=_summary_loop, args=(summary_every,), daemon=True).start()
+    if hasattr(signal, "SIGUSR1") and threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGUSR1, _on_signal)
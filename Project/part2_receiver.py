@@ -1,32 +1,216 @@
-import json
+import argparse
+import itertools
 import logging
+import multiprocessing
+import os
+import threading
+import time
+import zlib
 from datetime import datetime, timedelta
-from google.cloud import pubsub_v1
+import numpy as np
 import psycopg2
 
-# config
+import codec
+import db_pool
+import db_sink
+import dedup
+import metrics
+import reorder
+import schema
+import rejects as rejections
+import transport
+import trip_state
+import wal
+
+# config (transport backend comes from BREADCRUMB_TRANSPORT)
+TOPIC_PATH        = "projects/somalias-data-eng/topics/breadcrumbs"
 SUBSCRIPTION_PATH = "projects/somalias-data-eng/subscriptions/breadcrumbs-sub"
 DB_CONFIG = {
     'dbname':   "",
     'user':     "",
     'password': "",
     'host':     "",
-    'port':     
+    'port':     5432
 }
+# pooled connections, pinged after CHECK_IDLE idle seconds and replaced
+# when postgres restarts
+POOL_SIZE        = db_pool.POOL_SIZE
+POOL_CHECK_IDLE  = db_pool.CHECK_IDLE   # seconds
+# BreadCrumb rows are buffered and written with COPY; messages are acked
+# only once every record they carried is committed (or rejected)
+FLUSH_ROWS   = db_sink.FLUSH_ROWS    # rows per COPY batch
+FLUSH_LINGER = db_sink.LINGER        # max seconds a row waits for its batch
+MAX_INFLIGHT = db_sink.MAX_INFLIGHT  # batches buffered before callbacks block
+# trips already in Trip are remembered so each is upserted about once
+TRIP_CACHE_SIZE = db_sink.TRIP_CACHE_SIZE
+TRIP_CACHE_TTL  = db_sink.TRIP_CACHE_TTL   # seconds
+# fold each committed batch into TripSummary / VehicleDaySummary
+SUMMARIES = True
+# per-trip state survives restarts through a local checkpoint
+STATE_FILE       = trip_state.STATE_FILE
+STATE_TTL        = trip_state.STATE_TTL         # seconds without a breadcrumb
+STATE_MAX_TRIPS  = trip_state.STATE_MAX_TRIPS
+CHECKPOINT_EVERY = trip_state.CHECKPOINT_EVERY  # seconds
+# --workers N: shard records by trip across N processes (0 = in-process)
+Workers     = 0
+SHARD_QUEUE = 64    # messages queued per worker before the callback blocks
+# envelopes this big are validated as one vectorized batch (--no-vectorize
+# keeps everything on the per-record path)
+Vectorize          = True
+VECTOR_MIN_RECORDS = 64
+# rejected records: per-rule counts, sampled warnings, dead-letter file
+DEAD_LETTER_FILE = rejections.DEAD_LETTER_FILE
+# duplicates (redelivery, overlapping fetches) are dropped before validation
+DEDUP_CAPACITY    = dedup.CAPACITY      # keys per Bloom generation
+DEDUP_ERROR_RATE  = dedup.ERROR_RATE
+DEDUP_GENERATIONS = dedup.GENERATIONS
+STATS_EVERY       = 300                 # seconds between dedup / pool stats lines
+# keys of breadcrumbs in failed batches: when redelivered behind their trip's
+# state they are retried instead of rejected
+RETRY_KEYS = 200_000
+RETRY_TTL  = 3600                       # seconds
+# records are released per trip in ACT_TIME order once the trip's newest
+# ACT_TIME is REORDER_LATENESS past them (or after REORDER_MAX_HOLD seconds)
+REORDER_LATENESS    = reorder.LATENESS     # event-time seconds
+REORDER_MAX_HOLD    = reorder.MAX_HOLD     # wall seconds
+REORDER_MAX_RECORDS = reorder.MAX_RECORDS
+LATE_POLICY         = reorder.LATE_POLICY  # "reject" (dead-letter) or "process"
+# raw messages go to YYYY-MM-DD.json through one writer thread: group
+# commits, fsync at most every ARCHIVE_FSYNC seconds (0 = every group,
+# None = never), each line tagged with its message id for replay
+ARCHIVE_DIR   = wal.ARCHIVE_DIR
+ARCHIVE_FSYNC = wal.FSYNC_INTERVAL
+# per-stage latency histograms on http://127.0.0.1:METRICS_PORT/metrics (shard
+# workers use METRICS_PORT+1+shard), a log summary every METRICS_SUMMARY_EVERY
+# seconds, and /profile?seconds=N or SIGUSR1 for a sampling profile
+Metrics               = False
+METRICS_PORT          = metrics.METRICS_PORT
+METRICS_SUMMARY_EVERY = metrics.SUMMARY_EVERY
 
 # logging
 logging.basicConfig(level=logging.INFO,
                     format="[%(asctime)s] %(levelname)s:%(name)s: %(message)s")
 logger = logging.getLogger("receiver")
 
-# postgres
-conn = psycopg2.connect(**DB_CONFIG)
-conn.autocommit = True
-cur  = conn.cursor()
-
-# state
-previous_records = {}   # for speed & inter-record checks
+# postgres sink and per-trip state; owned by whichever process runs
+# process_record (this one, or each shard worker), see open_pipeline
+sink             = None
+previous_records = None   # for speed & inter-record checks
+rejects          = None   # rejections.Rejects
+deduper          = None   # dedup.Deduplicator
+reorderer        = None   # reorder.ReorderBuffer
+last_stats       = time.monotonic()
 days_with_trip   = set()  # for summary assertion
+archiver         = None   # wal.ArchiveWriter, in the process that subscribes
+retrying         = None   # db_sink.KnownTrips of (trip_id, tstamp) from failed batches
+redelivered      = 0      # records behind their trip's state that were already stored
+
+# validate_record's verdict for a record behind its trip's state that came
+# from a failed batch: valid, but checked and timed without the trip's state
+RETRY = "retry"
+
+
+def initialize():
+    parser = argparse.ArgumentParser(description="breadcrumb receiver")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="worker processes, records sharded by EVENT_NO_TRIP (0 = in-process)")
+    parser.add_argument("--vectorize", action=argparse.BooleanOptionalAction, default=True,
+                        help=f"validate envelopes of {VECTOR_MIN_RECORDS}+ records as numpy batches")
+    parser.add_argument("--metrics", action="store_true",
+                        help="time each ingest stage and serve the histograms over HTTP")
+    parser.add_argument("--metrics-port", type=int, default=metrics.METRICS_PORT,
+                        help="0 = log summaries only")
+    args = parser.parse_args()
+
+    global Metrics, METRICS_PORT
+    Metrics = args.metrics
+    METRICS_PORT = args.metrics_port
+    global Workers
+    Workers = args.workers
+    global Vectorize
+    Vectorize = args.vectorize
+
+
+def shard_file(path, shard):
+    if shard is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{shard}{ext}"
+
+
+def prepare_schema():
+    # DDL runs once, in the parent before any shard forks: shards running it
+    # together race on the catalog locks and fail with duplicate objects
+    ddl = db_sink.BreadCrumbSink(db_pool.ConnectionPool(lambda: psycopg2.connect(**DB_CONFIG), 1))
+    try:
+        ddl.ensure_meters()
+        ddl.ensure_unique_index()
+        if SUMMARIES:
+            ddl.ensure_summaries()
+    finally:
+        ddl.close()
+
+
+def open_pipeline(shard=None):
+    global sink, previous_records, rejects, deduper, reorderer, retrying
+    # each shard checkpoints the trips it owns; keep --workers stable
+    # across restarts or moved trips start over at speed 0
+    state_file = shard_file(STATE_FILE, shard)
+    rejects = rejections.Rejects(shard_file(DEAD_LETTER_FILE, shard), logger)
+    previous_records = trip_state.TripStateStore(state_file, STATE_TTL, STATE_MAX_TRIPS,
+                                                 CHECKPOINT_EVERY)
+    connect = lambda: psycopg2.connect(**DB_CONFIG)
+    pool = db_pool.ConnectionPool(connect, POOL_SIZE, POOL_CHECK_IDLE,
+                                  observe=lambda name, s: metrics.observe("db_" + name, s))
+    sink = db_sink.BreadCrumbSink(pool,
+                                  flush_rows=FLUSH_ROWS, linger=FLUSH_LINGER,
+                                  max_inflight=MAX_INFLIGHT,
+                                  known_trips=db_sink.KnownTrips(TRIP_CACHE_SIZE, TRIP_CACHE_TTL),
+                                  partitions=schema.Partitions(connect).load(),
+                                  summaries=SUMMARIES, on_commit=committed,
+                                  on_fail=failed)
+    retrying = db_sink.KnownTrips(RETRY_KEYS, RETRY_TTL)
+    deduper = dedup.Deduplicator(stored_duplicates, DEDUP_CAPACITY, DEDUP_ERROR_RATE,
+                                 DEDUP_GENERATIONS)
+    reorderer = reorder.ReorderBuffer(process_items, reject_late, REORDER_LATENESS,
+                                      REORDER_MAX_HOLD, REORDER_MAX_RECORDS, LATE_POLICY)
+    logger.info("Restored state for %d live trips", len(previous_records))
+    logger.info("Warmed trip cache with %d recent trips", sink.warm())
+
+
+def committed(batch):
+    # the trip state that gets checkpointed only moves once the sink commits
+    for tid, (act_time, meters, opd_date) in batch.marks.items():
+        previous_records.commit(tid, act_time, meters, opd_date)
+
+
+def failed(batch):
+    # the batch's messages are nacked and come back: its trips return to
+    # their last committed breadcrumb so the redelivered records pass the
+    # inter-record checks again, and its keys are remembered for records
+    # that still land behind their trip (a later batch committed first)
+    reorderer.rewind(previous_records.rollback(batch.marks))
+    retrying.add_all((row[4], row[0]) for row in batch.rows)
+
+
+def close_pipeline():
+    reorderer.close()   # releases everything still held
+    logger.info("Reorder: %s", reorderer.stats())
+    previous_records.checkpoint()
+    sink.close()    # writes the last partial batch, acking its messages
+    rejects.close()
+    logger.info("Wrote %d breadcrumbs in %d batches (%d failed)",
+                sink.rows_written, sink.batches_written, sink.batches_failed)
+    logger.info("Trip upserts: %d (cache hits %d, misses %d)",
+                sink.trips_upserted, sink.known.hits, sink.known.misses)
+    logger.info("Dedup: %s, %d more skipped on insert, %d redelivered behind their trip",
+                deduper.stats(), sink.rows_skipped, redelivered)
+    logger.info("Pool: %s", sink.pool.stats())
+    # Summary: ensure each day had at least one trip
+    if not days_with_trip:
+        logger.error("No trips processed today!")
+    else:
+        logger.info("Trips processed for days: %s", sorted(days_with_trip))
 
 def parse_opd_date(opd: str) -> datetime:
     # parse "31DEC2022:00:00:00"
@@ -42,28 +226,28 @@ def validate_record(rec: dict) -> bool:
         "GPS_LATITUDE", "GPS_LONGITUDE"
     ):
         if rec.get(f) is None:
-            logger.warning("Missing %s", f)
+            rejects.reject("missing_field", rec, f)
             return False
 
     # 7 Limit Checks
     act = rec["ACT_TIME"]
     if not (0 <= act <= 86399):
-        logger.warning("Bad ACT_TIME: %s", act)
+        rejects.reject("bad_act_time", rec, act)
         return False
 
     lat, lon = rec["GPS_LATITUDE"], rec["GPS_LONGITUDE"]
     if not (45.0 <= lat <= 46.0 and -123.5 <= lon <= -122.0):
-        logger.warning("Coords out of bounds: %s,%s", lat, lon)
+        rejects.reject("coords_out_of_bounds", rec, (lat, lon))
         return False
 
     sat = rec.get("GPS_SATELLITES")
     if sat is not None and not (4 <= sat <= 20):
-        logger.warning("Bad GPS_SATELLITES: %s", sat)
+        rejects.reject("bad_satellites", rec, sat)
         return False
 
     hdop = rec.get("GPS_HDOP")
     if hdop is not None and hdop <= 0:
-        logger.warning("Bad GPS_HDOP: %s", hdop)
+        rejects.reject("bad_hdop", rec, hdop)
         return False
 
     # Intra-record Checks
@@ -72,11 +256,11 @@ def validate_record(rec: dict) -> bool:
         return False
 
     if rec["METERS"] == 0 and act > 0:
-        logger.warning("Zero METERS at ACT_TIME>0")
+        rejects.reject("zero_meters", rec, act)
         return False
 
     if hdop is not None and hdop > 10:
-        logger.warning("High GPS_HDOP: %s", hdop)
+        rejects.reject("high_hdop", rec, hdop)
         return False
 
     # Inter-record Checks
@@ -84,39 +268,58 @@ def validate_record(rec: dict) -> bool:
     prev = previous_records.get(tid)
 
 
-    if prev and prev.get("OPD_DATE") != rec["OPD_DATE"]:
+    if prev and prev.opd_date != rec["OPD_DATE"]:
         previous_records.pop(tid)
         prev = None
-    #if prev:
-        #logger.warning("Trip: %s Prev time: %s  vs Current: %s",tid, rec["ACT_TIME"], prev["ACT_TIME"])
-
-        #if rec["ACT_TIME"] < prev["ACT_TIME"]:
-        #    logger.warning("Time < : Trip: %s Prev time: %s  < Current: %s",tid, prev["ACT_TIME"],rec["ACT_TIME"])
-        #    logger.warning("ACT_TIME moved backwards on trip %s", tid)
-        #    return False
-        #if rec["METERS"] < prev["METERS"]:
-        #    logger.warning("METER: Trip: %s Prev Meter: %s  vs Current: %s",tid, prev["METERS"],rec["METERS"])
-            #logger.warning("METERS decreased on trip %s", tid)
-        #   return False
-        #if rec["ACT_TIME"] == prev["ACT_TIME"]:
-        ##    logger.warning("DUP: Trip: %s Prev Meter: %s  vs Current: %s",tid, prev["ACT_TIME"],rec["ACT_TIME"])
-        #    logger.warning("Duplicate timestamp on trip %s", tid)
-        #   return False
+    if prev:
+        if rec["ACT_TIME"] < prev.act_time:
+            return behind("act_time_backwards", rec, (prev.act_time, rec["ACT_TIME"]))
+        if rec["METERS"] < prev.meters:
+            rejects.reject("meters_decreased", rec, (prev.meters, rec["METERS"]))
+            return False
+        if rec["ACT_TIME"] == prev.act_time:
+            return behind("duplicate_timestamp", rec, rec["ACT_TIME"])
 
     return True
 
 
-def transform_record(rec: dict) -> dict:
+def record_key(rec):
+    # (trip_id, tstamp) as stored in BreadCrumb, or None
+    try:
+        return (rec["EVENT_NO_TRIP"], parse_opd_date(rec["OPD_DATE"])
+                + timedelta(seconds=rec["ACT_TIME"]))
+    except Exception:
+        return None
+
+
+def behind(rule, rec, detail):
+    # a record at or behind its trip's state. from a failed batch it's
+    # retried (RETRY); already in BreadCrumb (a redelivery, or a replay after
+    # a restart) it's dropped; anything else is rejected under rule
+    global redelivered
+    key = record_key(rec)
+    if key is not None:
+        if retrying is not None and key in retrying:
+            return RETRY
+        if key in sink.existing([key]):
+            redelivered += 1
+            return False
+    rejects.reject(rule, rec, detail)
+    return False
+
+
+def transform_record(rec: dict, retry=False) -> dict:
     # timestamp
     base = parse_opd_date(rec["OPD_DATE"])
     rec["tstamp"] = base + timedelta(seconds=rec["ACT_TIME"])
 
-    # speed Statistical assertion
+    # speed Statistical assertion; a retried record has no usable previous
+    # breadcrumb (the trip's state is past it)
     tid  = rec["EVENT_NO_TRIP"]
-    prev = previous_records.get(tid)
+    prev = None if retry else previous_records.get(tid)
     if prev:
-        dt = rec["ACT_TIME"] - prev["ACT_TIME"]
-        ds = rec["METERS"]   - prev["METERS"]
+        dt = rec["ACT_TIME"] - prev.act_time
+        ds = rec["METERS"]   - prev.meters
         rec["speed"] = (ds/dt) if dt > 0 else 0.0
     else:
         rec["speed"] = 0.0
@@ -124,106 +327,401 @@ def transform_record(rec: dict) -> dict:
     return rec
 
 
-def callback(message):
-    # parse & archive raw
+def decode_and_archive(message):
+    # parse & archive raw; a message may be a single record or an envelope.
+    # -> (records, what to ack in place of message), records None if it
+    # didn't decode. the archive is the write-ahead log, so the message is
+    # only acked once its lines are on disk as well as in the database
     try:
-        rec = json.loads(message.data.decode())
+        with metrics.span("decode"):
+            records = codec.decode_message(message.data, message.attributes)
     except Exception as e:
-        logger.error("JSON decode failed: %s", e)
+        rejects.reject_message(message.data, e)
         message.ack()
-        return
+        return None, message
+
+    if archiver is not None:
+        message_id = message.message_id
+        message = db_sink.AckToken(message, 1)     # the pipeline's verdict + the archive
+        with metrics.span("archive"):   # queueing only; the writer thread does the I/O
+            archiver.write(message_id, records, on_durable=message.done)
+    return records, message
+
+
+def callback(message):
+    with metrics.span("message"):
+        records, message = decode_and_archive(message)
+        if records is not None:
+            process_records(records, message)
+
+
+def stored_duplicates(records):
+    # Bloom hits -> indexes of the ones really seen: still held for
+    # reordering, buffered or being written by the sink, or in BreadCrumb
+    keys = [record_key(rec) for rec in records]
+    seen = {i for i, k in enumerate(keys) if k is not None and (
+        sink.in_flight(k) or (reorderer is not None and reorderer.holds(k[0], records[i]["ACT_TIME"])))}
+    rest = [k for i, k in enumerate(keys) if k is not None and i not in seen]
+    found = sink.existing(rest) if rest else set()
+    return seen | {i for i, k in enumerate(keys) if k is not None and k in found}
+
+
+def process_records(records, message):
+    global last_stats
+    with metrics.span("dedup"):
+        records, _ = deduper.filter(records)
+    if time.monotonic() - last_stats >= STATS_EVERY:
+        last_stats = time.monotonic()
+        logger.info("Dedup: %s", deduper.stats())
+        logger.info("Pool: %s", sink.pool.stats())
+
+    # one ack covers every record in the envelope; it's sent once the last
+    # accepted record's batch commits
+    token = db_sink.AckToken(message, len(records))
+    reorderer.add([(rec, token) for rec in records])
+    token.close()
+
+
+def reject_late(rec, token):
+    # behind what the reorder buffer already released: a record from a
+    # failed batch still goes through, a stored one is dropped
+    if behind("late_arrival", rec, rec.get("ACT_TIME")) == RETRY:
+        if process_record(rec, token):
+            return
+    token.done()
+
+
+def process_items(items):
+    # [(rec, token)] released by the reorder buffer, in order within each trip
+    if Vectorize and len(items) >= VECTOR_MIN_RECORDS:
+        process_batch(items)
+    else:
+        for rec, token in items:
+            if not process_record(rec, token):
+                token.done()
 
-    fn = datetime.now().strftime("%Y-%m-%d") + ".json"
-    try:
-        with open(fn, "a") as f:
-            f.write(json.dumps(rec) + "\n")
-    except Exception as e:
-        logger.error("Archive write failed: %s", e)
 
+def process_record(rec: dict, token) -> bool:
+    # True once the record is handed to the sink, which releases the token
     # validation
-    if not validate_record(rec):
-        message.ack()
-        return
+    with metrics.span("validate"):
+        valid = validate_record(rec)
+    if not valid:
+        return False
+    retry = valid == RETRY
 
-    # transform
+    # transform a copy: the dead-letter file gets the record as received
+    raw = rec
     try:
-        rec = transform_record(rec)
+        with metrics.span("transform"):
+            rec = transform_record(dict(raw), retry)
     except Exception as e:
-        logger.error("Transform error: %s", e)
-        message.ack()
-        return
+        rejects.reject("transform_error", raw, e)
+        return False
 
     # speed sanity (Statistical)
     if rec["speed"] > 35.0:
-        logger.warning("Speed out of range: %.2f m/s", rec["speed"])
-        message.ack()
-        return
+        rejects.reject("speed_too_high", raw, rec["speed"])
+        return False
     # Non-negative speed assertion
     if rec["speed"] < 0:
-        logger.warning("Negative speed on trip %s: %.2f m/s",
-        rec["EVENT_NO_TRIP"], rec["speed"])
-        message.ack()
-        return
-
-    # update state for next record
-    previous_records[rec["EVENT_NO_TRIP"]] = {
-        "ACT_TIME": rec["ACT_TIME"],
-        "METERS":   rec["METERS"],
-        "OPD_DATE": rec["OPD_DATE"]
-    }
+        rejects.reject("negative_speed", raw, rec["speed"])
+        return False
 
-    # Referential Integrity: ensure Trip exists
-    try:
-        cur.execute(
-            """
-            INSERT INTO Trip (trip_id, vehicle_id)
-            VALUES (%s, %s)
-            ON CONFLICT (trip_id) DO NOTHING
-            """,
-            (rec["EVENT_NO_TRIP"], rec["VEHICLE_ID"])
-        )
-    except Exception as e:
-        logger.error("Trip upsert failed: %s", e)
-
-    # insert BreadCrumb
-    try:
-        cur.execute(
-            """
-            INSERT INTO BreadCrumb
-              (tstamp, latitude, longitude, speed, trip_id)
-            VALUES (%s, %s, %s, %s, %s)
-            """,
-            (
-                rec["tstamp"],
-                rec["GPS_LATITUDE"],
-                rec["GPS_LONGITUDE"],
-                rec["speed"],
-                rec["EVENT_NO_TRIP"],
-            )
-        )
-    except Exception as e:
-        logger.error("BreadCrumb insert failed: %s", e)
+    # update state for next record; a retried one is behind it
+    if not retry:
+        previous_records.put(rec["EVENT_NO_TRIP"], rec["ACT_TIME"], rec["METERS"], rec["OPD_DATE"])
+
+    # BreadCrumb row; the sink upserts its Trip in the same transaction
+    with metrics.span("sink_add"):
+        sink.add(rec["EVENT_NO_TRIP"], rec["VEHICLE_ID"], (
+            rec["tstamp"],
+            rec["GPS_LATITUDE"],
+            rec["GPS_LONGITUDE"],
+            rec["speed"],
+            rec["EVENT_NO_TRIP"],
+            rec["METERS"],
+        ), token, None if retry else (rec["ACT_TIME"], rec["METERS"], rec["OPD_DATE"]))
 
     # Summary Assertions: track days with at least one trip
     days_with_trip.add(rec["tstamp"].date())
+    return True
 
-    message.ack()
+
+# micro-batch path: the same assertions as validate_record/transform_record/
+# process_record, evaluated as numpy masks over a whole release. decisions
+# must match the per-record path exactly; trips whose outcome depends on an
+# earlier rejection in the same batch (a speed rejection, an unparseable
+# OPD_DATE) are handed back to the per-record path, in order
+REQUIRED = ("VEHICLE_ID", "EVENT_NO_TRIP", "EVENT_NO_STOP", "OPD_DATE", "ACT_TIME", "METERS",
+            "GPS_LATITUDE", "GPS_LONGITUDE")
+NUMERIC  = ("VEHICLE_ID", "EVENT_NO_TRIP", "EVENT_NO_STOP", "ACT_TIME", "METERS",
+            "GPS_LATITUDE", "GPS_LONGITUDE", "GPS_SATELLITES", "GPS_HDOP")
+
+
+def batch_columns(records):
+    # {field: (present mask, float64 values)}, or None if any value isn't a
+    # plain number/str, in which case the per-record path decides
+    cols = {}
+    n = len(records)
+    for f in NUMERIC:
+        vals = [r.get(f) for r in records]
+        if any(v is not None and type(v) not in (int, float) for v in vals):
+            return None
+        present = np.fromiter((v is not None for v in vals), bool, n)
+        cols[f] = (present, np.array([np.nan if v is None else v for v in vals], dtype=float))
+    opd = [r.get("OPD_DATE") for r in records]
+    if any(v is not None and type(v) is not str for v in opd):
+        return None
+    cols["OPD_DATE"] = (np.fromiter((v is not None for v in opd), bool, n), opd)
+    return cols
+
+
+def process_batch(items):
+    records = [rec for rec, _ in items]
+    tokens  = [token for _, token in items]
+    cols = batch_columns(records)
+    if cols is None:
+        for rec, token in items:
+            if not process_record(rec, token):
+                token.done()
+        return
+
+    present = {f: cols[f][0] for f in cols}
+    act   = cols["ACT_TIME"][1]
+    meters = cols["METERS"][1]
+    lat, lon = cols["GPS_LATITUDE"][1], cols["GPS_LONGITUDE"][1]
+    sat, hdop = cols["GPS_SATELLITES"][1], cols["GPS_HDOP"][1]
+    trip  = cols["EVENT_NO_TRIP"][1]
+    opd   = cols["OPD_DATE"][1]
+
+    with metrics.span("validate_batch"):
+        # Existence, Limit and Intra-record assertions, in validate_record order
+        with np.errstate(invalid="ignore"):
+            rules = (
+                ("missing_field",  ~np.logical_and.reduce([present[f] for f in REQUIRED])),
+                ("bad_act_time",   ~((0 <= act) & (act <= 86399))),
+                ("coords_out_of_bounds", ~((45.0 <= lat) & (lat <= 46.0) & (-123.5 <= lon) & (lon <= -122.0))),
+                ("bad_satellites", present["GPS_SATELLITES"] & ~((4 <= sat) & (sat <= 20))),
+                ("bad_hdop",       present["GPS_HDOP"] & (hdop <= 0)),
+                ("zero_meters",    (meters == 0) & (act > 0)),
+                ("high_hdop",      present["GPS_HDOP"] & (hdop > 10)),
+            )
+        ok = np.ones(len(records), bool)
+        for rule, bad in rules:
+            hit = ok & bad
+            if hit.any():
+                for i in np.flatnonzero(hit):
+                    rejects.reject(rule, records[i])
+                    tokens[i].done()
+                ok &= ~hit
+
+    with metrics.span("transform_batch"):
+        # timestamps: one strptime per distinct OPD_DATE, not per record
+        ok_idx = np.flatnonzero(ok)
+        bases = {}
+        sequential = set()  # trips resolved record by record
+        for i in ok_idx:
+            d = opd[i]
+            if d not in bases:
+                try:
+                    bases[d] = parse_opd_date(d)
+                except Exception:
+                    bases[d] = None
+            if bases[d] is None:
+                sequential.add(records[i]["EVENT_NO_TRIP"])
+
+        # speed: grouped diff per trip, seeded from the stored state of each trip
+        codes = {d: c for c, d in enumerate(bases)}
+        order = ok_idx[np.lexsort((ok_idx, trip[ok_idx]))]
+        first = np.ones(len(order), bool)
+        first[1:] = trip[order][1:] != trip[order][:-1]
+        prev_act  = np.empty(len(order))
+        prev_m    = np.empty(len(order))
+        prev_code = np.full(len(order), -1)
+        code = np.array([codes[opd[i]] for i in order], dtype=int)
+        prev_act[1:], prev_m[1:], prev_code[1:] = act[order][:-1], meters[order][:-1], code[:-1]
+        for j in np.flatnonzero(first):
+            state = previous_records.get(records[order[j]]["EVENT_NO_TRIP"])
+            prev_code[j] = codes.get(state.opd_date, -2) if state else -1
+            if state:
+                prev_act[j], prev_m[j] = state.act_time, state.meters
+        # a previous breadcrumb from another service day doesn't count
+        has_prev = (prev_code >= 0) & (prev_code == code)
+        dt = act[order] - prev_act
+        ds = meters[order] - prev_m
+        with np.errstate(invalid="ignore", divide="ignore"):
+            speed = np.where(has_prev & (dt > 0), ds / np.where(dt > 0, dt, 1), 0.0)
+        # Inter-record assertions, then speed
+        out_of_order = has_prev & ((act[order] < prev_act) | (meters[order] < prev_m)
+                                   | (act[order] == prev_act))
+        bad_speed = (speed > 35.0) | (speed < 0)
+        for j in np.flatnonzero(out_of_order | bad_speed):
+            sequential.add(records[order[j]]["EVENT_NO_TRIP"])
+
+        speeds = dict(zip(order.tolist(), speed.tolist()))
+
+    last = {}
+    for i in ok_idx.tolist():
+        rec = records[i]
+        tid = rec["EVENT_NO_TRIP"]
+        token = tokens[i]
+        if tid in sequential:
+            if not process_record(rec, token):
+                token.done()
+            continue
+        rec["tstamp"] = bases[rec["OPD_DATE"]] + timedelta(seconds=rec["ACT_TIME"])
+        rec["speed"] = speeds[i]
+        last[tid] = rec
+        sink.add(tid, rec["VEHICLE_ID"], (
+            rec["tstamp"],
+            rec["GPS_LATITUDE"],
+            rec["GPS_LONGITUDE"],
+            rec["speed"],
+            tid,
+            rec["METERS"],
+        ), token, (rec["ACT_TIME"], rec["METERS"], rec["OPD_DATE"]))
+        days_with_trip.add(rec["tstamp"].date())
+    for tid, rec in last.items():
+        previous_records.put(tid, rec["ACT_TIME"], rec["METERS"], rec["OPD_DATE"])
+
+
+def shard_of(trip_id, shards) -> int:
+    # stable across processes and restarts (unlike hash() on str)
+    return zlib.crc32(str(trip_id).encode()) % shards
+
+
+class ShardAck:
+    # stands in for the Pub/Sub message inside a worker: the worker's
+    # AckToken acks/nacks this, which reports back to the subscriber process
+
+    def __init__(self, token_id, results):
+        self.token_id = token_id
+        self.results = results
+
+    def ack(self):
+        self.results.put((self.token_id, True))
+
+    def nack(self):
+        self.results.put((self.token_id, False))
+
+
+def shard_worker(shard, inbox, results):
+    # owns one slice of the trips: its own state, trip cache and connection.
+    # a trip always lands on the same worker, in the order it arrived
+    global logger
+    logger = logging.getLogger(f"receiver.shard{shard}")
+    if Metrics:
+        metrics.logger = logging.getLogger(f"receiver.shard{shard}.metrics")
+        metrics.enable(METRICS_PORT + 1 + shard if METRICS_PORT else 0, METRICS_SUMMARY_EVERY)
+    open_pipeline(shard)
+    try:
+        while True:
+            item = inbox.get()
+            if item is None:
+                break
+            token_id, records = item
+            process_records(records, ShardAck(token_id, results))
+    finally:
+        close_pipeline()
+
+
+class ShardedReceiver:
+    # subscriber side of --workers: decode and archive each message, split
+    # its records by trip, and ack it once every shard that got a slice
+    # has committed (any shard failing nacks it)
+
+    def __init__(self, workers):
+        self.results = multiprocessing.Queue()
+        self.inboxes = [multiprocessing.Queue(SHARD_QUEUE) for _ in range(workers)]
+        self.procs = [multiprocessing.Process(target=shard_worker, args=(i, q, self.results),
+                                              name=f"shard-{i}")
+                      for i, q in enumerate(self.inboxes)]
+        self.pending = {}   # token_id -> [message, shards left, ok]
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        for p in self.procs:
+            p.start()
+        self.collector = threading.Thread(target=self._collect, daemon=True)
+        self.collector.start()
+        # decode errors are caught here, before records reach a shard
+        global rejects
+        rejects = rejections.Rejects(DEAD_LETTER_FILE, logger)
+
+    def callback(self, message):
+        records, message = decode_and_archive(message)
+        if records is None:
+            return
+        slices = {}
+        for rec in records:
+            shard = shard_of(rec.get("EVENT_NO_TRIP"), len(self.inboxes))
+            slices.setdefault(shard, []).append(rec)
+        if not slices:
+            message.ack()
+            return
+        token_id = next(self.ids)
+        with self.lock:
+            self.pending[token_id] = [message, len(slices), True]
+        for shard, part in slices.items():
+            self.inboxes[shard].put((token_id, part))
+
+    def _collect(self):
+        while True:
+            item = self.results.get()
+            if item is None:
+                return
+            token_id, ok = item
+            with self.lock:
+                entry = self.pending[token_id]
+                entry[1] -= 1
+                entry[2] = entry[2] and ok
+                if entry[1]:
+                    continue
+                del self.pending[token_id]
+            if entry[2]:
+                entry[0].ack()
+            else:
+                entry[0].nack()
+
+    def close(self):
+        for q in self.inboxes:
+            q.put(None)
+        for p in self.procs:
+            p.join()
+        self.results.put(None)
+        self.collector.join()
+        rejects.close()
+        if self.pending:
+            logger.warning("%d messages left unacked, they will be redelivered", len(self.pending))
 
 
 if __name__ == "__main__":
+    initialize()
     logger.info("Starting receiver on %s", SUBSCRIPTION_PATH)
-    subscriber = pubsub_v1.SubscriberClient()
-    future    = subscriber.subscribe(SUBSCRIPTION_PATH, callback=callback)
+    prepare_schema()
+    if Workers > 0:
+        logger.info("Sharding by trip across %d worker processes", Workers)
+        receiver = ShardedReceiver(Workers)
+        on_message = receiver.callback
+    else:
+        open_pipeline()
+        on_message = callback
+    # threads start after the shard workers fork; only this process archives
+    if Metrics:
+        metrics.enable(METRICS_PORT, METRICS_SUMMARY_EVERY)
+    archiver = wal.ArchiveWriter(ARCHIVE_DIR, ARCHIVE_FSYNC)
+    subscriber = transport.open_transport(topic_path=TOPIC_PATH,
+                                          subscription_path=SUBSCRIPTION_PATH)
+    future    = subscriber.subscribe(on_message)
     try:
         future.result()
     except KeyboardInterrupt:
         logger.info("Shutdown requested")
     finally:
         future.cancel()
-        conn.close()
-        # Summary: ensure each day had at least one trip
-        if not days_with_trip:
-            logger.error("No trips processed today!")
+        if Workers > 0:
+            receiver.close()
         else:
-            logger.info("Trips processed for days: %s", sorted(days_with_trip))
+            close_pipeline()
+        archiver.close()
         logger.info("Receiver stopped cleanly.")
@@ -1,28 +1,50 @@
-import json
-from datetime import datetime
-from google.cloud import pubsub_v1
+import os
 
-subscription_path = "projects/somalias-data-eng/subscriptions/breadcrumbs-sub"
-subscriber = pubsub_v1.SubscriberClient()
+import codec
+import transport
+import wal
+from archive import ParquetArchive
+
+topic_path = "projects/somalias-data-eng/topics/breadcrumbs"
+# part2_receiver reads breadcrumbs-sub too. on Pub/Sub they share it unless
+# BREADCRUMB_ARCHIVE_SUBSCRIPTION names a separate subscription (create it on
+# the topic first); local subscriptions are just files, so there this one
+# always gets its own instead of fighting over part2's socket and offset
+subscription_path = os.environ.get(
+    "BREADCRUMB_ARCHIVE_SUBSCRIPTION",
+    "projects/somalias-data-eng/subscriptions/"
+    + ("breadcrumbs-archive-sub" if transport.BACKEND == "local" else "breadcrumbs-sub"))
+# Pub/Sub or the local log, per BREADCRUMB_TRANSPORT
+subscriber = transport.open_transport(topic_path=topic_path, subscription_path=subscription_path)
+
+# received records, partitioned by service date and vehicle
+archive = ParquetArchive("received")
+# raw messages, one JSON line per record tagged with the message id, written
+# by a background thread; a message is acked only once its lines are on disk,
+# so whatever the parquet buffers held at a crash can be replayed from here
+# ("_" keeps parquet readers from picking these files up)
+wal_writer = wal.ArchiveWriter(os.path.join("received", "_wal"))
 
 def callback(message):
-    # Determine the daily file name
-    today = datetime.now().strftime("%Y-%m-%d")
-    filename = f"{today}.json"
     try:
-        # Decode message data
-        record = json.loads(message.data.decode("utf-8"))
-        record_str = json.dumps(record)
-        with open(filename, "a", encoding="utf-8") as f:
-            f.write(record_str + "\n")
+        # Decode message data (one record, or an envelope of several)
+        records = codec.decode_message(message.data, message.attributes)
+        for record in records:
+            archive.add(message.attributes.get("vehicle_id"), record)
     except Exception as err:
-        with open(filename, "a", encoding="utf-8") as f:
-            f.write(f"Error processing message: {err}\n")
-    message.ack()
-streaming_pull_future = subscriber.subscribe(subscription_path, callback=callback)
+        archive.write_error(message.attributes.get("vehicle_id"),
+                            f"Error processing message: {err}")
+        message.ack()
+        return
+    wal_writer.write(message.message_id, records,
+                     on_durable=lambda ok: message.ack() if ok else message.nack())
+streaming_pull_future = subscriber.subscribe(callback)
 print(f"Listening for messages on {subscription_path}...")
 
 try:
     streaming_pull_future.result()
 except KeyboardInterrupt:
-    streaming_pull_future.cancel()
\ No newline at end of file
+    streaming_pull_future.cancel()
+finally:
+    wal_writer.close()
+    archive.close()
\ No newline at end of file
@@ -0,0 +1,88 @@
+import base64
+import json
+import logging
+import threading
+
+# rejected breadcrumbs: counted per rule, logged only as a sample, and kept
+# in a dead-letter file (one JSON line per record: rule id + raw record) so
+# they can be fixed up and replayed later
+DEAD_LETTER_FILE = "rejected.jsonl"
+LOG_FIRST = 5           # log the first few rejections of each rule...
+LOG_EVERY = 1000        # ...then every LOG_EVERY-th
+SUMMARY_EVERY = 60      # seconds between summary lines
+
+RULES = (
+    "decode_error",         # whole message, dead-lettered as base64
+    "missing_field",
+    "bad_act_time",
+    "coords_out_of_bounds",
+    "bad_satellites",
+    "bad_hdop",             # GPS_HDOP <= 0
+    "zero_meters",
+    "high_hdop",            # GPS_HDOP > 10
+    "act_time_backwards",
+    "meters_decreased",
+    "duplicate_timestamp",
+    "late_arrival",         # behind what the reorder buffer already released
+    "transform_error",
+    "speed_too_high",       # > 35 m/s
+    "negative_speed",
+)
+
+
+class Rejects:
+
+    def __init__(self, path=DEAD_LETTER_FILE, logger=None, summary_every=SUMMARY_EVERY):
+        self.path = path
+        self.logger = logger or logging.getLogger("receiver.rejects")
+        self.counts = dict.fromkeys(RULES, 0)
+        self.since_summary = dict.fromkeys(RULES, 0)
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding="utf-8") if path else None
+        self.stopped = threading.Event()
+        self.summary_every = summary_every
+        self.ticker = threading.Thread(target=self._summary_loop, daemon=True)
+        self.ticker.start()
+
+    def reject(self, rule, rec, detail=None):
+        n = self._write(rule, json.dumps({"rule": rule, "rec": rec}, default=str))
+        if n <= LOG_FIRST or n % LOG_EVERY == 0:
+            self.logger.warning("Rejected (%s #%d) trip %s: %s", rule, n,
+                                rec.get("EVENT_NO_TRIP"), detail)
+
+    def reject_message(self, data, error):
+        n = self._write("decode_error", json.dumps({"rule": "decode_error",
+                                                    "data": base64.b64encode(data).decode()}))
+        if n <= LOG_FIRST or n % LOG_EVERY == 0:
+            self.logger.error("Message decode failed (#%d): %s", n, error)
+
+    def _write(self, rule, line):
+        # -> how many times rule has fired, this one included
+        with self.lock:
+            self.counts[rule] += 1
+            self.since_summary[rule] += 1
+            if self.file:
+                self.file.write(line + "\n")
+            return self.counts[rule]
+
+    def summary(self):
+        with self.lock:
+            recent = {r: n for r, n in self.since_summary.items() if n}
+            self.since_summary = dict.fromkeys(RULES, 0)
+            if self.file:
+                self.file.flush()
+        if recent:
+            self.logger.info("Rejected in the last %ds: %s (total %d)", self.summary_every,
+                             recent, sum(self.counts.values()))
+
+    def _summary_loop(self):
+        while not self.stopped.wait(self.summary_every):
+            self.summary()
+
+    def close(self):
+        self.stopped.set()
+        self.summary()
+        if self.file:
+            self.file.close()
+        totals = {r: n for r, n in self.counts.items() if n}
+        self.logger.info("Rejections by rule: %s", totals or "none")
@@ -0,0 +1,162 @@
+import collections
+import heapq
+import itertools
+import threading
+import time
+
+# holds each trip's breadcrumbs until its event-time watermark (the newest
+# ACT_TIME seen on the trip, minus LATENESS) passes them, then releases them
+# in ACT_TIME order, so speed and the inter-record checks see a trip in order
+# however Pub/Sub delivered it. held records keep their message un-acked, so
+# nothing is held longer than MAX_HOLD wall-clock seconds
+LATENESS = 60               # event-time seconds a record may arrive behind its trip
+MAX_HOLD = 20               # wall seconds before a held record is released anyway
+MAX_RECORDS = 200_000       # held across all trips; the longest-waiting trip goes first
+IDLE_TRIP = 3600            # forget an empty trip's release point after this long
+LATE_POLICIES = ("reject", "process")
+LATE_POLICY = "reject"      # arrived behind what was already released
+
+
+class TripBuffer:
+    __slots__ = ("heap", "newest", "released_upto", "first_held", "last_arrival")
+
+    def __init__(self):
+        self.heap = []              # (ACT_TIME, seq, arrival, rec, token)
+        self.newest = None          # max ACT_TIME seen
+        self.released_upto = None   # ACT_TIME of the last record released
+        self.first_held = None      # arrival (monotonic) of the oldest held record
+        self.last_arrival = None
+
+
+class ReorderBuffer:
+
+    def __init__(self, release, on_late, lateness=LATENESS, max_hold=MAX_HOLD,
+                 max_records=MAX_RECORDS, late_policy=LATE_POLICY):
+        self.release = release      # [(rec, token)] in order per trip; called under self.lock
+        self.on_late = on_late      # (rec, token) for late records under the "reject" policy
+        self.lateness = lateness
+        self.max_hold = max_hold
+        self.max_records = max_records
+        self.late_policy = late_policy
+        self.trips = {}
+        self.held = 0
+        self.seq = itertools.count()
+        self.lock = threading.RLock()   # also serializes everything release() does
+        self.late = 0
+        self.forced = 0             # released early by MAX_HOLD or MAX_RECORDS
+        self.rewinds = collections.deque()
+        self.stopped = threading.Event()
+        self.ticker = threading.Thread(target=self._tick_loop, daemon=True)
+        self.ticker.start()
+
+    def rewind(self, upto):
+        # {trip_id: ACT_TIME or None}: released records past these points
+        # weren't committed and will be redelivered, so they mustn't count as
+        # late. only queued here, and applied by the next add(): this runs on
+        # the sink's writer thread, which release() may be waiting on
+        self.rewinds.append(upto)
+
+    def add(self, items):
+        now = time.monotonic()
+        ready = []
+        with self.lock:
+            while self.rewinds:
+                for tid, act in self.rewinds.popleft().items():
+                    tb = self.trips.get(tid)
+                    if tb is not None and tb.released_upto is not None \
+                            and (act is None or act < tb.released_upto):
+                        tb.released_upto = act
+            touched = set()
+            for rec, token in items:
+                tid, act = rec.get("EVENT_NO_TRIP"), rec.get("ACT_TIME")
+                if tid is None or type(act) not in (int, float):
+                    ready.append((rec, token))     # can't be placed; validation rejects it
+                    continue
+                tb = self.trips.get(tid)
+                if tb is None:
+                    tb = self.trips[tid] = TripBuffer()
+                tb.last_arrival = now
+                if tb.released_upto is not None and act < tb.released_upto:
+                    self.late += 1
+                    if self.late_policy == "reject":
+                        self.on_late(rec, token)
+                    else:
+                        ready.append((rec, token))
+                    continue
+                heapq.heappush(tb.heap, (act, next(self.seq), now, rec, token))
+                self.held += 1
+                if tb.first_held is None:
+                    tb.first_held = now
+                if tb.newest is None or act > tb.newest:
+                    tb.newest = act
+                touched.add(tid)
+            for tid in touched:
+                tb = self.trips[tid]
+                ready.extend(self._pop(tb, tb.newest - self.lateness))
+            ready.extend(self._shed())
+            if ready:
+                self.release(ready)
+
+    def holds(self, trip_id, act_time) -> bool:
+        # a record of trip_id at act_time is waiting to be released
+        with self.lock:
+            tb = self.trips.get(trip_id)
+            return tb is not None and any(e[0] == act_time for e in tb.heap)
+
+    def _pop(self, tb, upto):
+        out = []
+        while tb.heap and tb.heap[0][0] <= upto:
+            act, _, _, rec, token = heapq.heappop(tb.heap)
+            tb.released_upto = act
+            out.append((rec, token))
+        self.held -= len(out)
+        tb.first_held = min((e[2] for e in tb.heap), default=None)
+        return out
+
+    def _shed(self):
+        # over MAX_RECORDS: flush whole trips, longest-waiting first
+        out = []
+        while self.held > self.max_records:
+            tb = min((t for t in self.trips.values() if t.heap), key=lambda t: t.first_held)
+            released = self._pop(tb, float("inf"))
+            self.forced += len(released)
+            out.extend(released)
+        return out
+
+    def poll(self):
+        # release what has waited MAX_HOLD, plus anything ordered before it,
+        # and forget trips that have gone quiet
+        now = time.monotonic()
+        ready = []
+        with self.lock:
+            for tid, tb in list(self.trips.items()):
+                if tb.first_held is not None and now - tb.first_held >= self.max_hold:
+                    upto = max(e[0] for e in tb.heap if now - e[2] >= self.max_hold)
+                    released = self._pop(tb, upto)
+                    self.forced += len(released)
+                    ready.extend(released)
+                elif not tb.heap and now - tb.last_arrival >= IDLE_TRIP:
+                    del self.trips[tid]
+            if ready:
+                self.release(ready)
+
+    def flush(self):
+        with self.lock:
+            ready = []
+            for tb in self.trips.values():
+                ready.extend(self._pop(tb, float("inf")))
+            if ready:
+                self.release(ready)
+
+    def _tick_loop(self):
+        while not self.stopped.wait(max(self.max_hold / 4, 0.05)):
+            self.poll()
+
+    def close(self):
+        self.stopped.set()
+        self.ticker.join()
+        self.flush()
+
+    def stats(self) -> dict:
+        return {"held": self.held, "trips": len(self.trips), "late": self.late,
+                "forced": self.forced}
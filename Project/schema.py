@@ -0,0 +1,312 @@
+import argparse
+import logging
+import re
+import threading
+from datetime import date, datetime, timedelta
+
+import psycopg2
+
+# BreadCrumb, range-partitioned by tstamp day (breadcrumb_pYYYYMMDD). indexes
+# are declared on the parent so every partition gets its own: BRIN on tstamp
+# (rows arrive roughly in time order, so it stays tiny), btree on trip_id and
+# the unique (trip_id, tstamp) the receiver dedups against. old days are
+# dropped (or detached) whole instead of DELETEd
+DAYS_AHEAD = 7          # partitions pre-created past today
+RETENTION_DAYS = 90     # days of BreadCrumb kept; 0 keeps everything
+PARTITION_PREFIX = "breadcrumb_p"
+LEGACY_TABLE = "breadcrumb_legacy"
+
+logger = logging.getLogger("schema")
+
+BOUND_RE = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+CREATE_TRIP = """
+    CREATE TABLE IF NOT EXISTS Trip (
+        trip_id     integer PRIMARY KEY,
+        route_id    integer,
+        vehicle_id  integer,
+        service_key text,
+        direction   text
+    )
+"""
+CREATE_BREADCRUMB = """
+    CREATE TABLE BreadCrumb (
+        tstamp      timestamp NOT NULL,
+        latitude    float,
+        longitude   float,
+        speed       float,
+        trip_id     integer REFERENCES Trip (trip_id),
+        meters      float
+    ) PARTITION BY RANGE (tstamp)
+"""
+# METERS came later; tables from before it get the column, NULL in old rows
+ADD_METERS = "ALTER TABLE {} ADD COLUMN IF NOT EXISTS meters float"
+# the plain table may hold repeated breadcrumbs, which the unique index on the
+# parent can't be built over once it's a partition: keep the first of each
+DELETE_DUPLICATES = """
+    DELETE FROM {0} WHERE ctid IN (
+        SELECT ctid FROM (
+            SELECT ctid, row_number() OVER (PARTITION BY trip_id, tstamp ORDER BY ctid) AS n
+            FROM {0} WHERE trip_id IS NOT NULL
+        ) d WHERE n > 1
+    )
+"""
+INDEXES = (
+    "CREATE INDEX IF NOT EXISTS breadcrumb_tstamp_brin ON BreadCrumb USING brin (tstamp)",
+    "CREATE INDEX IF NOT EXISTS breadcrumb_trip_id ON BreadCrumb (trip_id)",
+    "CREATE UNIQUE INDEX IF NOT EXISTS breadcrumb_trip_tstamp ON BreadCrumb (trip_id, tstamp)",
+)
+
+# running per-trip and per-vehicle-day aggregates, merged by BreadCrumbSink as
+# each batch commits (see db_sink.INSERT_WITH_SUMMARIES). mean speed is
+# speed_sum / breadcrumbs; the METERS span is meters_max - meters_min
+SUMMARY_COLUMNS = """
+        breadcrumbs  bigint NOT NULL,
+        speed_sum    float,
+        speed_min    float,
+        speed_max    float,
+        first_tstamp timestamp,
+        last_tstamp  timestamp,
+        meters_min   float,
+        meters_max   float
+"""
+CREATE_SUMMARIES = (
+    f"""
+    CREATE TABLE IF NOT EXISTS TripSummary (
+        trip_id      integer PRIMARY KEY,
+        vehicle_id   integer,{SUMMARY_COLUMNS}
+    )
+    """,
+    f"""
+    CREATE TABLE IF NOT EXISTS VehicleDaySummary (
+        vehicle_id   integer,
+        service_date date,{SUMMARY_COLUMNS},
+        PRIMARY KEY (vehicle_id, service_date)
+    )
+    """,
+)
+# rows stored before BreadCrumb had a meters column don't count towards the
+# meters span (min/max skip NULLs); a trip with only such rows keeps it NULL
+REBUILD_SUMMARIES = (
+    "TRUNCATE TripSummary, VehicleDaySummary",
+    """
+    INSERT INTO TripSummary
+    SELECT b.trip_id, min(t.vehicle_id), count(*), sum(b.speed), min(b.speed), max(b.speed),
+           min(b.tstamp), max(b.tstamp), min(b.meters), max(b.meters)
+    FROM BreadCrumb b JOIN Trip t ON t.trip_id = b.trip_id
+    GROUP BY b.trip_id
+    """,
+    """
+    INSERT INTO VehicleDaySummary
+    SELECT t.vehicle_id, b.tstamp::date, count(*), sum(b.speed), min(b.speed), max(b.speed),
+           min(b.tstamp), max(b.tstamp), min(b.meters), max(b.meters)
+    FROM BreadCrumb b JOIN Trip t ON t.trip_id = b.trip_id
+    WHERE t.vehicle_id IS NOT NULL
+    GROUP BY t.vehicle_id, b.tstamp::date
+    """,
+)
+
+
+def partition_name(day: date) -> str:
+    return f"{PARTITION_PREFIX}{day:%Y%m%d}"
+
+
+def table_kind(cur, name):
+    # 'p' partitioned, 'r' plain table, None if missing
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (name,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def list_partitions(cur):
+    # [(name, first day, day after last)]
+    cur.execute("""
+        SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass('breadcrumb')
+        """)
+    out = []
+    for name, bound in cur.fetchall():
+        m = BOUND_RE.search(bound or "")
+        if m:
+            lo, hi = (datetime.fromisoformat(v).date() for v in m.groups())
+            out.append((name, lo, hi))
+    return sorted(out, key=lambda p: p[1])
+
+
+def create_partition(cur, day: date):
+    cur.execute(f"""
+        CREATE TABLE IF NOT EXISTS {partition_name(day)} PARTITION OF BreadCrumb
+        FOR VALUES FROM (%s) TO (%s)
+        """, (day, day + timedelta(days=1)))
+
+
+def create_schema(conn, days_ahead=DAYS_AHEAD):
+    # idempotent. an existing plain BreadCrumb is kept: it's renamed and
+    # attached as one partition covering the days it already holds
+    with conn, conn.cursor() as cur:
+        cur.execute(CREATE_TRIP)
+        kind = table_kind(cur, "breadcrumb")
+        if kind == "r":
+            cur.execute(f"ALTER TABLE BreadCrumb RENAME TO {LEGACY_TABLE}")
+            cur.execute(f"SELECT min(tstamp)::date, max(tstamp)::date FROM {LEGACY_TABLE}")
+            lo, hi = cur.fetchone()
+            cur.execute("DROP INDEX IF EXISTS breadcrumb_trip_tstamp")
+            cur.execute(CREATE_BREADCRUMB)
+            if lo is not None:
+                cur.execute(f"ALTER TABLE {LEGACY_TABLE} ALTER COLUMN tstamp SET NOT NULL")
+                cur.execute(ADD_METERS.format(LEGACY_TABLE))
+                cur.execute(DELETE_DUPLICATES.format(LEGACY_TABLE))
+                if cur.rowcount:
+                    logger.warning("Deleted %d duplicate (trip_id, tstamp) rows from %s",
+                                   cur.rowcount, LEGACY_TABLE)
+                cur.execute(f"""
+                    ALTER TABLE BreadCrumb ATTACH PARTITION {LEGACY_TABLE}
+                    FOR VALUES FROM (%s) TO (%s)
+                    """, (lo, hi + timedelta(days=1)))
+                logger.info("Attached existing BreadCrumb rows (%s..%s) as %s", lo, hi, LEGACY_TABLE)
+            else:
+                cur.execute(f"DROP TABLE {LEGACY_TABLE}")
+        elif kind is None:
+            cur.execute(CREATE_BREADCRUMB)
+        for ddl in (ADD_METERS.format("BreadCrumb"),) + INDEXES + CREATE_SUMMARIES:
+            cur.execute(ddl)
+    precreate(conn, days_ahead)
+
+
+def rebuild_summaries(conn):
+    # regenerate both summaries from BreadCrumb in one transaction; writers
+    # merging at the same time wait on the TRUNCATE lock
+    with conn, conn.cursor() as cur:
+        for ddl in (ADD_METERS.format("BreadCrumb"),) + CREATE_SUMMARIES + REBUILD_SUMMARIES:
+            cur.execute(ddl)
+        cur.execute("SELECT count(*) FROM TripSummary")
+        trips = cur.fetchone()[0]
+    logger.info("Rebuilt summaries for %d trips", trips)
+    return trips
+
+
+def precreate(conn, days_ahead=DAYS_AHEAD, today=None):
+    today = today or date.today()
+    with conn, conn.cursor() as cur:
+        covered = list_partitions(cur)
+        for n in range(days_ahead + 1):
+            day = today + timedelta(days=n)
+            if not any(lo <= day < hi for _, lo, hi in covered):
+                create_partition(cur, day)
+
+
+def apply_retention(conn, retention_days=RETENTION_DAYS, detach=False, today=None):
+    # whole partitions whose last day is older than the window
+    if retention_days <= 0:
+        return []
+    cutoff = (today or date.today()) - timedelta(days=retention_days)
+    removed = []
+    with conn, conn.cursor() as cur:
+        for name, _, hi in list_partitions(cur):
+            if hi > cutoff:
+                continue
+            if detach:
+                cur.execute(f"ALTER TABLE BreadCrumb DETACH PARTITION {name}")
+            else:
+                cur.execute(f"DROP TABLE {name}")
+            removed.append(name)
+    for name in removed:
+        logger.info("%s partition %s", "Detached" if detach else "Dropped", name)
+    return removed
+
+
+class Partitions:
+    # used by BreadCrumbSink: makes sure a day's partition exists before rows
+    # for it are copied in, so writers never have to know about partitioning
+
+    def __init__(self, connect):
+        self.connect = connect
+        self.enabled = False
+        self.days = set()   # days known to be covered
+        self.lock = threading.Lock()
+
+    def load(self, days_ahead=DAYS_AHEAD):
+        conn = self.connect()
+        try:
+            with conn.cursor() as cur:
+                self.enabled = table_kind(cur, "breadcrumb") == "p"
+            if not self.enabled:
+                logger.warning("BreadCrumb is not partitioned (run schema.py create); "
+                               "writing to it as a plain table")
+                return self
+            try:
+                precreate(conn, days_ahead)
+            except psycopg2.Error as e:
+                # another writer pre-creating the same days; ensure() retries
+                logger.warning("Pre-creating partitions failed: %s", e)
+            with conn.cursor() as cur:
+                self._remember(list_partitions(cur))
+        finally:
+            conn.close()
+        return self
+
+    def _remember(self, partitions):
+        for _, lo, hi in partitions:
+            # legacy partitions can span years; only remember recent days
+            lo = max(lo, hi - timedelta(days=366))
+            self.days.update(lo + timedelta(days=n) for n in range((hi - lo).days))
+
+    def ensure(self, conn, days):
+        if not self.enabled:
+            return
+        with self.lock:
+            missing = set(days) - self.days
+            if not missing:
+                return
+            with conn, conn.cursor() as cur:   # own short transaction
+                covered = list_partitions(cur)
+                for day in sorted(missing):
+                    if not any(lo <= day < hi for _, lo, hi in covered):
+                        create_partition(cur, day)
+                        logger.info("Created partition %s", partition_name(day))
+                self._remember(list_partitions(cur))
+            self.days.update(missing)
+
+
+def initialize():
+    parser = argparse.ArgumentParser(description="BreadCrumb partition management")
+    parser.add_argument("action", choices=("create", "maintain", "rebuild-summaries"),
+                        help="create: tables, indexes and partitions (migrates a plain "
+                             "BreadCrumb); maintain: pre-create partitions and apply retention; "
+                             "rebuild-summaries: regenerate TripSummary/VehicleDaySummary")
+    parser.add_argument("--days-ahead", type=int, default=DAYS_AHEAD)
+    parser.add_argument("--retention-days", type=int, default=RETENTION_DAYS,
+                        help="0 keeps every partition")
+    parser.add_argument("--detach", action="store_true",
+                        help="detach expired partitions instead of dropping them")
+    return parser.parse_args()
+
+
+def main():
+    import part2_receiver   # DB_CONFIG
+
+    args = initialize()
+    conn = psycopg2.connect(**part2_receiver.DB_CONFIG)
+    try:
+        if args.action == "rebuild-summaries":
+            rebuild_summaries(conn)
+            return
+        if args.action == "create":
+            create_schema(conn, args.days_ahead)
+        else:
+            precreate(conn, args.days_ahead)
+        apply_retention(conn, args.retention_days, args.detach)
+        with conn.cursor() as cur:
+            partitions = list_partitions(cur)
+        logger.info("%d BreadCrumb partitions, %s .. %s", len(partitions),
+                    partitions[0][1] if partitions else "-", partitions[-1][2] if partitions else "-")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO,
+                        format="[%(asctime)s] %(levelname)s:%(name)s: %(message)s")
+    main()
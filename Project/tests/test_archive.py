@@ -0,0 +1,38 @@
+import time
+
+import pytest
+
+pytest.importorskip("pyarrow")
+
+import archive
+
+REC = {"VEHICLE_ID": 3001, "EVENT_NO_TRIP": 7, "EVENT_NO_STOP": 1, "OPD_DATE": "01JAN2023:00:00:00",
+       "ACT_TIME": 5, "METERS": 100, "GPS_LATITUDE": 45.5, "GPS_LONGITUDE": -122.6,
+       "GPS_SATELLITES": 10, "GPS_HDOP": 1.0}
+
+
+def parts(root):
+    return sorted(root.glob("service_date=*/vehicle=*/part-*.parquet"))
+
+
+def test_idle_partition_is_flushed_by_age(tmp_path):
+    sink = archive.ParquetArchive(str(tmp_path), max_age=0.2)
+    try:
+        sink.add(3001, REC)
+        deadline = time.monotonic() + 5
+        while not parts(tmp_path):
+            assert time.monotonic() < deadline, "aged partition never flushed"
+            time.sleep(0.05)
+        assert not sink.buffers
+    finally:
+        sink.close()
+
+
+def test_round_trip(tmp_path):
+    sink = archive.ParquetArchive(str(tmp_path), max_age=0)
+    sink.write_records(3001, [dict(REC, ACT_TIME=5 * i) for i in range(10)])
+    assert not parts(tmp_path)
+    sink.close()
+    df = archive.read_archive(str(tmp_path), columns=["EVENT_NO_TRIP", "ACT_TIME"],
+                              dates=["2023-01-01"])
+    assert sorted(df["ACT_TIME"]) == [5 * i for i in range(10)]
@@ -0,0 +1,58 @@
+import asyncio
+import json
+
+import pytest
+
+httpx = pytest.importorskip("httpx")
+
+import async_fetch
+
+RECORDS = [{"EVENT_NO_TRIP": 7, "ACT_TIME": 5 * i} for i in range(50)]
+
+
+def stream(body, on_records, on_error):
+    async def run():
+        async def chunks():
+            for i in range(0, len(body), 64):
+                yield body[i:i + 64]
+
+        transport = httpx.MockTransport(lambda request: httpx.Response(200, content=chunks()))
+        async with httpx.AsyncClient(transport=transport) as client:
+            await async_fetch.stream_vehicle(client, asyncio.Semaphore(1),
+                                             async_fetch.HostRateLimiter(0), 3001,
+                                             on_records, on_error, base_url="http://test/")
+    asyncio.run(run())
+
+
+def test_stream_delivers_every_record():
+    got, errors = [], []
+    stream(json.dumps(RECORDS).encode(), lambda vid, recs: got.extend(recs),
+           lambda vid, e: errors.append(e))
+    assert got == RECORDS and not errors
+
+
+def test_truncated_stream_reports_an_error():
+    got, errors = [], []
+    body = json.dumps(RECORDS).encode()
+    stream(body[:len(body) // 2], lambda vid, recs: got.extend(recs),
+           lambda vid, e: errors.append(e))
+    assert len(errors) == 1 and isinstance(errors[0], ValueError)
+    assert got == RECORDS[:len(got)] and len(got) < len(RECORDS)
+
+
+def test_callback_errors_are_not_parse_errors():
+    errors = []
+
+    def on_records(vid, recs):
+        raise ValueError("bug in the callback")
+
+    with pytest.raises(ValueError, match="bug in the callback"):
+        stream(json.dumps(RECORDS).encode(), on_records, lambda vid, e: errors.append(e))
+    assert not errors
+
+
+def test_json_array_stream_split_anywhere():
+    text = json.dumps([{"a": 1.25}, 4.5, "x", [1, 2]])
+    for cut in range(len(text)):
+        d = async_fetch.JsonArrayStream()
+        assert d.feed(text[:cut]) + d.feed(text[cut:]) + d.close() == json.loads(text)
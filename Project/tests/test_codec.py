@@ -0,0 +1,52 @@
+import json
+
+import pytest
+
+import codec
+
+REC = {"EVENT_NO_TRIP": 123456789, "EVENT_NO_STOP": 987654321, "OPD_DATE": "31DEC2022:00:00:00",
+       "VEHICLE_ID": 3001, "METERS": 4521, "ACT_TIME": 3600, "GPS_LONGITUDE": -122.6765,
+       "GPS_LATITUDE": 45.5231, "GPS_SATELLITES": 12, "GPS_HDOP": 0.8}
+
+
+@pytest.mark.parametrize("fmt", codec.FORMATS)
+def test_single_record_round_trip(fmt):
+    data, attrs = codec.encode_message(REC, fmt, vehicle_id=3001)
+    assert codec.decode_message(data, attrs) == [REC]
+    assert attrs[codec.ENCODING_ATTR] == fmt and attrs["vehicle_id"] == "3001"
+
+
+@pytest.mark.parametrize("fmt", codec.FORMATS)
+def test_envelope_round_trip_keeps_nulls(fmt):
+    records = [dict(REC, ACT_TIME=REC["ACT_TIME"] + i) for i in range(5)]
+    records[2]["GPS_HDOP"] = None
+    records[3]["OPD_DATE"] = None
+    data = codec.pack_envelope([codec.encode_record(r, fmt) for r in records], fmt)
+    assert codec.decode_message(data, codec.message_attributes(fmt, len(records))) == records
+
+
+def test_messages_without_attributes_are_single_json_records():
+    assert codec.decode_message(json.dumps(REC).encode()) == [REC]
+
+
+@pytest.mark.parametrize("change", [
+    {"OPD_DATE": 20221231},             # not a string
+    {"OPD_DATE": "31DEC2022:13:45:00"}, # has a time part
+    {"OPD_DATE": "yesterday"},
+    {"METERS": 12.5},
+    {"VEHICLE_ID": "3001"},
+    {"EXTRA": 1},
+])
+def test_records_that_dont_fit_fall_back_to_json(change):
+    rec = dict(REC, **change)
+    with pytest.raises(codec.EncodeError):
+        codec.encode_record(rec, codec.FORMAT_BINARY)
+    data, attrs = codec.encode_message(rec, codec.FORMAT_BINARY)
+    assert attrs[codec.ENCODING_ATTR] == codec.FORMAT_JSON
+    assert codec.decode_message(data, attrs) == [rec]
+
+
+def test_truncated_binary_is_rejected():
+    data, attrs = codec.encode_message(REC, codec.FORMAT_BINARY)
+    with pytest.raises(ValueError):
+        codec.decode_message(data[:-1], attrs)
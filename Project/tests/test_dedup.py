@@ -0,0 +1,59 @@
+import dedup
+
+OPD = "01JAN2023:00:00:00"
+
+
+def rec(act, trip=7):
+    return {"VEHICLE_ID": 3001, "EVENT_NO_TRIP": trip, "OPD_DATE": OPD, "ACT_TIME": act}
+
+
+class Confirm:
+    # stands in for the receiver's lookup: indexes of records whose key is "known"
+
+    def __init__(self, known=()):
+        self.known = set(known)
+        self.asked = []
+
+    def __call__(self, records):
+        self.asked.append(len(records))
+        return {i for i, r in enumerate(records) if dedup.record_key(r) in self.known}
+
+
+def test_new_records_pass_without_a_lookup():
+    confirm = Confirm()
+    d = dedup.Deduplicator(confirm, capacity=1000)
+    fresh, dropped = d.filter([rec(5 * i) for i in range(10)])
+    assert len(fresh) == 10 and dropped == 0
+    assert confirm.asked == []
+
+
+def test_repeats_within_a_message_are_dropped():
+    d = dedup.Deduplicator(Confirm(), capacity=1000)
+    fresh, dropped = d.filter([rec(5), rec(5), rec(10)])
+    assert [r["ACT_TIME"] for r in fresh] == [5, 10] and dropped == 1
+
+
+def test_confirmed_hits_are_dropped_and_unconfirmed_pass():
+    confirm = Confirm()
+    d = dedup.Deduplicator(confirm, capacity=1000)
+    d.filter([rec(5), rec(10)])
+    confirm.known = {dedup.record_key(rec(5))}
+    fresh, dropped = d.filter([rec(5), rec(10), rec(15)])
+    assert [r["ACT_TIME"] for r in fresh] == [10, 15] and dropped == 1
+    assert confirm.asked == [2]
+    stats = d.stats()
+    assert stats["duplicates"] == 1 and stats["unconfirmed"] == 1
+
+
+def test_records_without_a_key_are_left_to_validation():
+    d = dedup.Deduplicator(Confirm(), capacity=1000)
+    fresh, dropped = d.filter([rec(None), rec(None)])
+    assert len(fresh) == 2 and dropped == 0
+
+
+def test_rotation_forgets_the_oldest_generation():
+    bloom = dedup.RotatingBloom(capacity=10, error_rate=0.01, generations=2)
+    for i in range(30):
+        bloom.add(("k", i))
+    assert bloom.rotations == 2 and len(bloom.generations) == 2
+    assert all(("k", i) in bloom for i in range(10, 30))
@@ -0,0 +1,201 @@
+import logging
+import time
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("psycopg2")
+
+import codec
+import db_sink
+import dedup
+import part2_receiver as receiver
+import rejects as rejections
+import reorder
+import trip_state
+
+OPD = "01JAN2023:00:00:00"
+
+
+class FakePool:
+
+    def prepare(self, name, sql, types=()):
+        pass
+
+    def run(self, fn):
+        return fn(None)
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+class MemorySink(db_sink.BreadCrumbSink):
+    # BreadCrumb as a dict keyed like the unique index; the next `fail`
+    # batches raise as if the database went away
+
+    def __init__(self, **hooks):
+        self.stored = {}
+        self.fail = 0
+        super().__init__(FakePool(), flush_rows=100_000, linger=3600, **hooks)
+
+    def existing(self, keys):
+        return {k for k in keys if k in self.stored}
+
+    def _write_batch(self, conn, batch):
+        if self.fail:
+            self.fail -= 1
+            raise RuntimeError("server closed the connection unexpectedly")
+        inserted = 0
+        for row in batch.rows:
+            if (row[4], row[0]) not in self.stored:
+                self.stored[(row[4], row[0])] = row
+                inserted += 1
+        return inserted
+
+
+class Message:
+
+    def __init__(self):
+        self.acks = 0
+        self.nacks = 0
+
+    def ack(self):
+        self.acks += 1
+
+    def nack(self):
+        self.nacks += 1
+
+
+def breadcrumbs(trip, start, n):
+    return [{"VEHICLE_ID": 3001, "EVENT_NO_TRIP": trip, "EVENT_NO_STOP": 1, "OPD_DATE": OPD,
+             "ACT_TIME": start + 5 * i, "METERS": 100 + 50 * (start // 5 + i),
+             "GPS_LATITUDE": 45.5, "GPS_LONGITUDE": -122.6, "GPS_SATELLITES": 10,
+             "GPS_HDOP": 1.0} for i in range(n)]
+
+
+def deliver(sink, records):
+    message = Message()
+    receiver.process_records([dict(r) for r in records], message)
+    receiver.reorderer.flush()
+    sink.flush()
+    deadline = time.monotonic() + 5
+    while not (message.acks or message.nacks):
+        assert time.monotonic() < deadline, "message never settled"
+        time.sleep(0.01)
+    return message
+
+
+@pytest.fixture
+def sink(tmp_path, monkeypatch):
+    rejects = rejections.Rejects(str(tmp_path / "rejected.jsonl"), logging.getLogger("test"))
+    monkeypatch.setattr(receiver, "rejects", rejects)
+    monkeypatch.setattr(receiver, "previous_records",
+                        trip_state.TripStateStore(str(tmp_path / "trip_state.db")))
+    monkeypatch.setattr(receiver, "retrying", db_sink.KnownTrips(1000, 3600))
+    monkeypatch.setattr(receiver, "redelivered", 0)
+    sink = MemorySink(on_commit=receiver.committed, on_fail=receiver.failed)
+    monkeypatch.setattr(receiver, "sink", sink)
+    monkeypatch.setattr(receiver, "deduper", dedup.Deduplicator(receiver.stored_duplicates, 10_000))
+    # lateness 0: every record is released as soon as it arrives
+    monkeypatch.setattr(receiver, "reorderer", reorder.ReorderBuffer(
+        receiver.process_items, receiver.reject_late, lateness=0, max_hold=60))
+    yield sink
+    receiver.reorderer.close()
+    sink.close()
+    rejects.close()
+
+
+@pytest.mark.parametrize("n", [5, 100])     # per-record and vectorized paths
+def test_failed_batch_lands_when_redelivered(sink, n):
+    records = breadcrumbs(7, 0, n)
+    sink.fail = 1
+    first = deliver(sink, records)
+    assert (first.acks, first.nacks) == (0, 1)
+    assert not sink.stored
+
+    again = deliver(sink, records)
+    assert (again.acks, again.nacks) == (1, 0)
+    assert len(sink.stored) == n
+    assert sum(receiver.rejects.counts.values()) == 0
+
+
+def test_failed_batch_lands_after_a_later_one_commits(sink):
+    sink.fail = 1
+    first = deliver(sink, breadcrumbs(7, 0, 5))
+    later = deliver(sink, breadcrumbs(7, 25, 5))
+    assert first.nacks == 1 and later.acks == 1
+
+    again = deliver(sink, breadcrumbs(7, 0, 5))
+    assert again.acks == 1
+    assert len(sink.stored) == 10
+    assert sum(receiver.rejects.counts.values()) == 0
+
+
+def test_committed_records_redelivered_after_restart(sink, tmp_path, monkeypatch):
+    records = breadcrumbs(7, 0, 5)
+    assert deliver(sink, records).acks == 1
+    receiver.previous_records.checkpoint()
+    # a restart: state comes back from the checkpoint, the Bloom filter empty
+    receiver.reorderer.close()
+    monkeypatch.setattr(receiver, "previous_records",
+                        trip_state.TripStateStore(str(tmp_path / "trip_state.db")))
+    monkeypatch.setattr(receiver, "deduper", dedup.Deduplicator(receiver.stored_duplicates, 10_000))
+    monkeypatch.setattr(receiver, "reorderer", reorder.ReorderBuffer(
+        receiver.process_items, receiver.reject_late, lateness=0, max_hold=60))
+
+    assert deliver(sink, records).acks == 1
+    assert len(sink.stored) == 5
+    assert sum(receiver.rejects.counts.values()) == 0
+    assert receiver.redelivered == 5
+
+
+def test_checkpoint_holds_committed_state_only(sink, tmp_path):
+    sink.fail = 1
+    deliver(sink, breadcrumbs(7, 0, 5))
+    deliver(sink, breadcrumbs(8, 0, 5))
+    receiver.previous_records.checkpoint()
+    restored = trip_state.TripStateStore(str(tmp_path / "trip_state.db"))
+    assert restored.get(7) is None
+    assert restored.get(8).act_time == 20
+
+
+def test_duplicate_of_a_buffered_record_is_confirmed(sink):
+    records = breadcrumbs(7, 0, 5)
+    receiver.process_records([dict(r) for r in records], Message())
+    receiver.reorderer.flush()      # buffered in the sink, not written yet
+    receiver.process_records([dict(r) for r in records], Message())
+    stats = receiver.deduper.stats()
+    assert stats["duplicates"] == 5 and stats["unconfirmed"] == 0
+
+
+class HeldArchive:
+    # the archive writer with its lines queued until the test says they're on disk
+
+    def __init__(self):
+        self.on_durable = []
+
+    def write(self, message_id, records, on_durable=None):
+        self.on_durable.append(on_durable)
+
+
+@pytest.mark.parametrize("durable", [True, False])
+def test_message_waits_for_its_archive_lines(sink, monkeypatch, durable):
+    archive = HeldArchive()
+    monkeypatch.setattr(receiver, "archiver", archive)
+    message = Message()
+    message.message_id = "1"
+    message.data, message.attributes = codec.encode_message(breadcrumbs(7, 0, 1)[0])
+    receiver.callback(message)
+    receiver.reorderer.flush()
+    sink.flush()
+    deadline = time.monotonic() + 5
+    while not sink.stored:
+        assert time.monotonic() < deadline, "record never committed"
+        time.sleep(0.01)
+    time.sleep(0.05)
+    assert (message.acks, message.nacks) == (0, 0)
+    archive.on_durable[0](durable)
+    assert (message.acks, message.nacks) == ((1, 0) if durable else (0, 1))
@@ -0,0 +1,29 @@
+import json
+import logging
+
+import pytest
+
+import rejects as rejections
+
+
+@pytest.fixture
+def rejects(tmp_path):
+    r = rejections.Rejects(str(tmp_path / "rejected.jsonl"), logging.getLogger("test"))
+    yield r
+    r.close()
+
+
+def lines(rejects):
+    rejects.file.flush()
+    with open(rejects.path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+def test_decode_errors_are_logged_as_a_sample(rejects, caplog, monkeypatch):
+    monkeypatch.setattr(rejections, "LOG_EVERY", 10)
+    with caplog.at_level(logging.ERROR, logger="test"):
+        for _ in range(30):
+            rejects.reject_message(b"\xff", ValueError("bad envelope"))
+    assert rejects.counts["decode_error"] == 30
+    assert len(lines(rejects)) == 30
+    assert len(caplog.records) == rejections.LOG_FIRST + 3     # then #10, #20 and #30
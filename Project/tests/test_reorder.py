@@ -0,0 +1,112 @@
+import time
+
+import pytest
+
+import reorder
+
+
+def rec(act, trip=7):
+    return {"EVENT_NO_TRIP": trip, "ACT_TIME": act}
+
+
+class Collector:
+
+    def __init__(self):
+        self.released = []
+        self.late = []
+
+    def release(self, items):
+        self.released.extend(r["ACT_TIME"] for r, _ in items)
+
+    def on_late(self, r, token):
+        self.late.append(r["ACT_TIME"])
+
+
+@pytest.fixture
+def out():
+    return Collector()
+
+
+def buffer(out, **kwargs):
+    kwargs.setdefault("max_hold", 3600)
+    return reorder.ReorderBuffer(out.release, out.on_late, **kwargs)
+
+
+def add(buf, *acts, trip=7):
+    buf.add([(rec(a, trip), None) for a in acts])
+
+
+def test_released_in_order_once_the_watermark_passes(out):
+    buf = buffer(out, lateness=60)
+    add(buf, 30, 10, 20)
+    assert out.released == []
+    assert buf.holds(7, 10) and not buf.holds(7, 15)
+    add(buf, 85)                    # watermark 25
+    assert out.released == [10, 20]
+    buf.close()
+    assert out.released == [10, 20, 30, 85]
+    assert buf.stats()["held"] == 0
+
+
+def test_trips_are_ordered_independently(out):
+    buf = buffer(out, lateness=0)
+    add(buf, 50, trip=1)
+    add(buf, 10, trip=2)
+    assert out.released == [50, 10]
+    buf.close()
+
+
+def test_late_record_is_rejected(out):
+    buf = buffer(out, lateness=0)
+    add(buf, 10, 20)
+    add(buf, 15)
+    assert out.released == [10, 20] and out.late == [15]
+    assert buf.stats()["late"] == 1
+    buf.close()
+
+
+def test_late_record_is_processed_under_the_process_policy(out):
+    buf = buffer(out, lateness=0, late_policy="process")
+    add(buf, 10, 20)
+    add(buf, 15)
+    assert out.released == [10, 20, 15] and out.late == []
+    buf.close()
+
+
+def test_rewound_trip_takes_its_records_again(out):
+    buf = buffer(out, lateness=0)
+    add(buf, 10, 20)
+    buf.rewind({7: 10})             # 20 didn't commit and comes back
+    add(buf, 20)
+    assert out.released == [10, 20, 20] and out.late == []
+    buf.rewind({7: None})
+    add(buf, 10)
+    assert out.late == []
+    buf.close()
+
+
+def test_over_max_records_the_longest_waiting_trip_goes_first(out):
+    buf = buffer(out, lateness=1000, max_records=3)
+    add(buf, 10, 20, trip=1)
+    add(buf, 5, 6, trip=2)
+    assert out.released == [10, 20]
+    assert buf.stats()["forced"] == 2 and buf.stats()["held"] == 2
+    buf.close()
+
+
+def test_held_past_max_hold_is_released(out):
+    buf = buffer(out, lateness=1000, max_hold=0.05)
+    add(buf, 20, 10)
+    deadline = time.monotonic() + 5
+    while out.released != [10, 20]:
+        assert time.monotonic() < deadline, "held records never released"
+        time.sleep(0.02)
+    assert buf.stats()["forced"] == 2
+    buf.close()
+
+
+def test_unplaceable_records_pass_straight_through(out):
+    buf = buffer(out, lateness=1000)
+    add(buf, None, "12")
+    assert out.released == [None, "12"]
+    buf.close()
@@ -0,0 +1,84 @@
+import threading
+import time
+
+import pytest
+
+import transport
+
+
+def publish(tmp_path, n):
+    pub = transport.open_transport("local", topic_path="t", directory=str(tmp_path))
+    futures = [pub.publish(b"%d" % i, seq=str(i)) for i in range(n)]
+    pub.flush()
+    ends = [int(fu.result(5)) for fu in futures]
+    pub.close()
+    return ends
+
+
+def subscribe(tmp_path, callback):
+    sub = transport.open_transport("local", topic_path="t", subscription_path="s",
+                                   directory=str(tmp_path))
+    return sub.subscribe(callback)
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.02)
+
+
+def test_messages_arrive_in_order_with_attributes(tmp_path):
+    publish(tmp_path, 20)
+    got = []
+    handle = subscribe(tmp_path, lambda m: (got.append((m.data, m.attributes["seq"])), m.ack()))
+    wait_for(lambda: len(got) == 20)
+    handle.cancel()
+    assert got == [(b"%d" % i, str(i)) for i in range(20)]
+
+
+def test_nacked_window_is_redelivered_once_acks_resume(tmp_path, monkeypatch):
+    # every message nacked (the database is down) until a full window of them
+    # is outstanding; the subscription must keep redelivering, not stall
+    monkeypatch.setattr(transport, "LOCAL_MAX_OUTSTANDING", 50)
+    publish(tmp_path, 200)
+    healthy = threading.Event()
+    acked = set()
+    lock = threading.Lock()
+
+    def callback(message):
+        if not healthy.is_set():
+            message.nack()
+            return
+        with lock:
+            acked.add(message.data)
+        message.ack()
+
+    handle = subscribe(tmp_path, callback)
+    time.sleep(1.0)
+    assert not acked
+    healthy.set()
+    wait_for(lambda: len(acked) == 200)
+    wait_for(lambda: not handle.inflight)
+    handle.cancel()
+    assert handle.committed == (tmp_path / "t.log").stat().st_size
+
+
+def test_unacked_messages_are_redelivered_after_a_restart(tmp_path):
+    publish(tmp_path, 10)
+    first = []
+
+    def ack_first_five(message):
+        first.append(message.data)
+        if len(first) <= 5:
+            message.ack()
+
+    handle = subscribe(tmp_path, ack_first_five)
+    wait_for(lambda: len(first) == 10)
+    handle.cancel()
+
+    again = []
+    handle = subscribe(tmp_path, lambda m: (again.append(m.data), m.ack()))
+    wait_for(lambda: len(again) == 5)
+    handle.cancel()
+    assert again == [b"%d" % i for i in range(5, 10)]
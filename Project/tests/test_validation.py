@@ -0,0 +1,122 @@
+import copy
+import json
+import logging
+import random
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("psycopg2")
+
+import part2_receiver as receiver
+import rejects as rejections
+import trip_state
+
+DAY, NEXT_DAY = "15FEB2023:00:00:00", "16FEB2023:00:00:00"
+
+
+class RowSink:
+
+    def __init__(self):
+        self.rows = []
+        self.marks = []
+
+    def add(self, trip_id, vehicle_id, row, token, mark=None):
+        self.rows.append(row)
+        self.marks.append(mark)
+
+    def existing(self, keys):
+        return set()
+
+
+class Token:
+
+    def __init__(self):
+        self.done_calls = 0
+
+    def done(self, ok=True):
+        self.done_calls += 1
+
+
+def random_record(rng):
+    # mostly valid breadcrumbs on a handful of trips, with every assertion
+    # broken now and then: bad and missing fields, NaNs, out-of-range values,
+    # time going backwards, a second service day
+    rec = {"EVENT_NO_TRIP": rng.choice([1, 2, 3, 4, 5]), "EVENT_NO_STOP": 1,
+           "OPD_DATE": rng.choice([DAY] * 8 + [NEXT_DAY, "BADDATE"]),
+           "VEHICLE_ID": 3000,
+           "METERS": rng.choice([0, rng.randint(0, 3000), rng.randint(0, 3000)]),
+           "ACT_TIME": rng.choice([rng.randint(0, 400), rng.randint(0, 400), -1, 90000,
+                                   rng.uniform(0, 400)]),
+           "GPS_LATITUDE": rng.choice([45.5, 45.5, 44.0, float("nan")]),
+           "GPS_LONGITUDE": rng.choice([-122.6] * 5 + [-121.0]),
+           "GPS_SATELLITES": rng.choice([None, 10, 10, 2, float("nan")]),
+           "GPS_HDOP": rng.choice([None, 1.0, 1.0, 0, 11, float("nan")])}
+    for field in list(rec):
+        if rng.random() < 0.02:
+            rec[field] = None
+        if rng.random() < 0.01:
+            del rec[field]
+    return rec
+
+
+def run(batches, state, vectorized, monkeypatch):
+    store = trip_state.TripStateStore(None)
+    for trip_id, (act, meters, opd) in state.items():
+        store.put(trip_id, act, meters, opd)
+    monkeypatch.setattr(receiver, "previous_records", store)
+    monkeypatch.setattr(receiver, "rejects",
+                        rejections.Rejects(None, logging.getLogger("test"), summary_every=1e9))
+    monkeypatch.setattr(receiver, "sink", RowSink())
+    monkeypatch.setattr(receiver, "retrying", None)
+    monkeypatch.setattr(receiver, "days_with_trip", set())
+    token = Token()
+    for batch in copy.deepcopy(batches):
+        if vectorized:
+            receiver.process_batch([(rec, token) for rec in batch])
+        else:
+            for rec in batch:
+                if not receiver.process_record(rec, token):
+                    token.done()
+    trips = {k: (v.act_time, v.meters, v.opd_date) for k, v in store.trips.items()}
+    return (receiver.sink.rows, receiver.sink.marks, token.done_calls, trips,
+            dict(receiver.rejects.counts), receiver.days_with_trip)
+
+
+@pytest.mark.parametrize("seeds", [range(0, 100), range(100, 200), range(200, 300)])
+def test_vectorized_path_matches_per_record(seeds, monkeypatch):
+    for seed in seeds:
+        rng = random.Random(seed)
+        batches = [[random_record(rng) for _ in range(rng.randint(1, 80))]
+                   for _ in range(rng.randint(1, 3))]
+        state = {t: (rng.randint(0, 200), rng.randint(0, 1500), rng.choice([DAY, "14FEB2023:00:00:00"]))
+                 for t in range(1, 6) if rng.random() < 0.5}
+        expected = run(batches, state, False, monkeypatch)
+        assert run(batches, state, True, monkeypatch) == expected, f"seed {seed}"
+
+
+def test_clean_batch_is_accepted_whole(monkeypatch):
+    batch = [{"EVENT_NO_TRIP": 1, "EVENT_NO_STOP": 1, "OPD_DATE": DAY, "VEHICLE_ID": 3000,
+              "METERS": 10 * i, "ACT_TIME": 5 * i, "GPS_LATITUDE": 45.5,
+              "GPS_LONGITUDE": -122.6, "GPS_SATELLITES": 10, "GPS_HDOP": 1.0}
+             for i in range(100)]
+    rows, marks, done, trips, counts, _ = run([batch], {}, True, monkeypatch)
+    assert len(rows) == 100 and done == 0
+    assert sum(counts.values()) == 0
+    assert trips[1] == (495, 990, DAY) and marks[-1] == (495, 990, DAY)
+
+
+def test_speed_rejection_dead_letters_the_record_as_received(tmp_path, monkeypatch):
+    rejects = rejections.Rejects(str(tmp_path / "rejected.jsonl"), logging.getLogger("test"))
+    monkeypatch.setattr(receiver, "rejects", rejects)
+    monkeypatch.setattr(receiver, "previous_records", trip_state.TripStateStore(None))
+    monkeypatch.setattr(receiver, "sink", RowSink())
+    monkeypatch.setattr(receiver, "retrying", None)
+    first = {"EVENT_NO_TRIP": 1, "EVENT_NO_STOP": 1, "OPD_DATE": DAY, "VEHICLE_ID": 3000,
+             "METERS": 10, "ACT_TIME": 5, "GPS_LATITUDE": 45.5, "GPS_LONGITUDE": -122.6}
+    too_fast = dict(first, METERS=5000, ACT_TIME=10)
+    assert receiver.process_record(dict(first), Token())
+    assert not receiver.process_record(dict(too_fast), Token())
+    rejects.close()
+    with open(tmp_path / "rejected.jsonl", encoding="utf-8") as f:
+        assert [json.loads(line) for line in f] == [{"rule": "speed_too_high", "rec": too_fast}]
@@ -0,0 +1,428 @@
+import abc
+import fcntl
+import glob
+import os
+import socket
+import struct
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError
+
+# message transport used by the fetchers, publishers and receivers.
+# both backends expose the same operations:
+#   publish(data, ordering_key="", **attrs) -> future resolving to a message id
+#   publish_batch([(data, attrs), ...])     -> [futures]
+#   subscribe(callback, max_workers=None)   -> handle with result()/cancel()
+#   message.ack() / message.nack()          on whatever the callback receives
+#   flush() / close()
+# the backend is picked by BREADCRUMB_TRANSPORT (pubsub | local) unless the
+# caller passes one explicitly
+BACKENDS = ("pubsub", "local")
+BACKEND = os.environ.get("BREADCRUMB_TRANSPORT", "pubsub")
+LOCAL_DIR = os.environ.get("BREADCRUMB_LOCAL_DIR", "local_transport")
+
+# Pub/Sub client-side batching / flow control
+BATCH_MAX_MESSAGES = 100
+BATCH_MAX_BYTES = 4_000_000
+BATCH_MAX_LATENCY = 0.05        # seconds
+FLOW_MAX_MESSAGES = 1000
+FLOW_MAX_BYTES = 64_000_000
+
+# local backend: publishers group-append frames to <dir>/<topic>.log
+LOCAL_MAX_BATCH_BYTES = 1 << 20
+LOCAL_MAX_LATENCY = 0.005       # seconds
+LOCAL_READ_SIZE = 1 << 20
+LOCAL_MAX_OUTSTANDING = 10_000  # delivered but unacked messages per subscriber
+FRAME = struct.Struct("<IH")    # data length, attributes length
+ATTR_SEP, KV_SEP = "\x1f", "\x1e"
+
+
+def open_transport(backend=None, topic_path=None, subscription_path=None, **settings):
+    backend = backend or BACKEND
+    if backend == "pubsub":
+        return PubSubTransport(topic_path, subscription_path, **settings)
+    if backend == "local":
+        return LocalTransport(topic_path, subscription_path, **settings)
+    raise ValueError(f"unknown transport backend {backend!r}, expected one of {BACKENDS}")
+
+
+class Transport(abc.ABC):
+
+    @abc.abstractmethod
+    def publish(self, data: bytes, ordering_key="", **attrs) -> Future:
+        ...
+
+    def publish_batch(self, messages):
+        return [self.publish(data, **attrs) for data, attrs in messages]
+
+    @abc.abstractmethod
+    def subscribe(self, callback, max_workers=None):
+        ...
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+
+class PubSubTransport(Transport):
+
+    def __init__(self, topic_path=None, subscription_path=None,
+                 batch_max_messages=BATCH_MAX_MESSAGES, batch_max_bytes=BATCH_MAX_BYTES,
+                 batch_max_latency=BATCH_MAX_LATENCY, flow_max_messages=FLOW_MAX_MESSAGES,
+                 flow_max_bytes=FLOW_MAX_BYTES, ordering=True):
+        from google.cloud import pubsub_v1
+
+        self.pubsub_v1 = pubsub_v1
+        self.topic_path = topic_path
+        self.subscription_path = subscription_path
+        self.publisher = None
+        self.ordering = ordering
+        self.settings = (batch_max_messages, batch_max_bytes, batch_max_latency,
+                         flow_max_messages, flow_max_bytes)
+        self.publisher_lock = threading.Lock()
+
+    def _publisher(self):
+        # built on first publish, so subscribe-only receivers never open one
+        with self.publisher_lock:
+            if self.publisher is None:
+                if not self.topic_path:
+                    raise ValueError("publish needs a topic path")
+                self.publisher = self._new_publisher(*self.settings)
+            return self.publisher
+
+    def _new_publisher(self, batch_max_messages, batch_max_bytes, batch_max_latency,
+                       flow_max_messages, flow_max_bytes):
+        pubsub_v1 = self.pubsub_v1
+        # NOTE: ordering keys are only honoured if the subscription was
+        # created with message ordering enabled
+        batch_settings = pubsub_v1.types.BatchSettings(
+            max_messages=batch_max_messages,
+            max_bytes=batch_max_bytes,
+            max_latency=batch_max_latency,
+        )
+        flow_control = pubsub_v1.types.PublishFlowControl(
+            message_limit=flow_max_messages,
+            byte_limit=flow_max_bytes,
+            limit_exceeded_behavior=pubsub_v1.types.LimitExceededBehavior.BLOCK,
+        )
+        options = pubsub_v1.types.PublisherOptions(
+            enable_message_ordering=self.ordering,
+            flow_control=flow_control,
+        )
+        return pubsub_v1.PublisherClient(batch_settings=batch_settings, publisher_options=options)
+
+    def publish(self, data, ordering_key="", **attrs):
+        if not self.ordering:
+            ordering_key = ""
+        publisher = self._publisher()
+        future = publisher.publish(self.topic_path, data, ordering_key=ordering_key, **attrs)
+        if ordering_key:
+            # a failed publish pauses its ordering key until resumed
+            future.add_done_callback(lambda fu: fu.exception() and publisher.resume_publish(
+                self.topic_path, ordering_key))
+        return future
+
+    def subscribe(self, callback, max_workers=None):
+        subscriber = self.pubsub_v1.SubscriberClient()
+        scheduler = None
+        if max_workers:
+            scheduler = self.pubsub_v1.subscriber.scheduler.ThreadScheduler(
+                ThreadPoolExecutor(max_workers=max_workers))
+        return subscriber.subscribe(self.subscription_path, callback=callback, scheduler=scheduler)
+
+    def close(self):
+        if self.publisher is not None:
+            self.publisher.stop()
+
+
+def _name(path):
+    # "projects/p/topics/breadcrumbs" -> "breadcrumbs"
+    return path.rsplit("/", 1)[-1] if path else None
+
+
+def encode_frame(data: bytes, attrs: dict) -> bytes:
+    a = ATTR_SEP.join(f"{k}{KV_SEP}{v}" for k, v in attrs.items()).encode("utf-8")
+    return FRAME.pack(len(data), len(a)) + a + data
+
+
+class LocalMessage:
+
+    __slots__ = ("data", "attributes", "message_id", "offset", "end", "_sub")
+
+    def __init__(self, sub, offset, end, data, attributes):
+        self.data = data
+        self.attributes = attributes
+        self.message_id = str(offset)   # byte offset in the log, unique per topic
+        self.offset = offset
+        self.end = end
+        self._sub = sub
+
+    def ack(self):
+        self._sub.ack(self)
+
+    def nack(self):
+        self._sub.nack(self)
+
+
+class LocalTransport(Transport):
+    # single-host backend: an append-only log file per topic is the queue and
+    # the durable record; a subscriber tails it from its committed offset.
+    # publishers batch frames and append them with one write() under flock,
+    # then poke each subscriber's unix datagram socket so it wakes at once
+    # instead of polling. the log is never truncated here; rotate it offline
+    # once every subscriber's offset file has passed the end
+
+    def __init__(self, topic_path=None, subscription_path=None, directory=LOCAL_DIR,
+                 max_batch_bytes=LOCAL_MAX_BATCH_BYTES, max_latency=LOCAL_MAX_LATENCY,
+                 **_pubsub_settings):
+        self.topic = _name(topic_path) or "breadcrumbs"
+        self.subscription = _name(subscription_path)
+        os.makedirs(directory, exist_ok=True)
+        self.log_path = os.path.join(directory, self.topic + ".log")
+        self.max_batch_bytes = max_batch_bytes
+        self.max_latency = max_latency
+        self.fd = None
+        self.buf = bytearray()
+        self.frames = []            # (position in buf, future) for the pending batch
+        self.cond = threading.Condition()
+        self.flusher = None
+        self.closed = False
+        self.peers = []
+        self.peers_checked = 0.0
+        self.notify_sock = None
+
+    def publish(self, data, ordering_key="", **attrs):
+        # the log is totally ordered, so ordering keys need no extra handling
+        frame = encode_frame(data, attrs)
+        future = Future()
+        with self.cond:
+            self.frames.append((len(self.buf), future))
+            self.buf += frame
+            if len(self.buf) >= self.max_batch_bytes:
+                self._flush()
+            else:
+                if self.flusher is None:
+                    self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+                    self.flusher.start()
+                self.cond.notify()
+        return future
+
+    def publish_batch(self, messages):
+        return [self.publish(data, **attrs) for data, attrs in messages]
+
+    def flush(self):
+        with self.cond:
+            self._flush()
+
+    def close(self):
+        with self.cond:
+            self._flush()
+            self.closed = True
+            self.cond.notify()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _flush_loop(self):
+        with self.cond:
+            while not self.closed:
+                if not self.buf:
+                    self.cond.wait()
+                    continue
+                # let a batch build up for max_latency, then write it
+                self.cond.wait(self.max_latency)
+                self._flush()
+
+    def _flush(self):
+        if not self.buf:
+            return
+        if self.fd is None:
+            self.fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        buf, frames = bytes(self.buf), self.frames
+        self.buf, self.frames = bytearray(), []
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                # a short write (disk full, signal) leaves the rest unwritten;
+                # O_APPEND keeps each retry at the end of the log
+                view = memoryview(buf)
+                while view:
+                    view = view[os.write(self.fd, view):]
+                start = os.lseek(self.fd, 0, os.SEEK_CUR) - len(buf)
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+        except OSError as e:
+            for _, future in frames:
+                future.set_exception(e)
+            return
+        for pos, future in frames:
+            future.set_result(str(start + pos))
+        self._notify()
+
+    def _notify(self):
+        now = time.monotonic()
+        if now - self.peers_checked > 1.0:
+            self.peers = glob.glob(glob.escape(self.log_path) + ".*.sock")
+            self.peers_checked = now
+        if not self.peers:
+            return
+        if self.notify_sock is None:
+            self.notify_sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.notify_sock.setblocking(False)
+        for peer in self.peers:
+            try:
+                self.notify_sock.sendto(b"!", peer)
+            except OSError:
+                pass    # subscriber gone or its queue is full; it'll poll
+
+    def subscribe(self, callback, max_workers=None):
+        if not self.subscription:
+            raise ValueError("local subscribe needs a subscription path")
+        return LocalSubscription(self.log_path, self.subscription, callback, max_workers or 1)
+
+
+class LocalSubscription:
+    # tails <topic>.log from <topic>.log.<sub>.offset. the committed offset only
+    # moves past a message once it and everything before it were acked, so a
+    # restart redelivers whatever was in flight (at-least-once, like Pub/Sub)
+
+    def __init__(self, log_path, name, callback, max_workers=1):
+        self.log_path = log_path
+        self.offset_path = f"{log_path}.{name}.offset"
+        self.sock_path = f"{log_path}.{name}.sock"
+        self.callback = callback
+        self.pool = ThreadPoolExecutor(max_workers) if max_workers > 1 else None
+        self.lock = threading.Lock()
+        self.space = threading.Condition(self.lock)
+        self.inflight = OrderedDict()   # offset -> [end, acked]
+        self.redeliver = deque()
+        self.committed = 0
+        self.saved = 0
+        if os.path.exists(self.offset_path):
+            with open(self.offset_path, "r") as f:
+                self.committed = self.saved = int(f.read().strip() or 0)
+        if os.path.exists(self.sock_path):
+            os.unlink(self.sock_path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.sock_path)
+        self.sock.settimeout(0.2)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def ack(self, message):
+        with self.lock:
+            entry = self.inflight.get(message.offset)
+            if entry is None:
+                return
+            entry[1] = True
+            while self.inflight:
+                offset, (end, acked) = next(iter(self.inflight.items()))
+                if not acked:
+                    break
+                self.inflight.popitem(last=False)
+                self.committed = end
+            self.space.notify()
+
+    def nack(self, message):
+        with self.lock:
+            self.redeliver.append(message)
+
+    def result(self, timeout=None):
+        if not self.stopped.wait(timeout):
+            raise TimeoutError()
+
+    def cancel(self):
+        self.stopped.set()
+        self.thread.join()
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+        self._save_offset()
+        self.sock.close()
+        if os.path.exists(self.sock_path):
+            os.unlink(self.sock_path)
+
+    def _dispatch(self, message):
+        if self.pool is not None:
+            self.pool.submit(self.callback, message)
+        else:
+            self.callback(message)
+
+    def _redeliver(self):
+        with self.lock:
+            again = list(self.redeliver)
+            self.redeliver.clear()
+        for message in again:
+            self._dispatch(message)
+
+    def _save_offset(self):
+        with self.lock:
+            committed = self.committed
+        if committed == self.saved:
+            return
+        tmp = self.offset_path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(str(committed))
+        os.replace(tmp, self.offset_path)
+        self.saved = committed
+
+    def _run(self):
+        while not os.path.exists(self.log_path) and not self.stopped.is_set():
+            self._wait()
+        if self.stopped.is_set():
+            return
+        pos = self.committed
+        pending = b""
+        last_save = time.monotonic()
+        with open(self.log_path, "rb") as f:
+            f.seek(pos)
+            while not self.stopped.is_set():
+                self._redeliver()
+
+                chunk = f.read(LOCAL_READ_SIZE)
+                if not chunk:
+                    if time.monotonic() - last_save > 0.5:
+                        self._save_offset()
+                        last_save = time.monotonic()
+                    self._wait()
+                    continue
+                data = pending + chunk if pending else chunk
+                base = pos - len(pending)
+                i, n = 0, len(data)
+                view = memoryview(data)
+                while i + FRAME.size <= n:
+                    dlen, alen = FRAME.unpack_from(data, i)
+                    end = i + FRAME.size + alen + dlen
+                    if end > n:
+                        break   # frame continues in the next read
+                    a = bytes(view[i + FRAME.size:i + FRAME.size + alen]).decode("utf-8")
+                    attrs = dict(kv.split(KV_SEP, 1) for kv in a.split(ATTR_SEP)) if a else {}
+                    message = LocalMessage(self, base + i, base + end,
+                                           bytes(view[end - dlen:end]), attrs)
+                    # flow control: don't run too far ahead of the acks. nacked
+                    # messages still count, so keep redelivering them while
+                    # waiting or a full window of nacks would stall for good
+                    while True:
+                        with self.lock:
+                            if len(self.inflight) < LOCAL_MAX_OUTSTANDING or self.stopped.is_set():
+                                self.inflight[message.offset] = [message.end, False]
+                                break
+                            self.space.wait(0.2)
+                        self._redeliver()
+                    self._dispatch(message)
+                    i = end
+                view.release()
+                pending = data[i:]
+                pos += len(chunk)
+                if time.monotonic() - last_save > 0.5:
+                    self._save_offset()
+                    last_save = time.monotonic()
+
+    def _wait(self):
+        try:
+            self.sock.recv(64)
+        except (socket.timeout, OSError):
+            pass
@@ -0,0 +1,162 @@
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+# last accepted breadcrumb per live trip, for the receiver's speed and
+# inter-record checks. the newest breadcrumb the sink has committed is kept
+# alongside and checkpointed to a small SQLite file, so a restart picks trips
+# up where they left off instead of resetting speed to 0, without getting
+# ahead of messages that were never acked and will be redelivered
+STATE_FILE = "trip_state.db"
+STATE_TTL = 3 * 3600            # a trip with no breadcrumb for this long is over
+STATE_MAX_TRIPS = 20_000        # hard cap; the least recently updated go first
+CHECKPOINT_EVERY = 60           # seconds between checkpoints
+
+logger = logging.getLogger("receiver.state")
+
+
+class TripState:
+    __slots__ = ("act_time", "meters", "opd_date", "seen")
+
+    def __init__(self, act_time, meters, opd_date, seen):
+        self.act_time = act_time
+        self.meters = meters
+        self.opd_date = opd_date    # interned: every live trip shares a few dates
+        self.seen = seen            # wall clock, so it means something after a restart
+
+
+class TripStateStore:
+
+    def __init__(self, path=STATE_FILE, ttl=STATE_TTL, max_trips=STATE_MAX_TRIPS,
+                 checkpoint_every=CHECKPOINT_EVERY):
+        self.path = path
+        self.ttl = ttl
+        self.max_trips = max_trips
+        self.checkpoint_every = checkpoint_every
+        self.trips = OrderedDict()      # trip_id -> TripState, least recently updated first
+        self.committed = OrderedDict()  # trip_id -> TripState of its newest committed breadcrumb
+        self.lock = threading.Lock()
+        self.checkpoint_lock = threading.Lock()     # one checkpoint written at a time
+        self.last_checkpoint = time.monotonic()
+        self.expired = 0
+        if path and os.path.exists(path):
+            self.restore()
+
+    def __len__(self):
+        return len(self.trips)
+
+    def get(self, trip_id):
+        return self.trips.get(trip_id)
+
+    def pop(self, trip_id):
+        with self.lock:
+            return self.trips.pop(trip_id, None)
+
+    def put(self, trip_id, act_time, meters, opd_date):
+        now = time.time()
+        with self.lock:
+            self._set(self.trips, trip_id, act_time, meters, opd_date, now)
+            self._evict(self.trips, now)
+
+    def commit(self, trip_id, act_time, meters, opd_date):
+        # trip_id's breadcrumbs up to act_time are in BreadCrumb. a trip whose
+        # state was rolled back meanwhile moves forward to here as well
+        now = time.time()
+        with self.lock:
+            state = self.committed.get(trip_id)
+            if state is None or state.opd_date != opd_date or state.act_time < act_time:
+                self._set(self.committed, trip_id, act_time, meters, opd_date, now)
+                self._evict(self.committed, now)
+            state = self.trips.get(trip_id)
+            if state is None or (state.opd_date == opd_date and state.act_time < act_time):
+                self._set(self.trips, trip_id, act_time, meters, opd_date, now)
+                self._evict(self.trips, now)
+            due = time.monotonic() - self.last_checkpoint >= self.checkpoint_every
+            if due:
+                self.last_checkpoint = time.monotonic()     # claimed: nobody else starts one
+        if due:
+            try:
+                self.checkpoint()
+            except (OSError, sqlite3.Error) as e:
+                logger.error("Trip state checkpoint failed: %s", e)
+
+    def rollback(self, trip_ids) -> dict:
+        # a batch holding these trips failed and will be redelivered: each
+        # goes back to its last committed breadcrumb (or none).
+        # -> {trip_id: committed ACT_TIME or None}
+        upto = {}
+        with self.lock:
+            for tid in trip_ids:
+                state = self.committed.get(tid)
+                if state is None:
+                    self.trips.pop(tid, None)
+                    upto[tid] = None
+                else:
+                    self.trips[tid] = TripState(state.act_time, state.meters, state.opd_date, state.seen)
+                    upto[tid] = state.act_time
+        return upto
+
+    def _set(self, table, trip_id, act_time, meters, opd_date, now):
+        state = table.get(trip_id)
+        if state is None:
+            table[trip_id] = TripState(act_time, meters, sys.intern(opd_date), now)
+        else:
+            state.act_time, state.meters, state.seen = act_time, meters, now
+            if state.opd_date != opd_date:
+                state.opd_date = sys.intern(opd_date)
+            table.move_to_end(trip_id)
+
+    def _evict(self, table, now):
+        while table:
+            trip_id, state = next(iter(table.items()))
+            if len(table) <= self.max_trips and now - state.seen <= self.ttl:
+                break
+            del table[trip_id]
+            if table is self.trips:
+                self.expired += 1
+
+    def checkpoint(self):
+        # snapshot of the committed state into a fresh file, then rename over
+        # the old one
+        if not self.path:
+            return
+        with self.checkpoint_lock:
+            with self.lock:
+                self.last_checkpoint = time.monotonic()
+                rows = [(tid, s.act_time, s.meters, s.opd_date, s.seen)
+                        for tid, s in self.committed.items()]
+            tmp = f"{self.path}.{os.getpid()}-{threading.get_ident()}.tmp"
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            db = sqlite3.connect(tmp)
+            try:
+                db.execute("""CREATE TABLE trip_state (trip_id INTEGER PRIMARY KEY, act_time INTEGER,
+                              meters INTEGER, opd_date TEXT, seen REAL)""")
+                db.executemany("INSERT INTO trip_state VALUES (?, ?, ?, ?, ?)", rows)
+                db.commit()
+            finally:
+                db.close()
+            os.replace(tmp, self.path)
+
+    def restore(self):
+        db = sqlite3.connect(self.path)
+        try:
+            rows = db.execute("SELECT trip_id, act_time, meters, opd_date, seen "
+                              "FROM trip_state ORDER BY seen").fetchall()
+        except sqlite3.DatabaseError:
+            rows = []   # unreadable checkpoint: start cold
+        finally:
+            db.close()
+        with self.lock:
+            for tid, act_time, meters, opd_date, seen in rows:
+                opd_date = sys.intern(opd_date)
+                self.committed[tid] = TripState(act_time, meters, opd_date, seen)
+                self.trips[tid] = TripState(act_time, meters, opd_date, seen)
+            now = time.time()
+            self._evict(self.committed, now)
+            self._evict(self.trips, now)
+        return len(self.trips)
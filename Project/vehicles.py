@@ -0,0 +1,72 @@
+import json
+import os
+from datetime import date, timedelta
+
+# every vehicle we poll
+VEHICLE_IDS = [
+    2901, 2902, 2904, 2905, 2907, 2908, 2910, 2922, 2924, 2926, 2929, 2935, 2937, 3001, 3002, 3004, 3006,
+    3008, 3009, 3010, 3017, 3020, 3029, 3036, 3042, 3046, 3052, 3054, 3059, 3105, 3108, 3110, 3115, 3117,
+    3118, 3121, 3122, 3125, 3127, 3128, 3132, 3138, 3141, 3146, 3149, 3150, 3153, 3158, 3160, 3163, 3203,
+    3204, 3206, 3208, 3213, 3214, 3219, 3220, 3223, 3226, 3227, 3231, 3233, 3234, 3235, 3237, 3240, 3241,
+    3242, 3243, 3247, 3249, 3250, 3251, 3252, 3254, 3255, 3261, 3264, 3265, 3315, 3318, 3320, 3324, 3330,
+    3404, 3406, 3412, 3417, 3418, 3422, 3503, 3508, 3512, 3521, 3523, 3528, 3534, 3536, 3548, 3549, 3554,
+    3557, 3562, 3563, 3565, 3569, 3577, 3603, 3620, 3631, 3633, 3635, 3637, 3639, 3645, 3647, 3649, 3650,
+    3702, 3704, 3705, 3712, 3718, 3720, 3723, 3725, 3730, 3731, 3732, 3733, 3737, 3738, 3748, 3749, 3750,
+    3754, 3755, 3756, 3902, 3907, 3911, 3912, 3914, 3920, 3922, 3923, 3926, 3928, 3932, 3934, 3935, 3938,
+    3939, 3943, 3948, 3951, 3952, 3960, 3963, 3964, 4002, 4006, 4009, 4017, 4019, 4022, 4026, 4031, 4033,
+    4038, 4043, 4049, 4053, 4058, 4060, 4062, 4070, 4202, 4206, 4208, 4209, 4213, 4217, 4218, 4223, 4225,
+    4226, 4228, 4231, 4236, 4237, 4238, 4302, 4510, 4513, 4521, 4526, 4528, 4530
+]
+
+REGISTRY_FILE = "vehicles.json"
+MAX_BACKOFF_DAYS = 8    # an idle bus sinks to the back of the run for at most this long
+
+
+class VehicleRegistry:
+    # learns which vehicles actually run from past fetch results.
+    # per vehicle: consecutive idle runs, until when it's deprioritised, last
+    # record count. every vehicle is still polled every run (the API only
+    # serves yesterday, so a skipped day is gone for good); idle ones back off
+    # exponentially (1, 2, 4, ... MAX_BACKOFF_DAYS days) to the end of the
+    # run, and any records bring them back to the front
+
+    def __init__(self, path=REGISTRY_FILE, known=VEHICLE_IDS):
+        self.path = path
+        self.stats = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.stats = json.load(f)
+        for vehicle_id in known:
+            self.stats.setdefault(str(vehicle_id),
+                                  {"idle_runs": 0, "next_poll": None, "last_count": None})
+
+    def due(self, today=None):
+        # every vehicle, in poll order: active ones first, busiest first so
+        # the big responses start early and don't end up on the tail of the
+        # run, then the ones backing off
+        today = (today or date.today()).isoformat()
+
+        def order(v):
+            s = self.stats[str(v)]
+            backing_off = s["next_poll"] is not None and s["next_poll"] > today
+            return backing_off, -(s["last_count"] or 0), v
+
+        return sorted((int(k) for k in self.stats), key=order)
+
+    def record_result(self, vehicle_id, count, today=None):
+        today = today or date.today()
+        s = self.stats[str(vehicle_id)]
+        s["last_count"] = count
+        if count:
+            s["idle_runs"] = 0
+            s["next_poll"] = None
+        else:
+            s["idle_runs"] += 1
+            wait = min(2 ** (s["idle_runs"] - 1), MAX_BACKOFF_DAYS)
+            s["next_poll"] = (today + timedelta(days=wait)).isoformat()
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.stats, f, indent=1)
+        os.replace(tmp, self.path)
@@ -0,0 +1,176 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import date
+
+# raw-message archive written by one background thread: callbacks only queue
+# (message id, records); the writer keeps the day's YYYY-MM-DD.json open,
+# appends whatever has queued up as one group, flushes it, fsyncs at most
+# every FSYNC_INTERVAL seconds and switches files at midnight. every line is
+# one record tagged with the Pub/Sub message id ("_msg"), so after a crash the
+# file replays message by message (replay() below, or backfill.py, which
+# reads the same files)
+ARCHIVE_DIR = "."
+FSYNC_INTERVAL = 1.0    # seconds between fsyncs; 0 fsyncs every group, None never
+GROUP_MAX = 500         # messages written per group commit
+QUEUE_SIZE = 10_000     # queued messages before callbacks block
+MESSAGE_FIELD = "_msg"
+
+logger = logging.getLogger("receiver.archive")
+
+
+def archive_path(directory, day: date) -> str:
+    return os.path.join(directory, f"{day:%Y-%m-%d}.json")
+
+
+class ArchiveWriter:
+
+    def __init__(self, directory=ARCHIVE_DIR, fsync_interval=FSYNC_INTERVAL,
+                 group_max=GROUP_MAX, queue_size=QUEUE_SIZE):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.group_max = group_max
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.file = None
+        self.day = None
+        self.last_sync = time.monotonic()
+        self.unsynced = []      # on_durable callbacks waiting for the next fsync
+        self.messages = 0
+        self.records = 0
+        self.groups = 0
+        self.syncs = 0
+        self.errors = 0
+        os.makedirs(directory, exist_ok=True)
+        self.writer = threading.Thread(target=self._write_loop, name="archive-writer", daemon=True)
+        self.writer.start()
+
+    def write(self, message_id, records, on_durable=None):
+        # on_durable(ok) runs once the lines are flushed (and fsynced, if fsync
+        # is on), or with ok=False if they couldn't be written
+        self.queue.put((message_id, records, on_durable))
+
+    def close(self):
+        self.queue.put(None)
+        self.writer.join()
+
+    def _write_loop(self):
+        stopping = False
+        while not stopping:
+            try:
+                item = self.queue.get(timeout=self._sync_wait())
+            except queue.Empty:
+                self._sync(force=False)
+                continue
+            group = []
+            while item is not None:
+                group.append(item)
+                if len(group) >= self.group_max:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            stopping = item is None
+            if group:
+                self._commit(group)
+        self._sync(force=True)
+        if self.file is not None:
+            self.file.close()
+        logger.info("Archived %d messages (%d records) in %d groups, %d fsyncs",
+                    self.messages, self.records, self.groups, self.syncs)
+
+    def _sync_wait(self):
+        if not self.unsynced or self.fsync_interval is None:
+            return None
+        return max(0.0, self.fsync_interval - (time.monotonic() - self.last_sync))
+
+    def _commit(self, group):
+        try:
+            self._rotate()
+            lines = []
+            for message_id, records, _ in group:
+                for rec in records:
+                    lines.append(json.dumps({MESSAGE_FIELD: message_id, **rec}))
+            if lines:
+                self.file.write("\n".join(lines) + "\n")
+            self.file.flush()
+        except Exception as e:
+            self.errors += 1
+            logger.error("Archive write of %d messages failed: %s", len(group), e)
+            for _, _, cb in group:
+                if cb is not None:
+                    self._callback(cb, False)
+            return
+        self.groups += 1
+        self.messages += len(group)
+        self.records += sum(len(records) for _, records, _ in group)
+        self.unsynced.extend(cb for _, _, cb in group if cb is not None)
+        self._sync(force=self.fsync_interval == 0)
+
+    def _rotate(self):
+        today = date.today()
+        if self.file is not None and today == self.day:
+            return
+        if self.file is not None:
+            self._sync(force=True)      # yesterday's file is complete on disk
+            self.file.close()
+        self.day = today
+        self.file = open(archive_path(self.directory, today), "a", encoding="utf-8")
+
+    def _sync(self, force):
+        if self.file is not None and self.fsync_interval is not None:
+            if not force and time.monotonic() - self.last_sync < self.fsync_interval:
+                return
+            try:
+                os.fsync(self.file.fileno())
+                self.syncs += 1
+            except OSError as e:
+                self.errors += 1
+                logger.error("Archive fsync failed: %s", e)
+        self.last_sync = time.monotonic()
+        callbacks, self.unsynced = self.unsynced, []
+        for cb in callbacks:
+            self._callback(cb, True)
+
+    def _callback(self, cb, ok):
+        try:
+            cb(ok)
+        except Exception as e:
+            logger.error("Archive callback failed: %s", e)
+
+    def stats(self) -> dict:
+        return {"messages": self.messages, "records": self.records, "groups": self.groups,
+                "fsyncs": self.syncs, "queued": self.queue.qsize(), "errors": self.errors}
+
+
+def replay(path):
+    # -> (message id, [records]) per message, in file order; a message that
+    # was archived more than once (redelivery) comes back once, and a line
+    # torn by a crash ends the replay. lines without an id (files from
+    # before the id was recorded) come back one record at a time
+    seen = set()
+    current, records = None, []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.startswith("{"):
+                continue
+            try:
+                rec = json.loads(line)
+            except ValueError:
+                logger.warning("Stopping replay of %s at a torn line", path)
+                break
+            message_id = rec.pop(MESSAGE_FIELD, None)
+            if message_id is None:
+                yield None, [rec]
+                continue
+            if message_id != current:
+                if records and current not in seen:
+                    seen.add(current)
+                    yield current, records
+                current, records = message_id, []
+            records.append(rec)
+    if records and current not in seen:
+        yield current, records